@@ -0,0 +1,381 @@
+# coding: utf-8
+"""
+asyncio client with the CRUD API and the dict based where syntax of SQLPool.
+
+    pool = AsyncSQLPool(**config)
+    insert_id = await pool.insert(table='t1', obj={'name': 'abc', 'age': 10})
+    async for row in pool.query(table='t1', where={'id__in': [1, 2, 3]}):
+        print(row.name)
+    async with pool.transaction():
+        await pool.update(table='t1', where={'id': 3}, obj={'age': 11})
+
+Transactions are task local (contextvars) instead of thread local.
+"""
+
+import asyncio
+import collections
+import contextvars
+
+try:
+    from .pool import InsertIds, SQLCompiler, SQLBuilder, import_driver
+except ImportError:
+    from pool import InsertIds, SQLCompiler, SQLBuilder, import_driver
+
+
+class AsyncConnectionPool(object):
+    """
+    asyncio connection pool: keeps up to `maxcached` idle connections and opens
+    at most `maxconnections` connections (0 means unlimited), callers beyond
+    that wait for a release.
+    """
+
+    def __init__(self, module, config, maxcached=10, maxconnections=0):
+        self.module = module
+        self.config = config
+        self.maxcached = maxcached
+        self.maxconnections = maxconnections
+        self.size = 0
+        self._idle = collections.deque()
+        self._cond = asyncio.Condition()
+
+    async def acquire(self):
+        async with self._cond:
+            while True:
+                if self._idle:
+                    return self._idle.pop()
+                if not self.maxconnections or self.size < self.maxconnections:
+                    self.size += 1
+                    break
+                await self._cond.wait()
+        try:
+            return await self.module.connect(**self.config)
+        except Exception:
+            async with self._cond:
+                self.size -= 1
+                self._cond.notify()
+            raise
+
+    async def release(self, conn, discard=False):
+        async with self._cond:
+            if discard or len(self._idle) >= self.maxcached:
+                self.size -= 1
+                conn.close()
+            else:
+                self._idle.append(conn)
+            self._cond.notify()
+
+    async def close(self):
+        async with self._cond:
+            while self._idle:
+                self._idle.pop().close()
+                self.size -= 1
+
+
+class _TransactionState(object):
+    """
+    Connection and stack of open transactions of one task. Tasks started by
+    the task copy its context but not its state: they run on connections of
+    their own, never on the transaction's connection at the same time.
+    """
+
+    __slots__ = ['conn', 'stack', 'task']
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.stack = []
+        self.task = asyncio.current_task()
+
+
+class AsyncTransaction(object):
+    """
+    Task local transaction, nested transactions use savepoints.
+
+        async with pool.transaction():
+            ...
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.state = None
+        self.savepoint = None
+        self._token = None
+
+    async def __aenter__(self):
+        state = self.pool._current_state()
+        if state is None:
+            state = _TransactionState(await self.pool._pool.acquire())
+            self._token = self.pool._state.set(state)
+        else:
+            self.savepoint = 'sp_%d' % len(state.stack)
+            await self.pool._execute(state.conn, SQLBuilder('SAVEPOINT ' + self.savepoint))
+        self.state = state
+        state.stack.append(self)
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            await self.commit()
+        else:
+            await self.rollback()
+        return False
+
+    async def commit(self):
+        await self._finish('RELEASE SAVEPOINT %s', 'commit')
+
+    async def rollback(self):
+        await self._finish('ROLLBACK TO SAVEPOINT %s', 'rollback')
+
+    async def _finish(self, savepoint_sql, method):
+        state, self.state = self.state, None
+        if state is None:
+            return
+        assert state.stack[-1] is self, 'Inner transactions must finish first'
+        state.stack.pop()
+        if self.savepoint:
+            await self.pool._execute(state.conn, SQLBuilder(savepoint_sql % self.savepoint))
+            return
+        try:
+            await getattr(state.conn, method)()
+        finally:
+            self.pool._state.reset(self._token)
+            await self.pool._pool.release(state.conn)
+
+
+class AsyncResult(object):
+    """
+    Rows of an async query, the statement is sent on first use:
+
+        async for row in pool.query(...)      # iterate, fetched batch_size rows at a time
+        rows = await pool.query(...)          # list of rows (rowcount without result set)
+        async with pool.query(..., stream=True) as rows:
+
+    Outside a transaction the result holds a pooled connection until the rows
+    are exhausted or it is closed. A result dropped before that discards its
+    connection.
+    """
+
+    def __init__(self, pool, sqlquery, row_factory=None, batch_size=1000, stream=False):
+        self.pool = pool
+        self.sqlquery = sqlquery
+        self.row_factory = row_factory
+        self.batch_size = batch_size
+        self.stream = stream
+        self.cursor = None
+        self.description = None
+        self.rowcount = None
+        self._conn = None
+        self._started = False
+        self._batch = iter(())
+        self._make_row = None
+        self._loop = None
+
+    def __del__(self):
+        conn, self._conn = self._conn, None
+        if conn is None:
+            return
+        # Unread rows may be pending on the connection, it is closed rather than reused.
+        pool, loop = self.pool._pool, self._loop
+        if loop is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(lambda: loop.create_task(pool.release(conn, discard=True)))
+        else:
+            pool.size -= 1
+            conn.close()
+
+    async def _start(self):
+        self._started = True
+        self._loop = asyncio.get_running_loop()
+        state = self.pool._current_state()
+        if state is None:
+            conn = self._conn = await self.pool._pool.acquire()
+        else:
+            conn = state.conn
+        cursorclass = self.pool._ss_cursorclass() if self.stream else None
+        try:
+            self.cursor = await self.pool._execute(conn, self.sqlquery, cursorclass)
+        except Exception:
+            await self._release(error=True)
+            raise
+        self.rowcount = self.cursor.rowcount
+        self.description = self.cursor.description
+        if self.description:
+            self._make_row = self.pool._row_maker(self.description, self.row_factory)
+        else:
+            await self.aclose()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self._started:
+            await self._start()
+        for row in self._batch:
+            return row if self._make_row is None else self._make_row(row)
+        if self.cursor is not None:
+            rows = await self.cursor.fetchmany(self.batch_size)
+            if rows:
+                self._batch = iter(rows)
+                return await self.__anext__()
+            await self.aclose()
+        raise StopAsyncIteration
+
+    async def _all(self):
+        if not self._started:
+            await self._start()
+        if not self.description:
+            return self.rowcount
+        return [row async for row in self]
+
+    def __await__(self):
+        return self._all().__await__()
+
+    async def _release(self, error=False):
+        conn, self._conn = self._conn, None
+        if conn is None:
+            return
+        try:
+            if error:
+                await conn.rollback()
+            else:
+                await conn.commit()
+        finally:
+            await self.pool._pool.release(conn, discard=error)
+
+    async def aclose(self):
+        """Close the cursor and give the connection back"""
+        cursor, self.cursor = self.cursor, None
+        self._batch = iter(())
+        try:
+            if cursor is not None:
+                await cursor.close()
+        finally:
+            await self._release()
+
+    async def __aenter__(self):
+        if not self._started:
+            await self._start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.aclose()
+
+
+class AsyncSQLPool(SQLCompiler):
+    """
+    MySQL asyncio Pool Connection, takes the config of SQLPool. The driver is
+    aiomysql or asyncmy unless a `module` is given.
+    """
+
+    def __init__(self, module=None, **config):
+        if module is None:
+            module = import_driver(['aiomysql', 'asyncmy'])
+
+        config['port'] = int(config.get('port', 3306))
+        config['charset'] = config.get('charset', 'utf8')
+        if 'passwd' in config:
+            config['password'] = config.pop('passwd')
+        statement_cache_size = config.pop('statement_cache_size', 1024)
+        row_factory = config.pop('row_factory', 'item')
+        maxcached = config.pop('maxcached', 10) or 10
+        maxconnections = config.pop('maxconnections', 0)
+        for key in ('mincached', 'maxshared', 'blocking', 'maxusage', 'setsession', 'reset', 'ping'):
+            config.pop(key, None)
+
+        super(AsyncSQLPool, self).__init__(statement_cache_size=statement_cache_size, row_factory=row_factory)
+        self.module = module
+        self.config = config
+        self._pool = AsyncConnectionPool(module, config, maxcached, maxconnections)
+        self._state = contextvars.ContextVar('pysql_transaction_%x' % id(self), default=None)
+        self._increment = None
+
+    def _current_state(self):
+        """Transaction state of the current task, None outside transactions"""
+        state = self._state.get()
+        if state is None or state.task is not asyncio.current_task():
+            return None
+        return state
+
+    def _ss_cursorclass(self):
+        """Return the unbuffered cursor class of the driver, or None"""
+        cursorclass = getattr(self.module, 'SSCursor', None)
+        return cursorclass or getattr(getattr(self.module, 'cursors', None), 'SSCursor', None)
+
+    async def _execute(self, conn, sqlquery, cursorclass=None):
+        """Execute `sqlquery` on `conn`, return the cursor"""
+        cursor = await (conn.cursor(cursorclass) if cursorclass else conn.cursor())
+        await cursor.execute(sqlquery.query(), sqlquery.values() or None)
+        return cursor
+
+    async def _write(self, sqlquery):
+        """Execute a statement and commit it unless a transaction is open, return the cursor"""
+        state = self._current_state()
+        if state is not None:
+            return await self._execute(state.conn, sqlquery)
+
+        conn = await self._pool.acquire()
+        try:
+            cursor = await self._execute(conn, sqlquery)
+            await conn.commit()
+        except Exception:
+            try:
+                await conn.rollback()
+            finally:
+                await self._pool.release(conn, discard=True)
+            raise
+        await self._pool.release(conn)
+        return cursor
+
+    async def insert(self, table, obj={}, mode='INSERT', dup={}):
+        cursor = await self._write(self._compile_insert(table, obj, mode, dup))
+        return cursor.lastrowid
+
+    async def insertmany(self, table, objs=[], mode='INSERT', dup={}):
+        """
+        Insert rows with one multiple-row INSERT statement.
+        :return: InsertIds of the rows, None if there is no row. Like with
+                 `DB.insertmany` the ids are None unless every row got one.
+        """
+        objs = list(objs)
+        if not objs:
+            return None
+        increment = await self._auto_increment_increment()
+        cursor = await self._write(self._compile_insertmany(table, objs, mode, dup))
+        out = InsertIds()
+        first, count = cursor.lastrowid, len(objs)
+        # IGNORE skips rows, REPLACE and ON DUPLICATE KEY UPDATE count rows twice.
+        if first and cursor.rowcount == count and not dup:
+            out.add(count, range(first, first + count * increment, increment))
+        else:
+            out.add(count, None)
+        return out
+
+    async def _auto_increment_increment(self):
+        """auto_increment_increment of the server, read once"""
+        if self._increment is None:
+            rows = await self.execute('SELECT @@auto_increment_increment', row_factory='tuple')
+            self._increment = int(rows[0][0])
+        return self._increment
+
+    async def update(self, table, where={}, obj={}):
+        cursor = await self._write(self._compile_update(table, where, obj))
+        return cursor.rowcount
+
+    async def delete(self, table, where={}, using=None):
+        cursor = await self._write(self._compile_delete(table, where, using))
+        return cursor.rowcount
+
+    def query(self, table, where={}, group_by=None, having=None, order_by=None, fields=['*'], page=0, page_num=10,
+              stream=False, batch_size=1000, row_factory=None):
+        """Same arguments as `DB.query`, returns an AsyncResult"""
+        sqlquery = self._compile_select(table, where, group_by, having, order_by, fields, page, page_num)
+        return AsyncResult(self, sqlquery, row_factory, batch_size, stream)
+
+    def execute(self, sql, stream=False, batch_size=1000, row_factory=None):
+        """Execute raw sql, returns an AsyncResult"""
+        return AsyncResult(self, SQLBuilder(sql), row_factory, batch_size, stream)
+
+    def transaction(self):
+        return AsyncTransaction(self)
+
+    async def close(self):
+        """Close the idle connections"""
+        await self._pool.close()
@@ -0,0 +1,46 @@
+# coding: utf-8
+"""
+Client overhead per statement of the query hooks: no hook, an empty QueryHook
+and a QueryRecorder. The driver (fakedriver) does no I/O, so only pysql's own work is timed.
+
+    python benchmarks/bench_hooks.py [-n 100000] [-r 10]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from pool import DB, QueryHook, QueryRecorder
+
+import fakedriver
+
+
+def bench(n, nrows):
+    fakedriver.respond(r'^\s*SELECT .* FROM t1\b', ['id', 'name'], [(i, 'name_%d' % i) for i in range(nrows)])
+    cases = (('none', []), ('empty hook', [QueryHook()]), ('recorder', [QueryRecorder()]))
+
+    print('%-12s %14s %14s' % ('hooks', 'update/s', 'query/s'))
+    for name, hooks in cases:
+        pool = DB(fakedriver, {}, hooks=hooks)
+        start = time.perf_counter()
+        for i in range(n):
+            pool.update('t1', where={'id': i}, obj={'age': 1})
+        updates = n / (time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for i in range(n):
+            list(pool.query('t1', where={'id__in': [i, i + 1]}))
+        queries = n / (time.perf_counter() - start)
+        print('%-12s %14.0f %14.0f' % (name, updates, queries))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-n', '--number', type=int, default=100000)
+    parser.add_argument('-r', '--rows', type=int, default=10)
+    args = parser.parse_args()
+    bench(args.number, args.rows)
@@ -0,0 +1,70 @@
+# coding: utf-8
+"""
+Rows/s of insertmany ingesting a generator of rows, per chunk size.
+Runs on the sqlite stand-in driver of the tests unless a MySQL server is given.
+
+    python benchmarks/bench_insertmany.py [-r 1000000] [-s 100,1000,5000] [--host 127.0.0.1 --user root --db test]
+"""
+
+import argparse
+import datetime
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pool import DB, import_driver
+
+
+TABLE = 'bench_insertmany'
+SCHEMAS = {
+    'mysql': """CREATE TABLE %s (id BIGINT PRIMARY KEY AUTO_INCREMENT, name VARCHAR(64),
+                age INT, score DOUBLE, created DATETIME)""" % TABLE,
+    'sqlite': """CREATE TABLE %s (id INTEGER PRIMARY KEY AUTOINCREMENT, name VARCHAR(64),
+                 age INT, score DOUBLE, created DATETIME)""" % TABLE,
+}
+
+
+def rows(count):
+    now = datetime.datetime(2020, 1, 1)
+    for i in range(count):
+        yield {'name': 'name-%d' % i, 'age': i % 100, 'score': i / 7.0, 'created': now.isoformat()}
+
+
+def connect(args):
+    if args.host:
+        module = import_driver(['pymysql', 'MySQLdb'])
+        config = {'host': args.host, 'port': args.port, 'user': args.user, 'passwd': args.password,
+                  'db': args.db, 'charset': 'utf8'}
+        return DB(module, config), 'mysql'
+    from test import fakedb
+    fakedb.reset()
+    return DB(fakedb, {'host': 'bench', 'db': 'bench'}), 'sqlite'
+
+
+def bench(args):
+    pool, dialect = connect(args)
+    print('%-10s %12s %10s' % ('chunk', 'rows/s', 'seconds'))
+    for chunk_size in args.chunk_sizes:
+        pool.execute('DROP TABLE IF EXISTS %s' % TABLE)
+        pool.execute(SCHEMAS[dialect])
+        start = time.perf_counter()
+        ids = pool.insertmany(TABLE, rows(args.rows), chunk_size=chunk_size)
+        elapsed = time.perf_counter() - start
+        assert len(ids) == args.rows
+        print('%-10d %12.0f %10.2f' % (chunk_size, args.rows / elapsed, elapsed))
+    pool.execute('DROP TABLE IF EXISTS %s' % TABLE)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-r', '--rows', type=int, default=1000000)
+    parser.add_argument('-s', '--chunk-sizes', default='100,1000,5000',
+                        type=lambda s: [int(x) for x in s.split(',')])
+    parser.add_argument('--host')
+    parser.add_argument('--port', type=int, default=3306)
+    parser.add_argument('--user', default='root')
+    parser.add_argument('--password', default='')
+    parser.add_argument('--db', default='test')
+    bench(parser.parse_args())
@@ -0,0 +1,50 @@
+# coding: utf-8
+"""
+Throughput and memory of materializing query rows with each row factory.
+
+    python benchmarks/bench_row_factory.py [-r 200000] [-c 20]
+"""
+
+import argparse
+import gc
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pool import DB, ROW_FACTORIES
+
+
+def bench(nrows, ncols):
+    description = tuple(('column_%d' % i, 3, None, None, None, None, True) for i in range(ncols))
+    rows = [tuple(range(i, i + ncols)) for i in range(nrows)]
+    db = DB(None, {})
+
+    print('%-8s %14s %14s %14s' % ('factory', 'rows/s', 'bytes/row', 'peak MB'))
+    for name in sorted(ROW_FACTORIES):
+        gc.collect()
+        start = time.perf_counter()
+        make_row = db._row_maker(description, name)
+        out = list(rows) if make_row is None else list(map(make_row, rows))
+        elapsed = time.perf_counter() - start
+        del out
+
+        gc.collect()
+        tracemalloc.start()
+        make_row = db._row_maker(description, name)
+        out = list(rows) if make_row is None else list(map(make_row, rows))
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del out
+
+        print('%-8s %14.0f %14.1f %14.2f' % (name, nrows / elapsed, current / float(nrows), peak / 1e6))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-r', '--rows', type=int, default=200000)
+    parser.add_argument('-c', '--columns', type=int, default=20)
+    args = parser.parse_args()
+    bench(args.rows, args.columns)
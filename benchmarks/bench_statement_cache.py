@@ -0,0 +1,42 @@
+# coding: utf-8
+"""
+Per-call SQL build overhead of insert/update/delete/query with and without
+the compiled statement cache.
+
+    python benchmarks/bench_statement_cache.py [-n 100000]
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pool import DB, Field
+
+
+CASES = (
+    ('insert', '_compile_insert', ('t1', {'name': 'abc', 'age': 10, 'score': 1.5}, 'INSERT', {})),
+    ('update', '_compile_update', ('t1', {'id__in': list(range(20)), 'age__gte': 3}, {'age': 9, 'num': Field('num+1')})),
+    ('delete', '_compile_delete', ('t1', {'id__gte': 12, 'id__lte': 20}, None)),
+    ('query', '_compile_select', ('t1', {'id__in': [1, 2, 3], 'name': 'a'}, None, None, ['id'], ['id', 'name'], 0, 10)),
+)
+
+
+def bench(number):
+    uncached = DB(None, {}, statement_cache_size=0)
+    cached = DB(None, {})
+
+    print('%-8s %14s %14s %8s' % ('op', 'uncached us', 'cached us', 'speedup'))
+    for name, method, args in CASES:
+        before = timeit.timeit(lambda: getattr(uncached, method)(*args), number=number)
+        after = timeit.timeit(lambda: getattr(cached, method)(*args), number=number)
+        print('%-8s %14.2f %14.2f %7.1fx' % (name, before / number * 1e6, after / number * 1e6, before / after))
+    print('cache: %s' % cached.statement_cache.stats())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-n', '--number', type=int, default=100000)
+    bench(parser.parse_args().number)
@@ -0,0 +1,82 @@
+# coding: utf-8
+"""
+Writes/s of single-row inserts from many threads, committed one by one
+(`pool.insert`) and group committed by a WriteBatcher.
+Runs on the sqlite stand-in driver of the tests unless a MySQL server is given.
+
+    python benchmarks/bench_write_batcher.py [-t 16] [-w 500] [--host 127.0.0.1 --user root --db test]
+"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pool import DB, import_driver
+
+
+TABLE = 'bench_write_batcher'
+SCHEMAS = {
+    'mysql': 'CREATE TABLE %s (id BIGINT PRIMARY KEY AUTO_INCREMENT, name VARCHAR(64), age INT)' % TABLE,
+    'sqlite': 'CREATE TABLE %s (id INTEGER PRIMARY KEY AUTOINCREMENT, name VARCHAR(64), age INT)' % TABLE,
+}
+
+
+def connect(args):
+    config = {'maxconnections': args.threads + 1, 'blocking': True}
+    if args.host:
+        module = import_driver(['pymysql', 'MySQLdb'])
+        config.update(host=args.host, port=args.port, user=args.user, passwd=args.password, db=args.db,
+                      charset='utf8')
+        return DB(module, config), 'mysql'
+    from test import fakedb
+    fakedb.reset()
+    config.update(host='bench', db='bench')
+    return DB(fakedb, config), 'sqlite'
+
+
+def run(threads, writes, write):
+    def work(n):
+        for i in range(writes):
+            write({'name': 'name-%d-%d' % (n, i), 'age': i})
+
+    workers = [threading.Thread(target=work, args=(n,)) for n in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return threads * writes / (time.perf_counter() - start)
+
+
+def bench(args):
+    pool, dialect = connect(args)
+    pool.execute('DROP TABLE IF EXISTS %s' % TABLE)
+    pool.execute(SCHEMAS[dialect])
+
+    print('%-24s %12s' % ('path', 'writes/s'))
+    rate = run(args.threads, args.writes, lambda obj: pool.insert(TABLE, obj))
+    print('%-24s %12.0f' % ('commit per insert', rate))
+
+    batcher = pool.write_batcher(max_delay=args.delay / 1000.0, max_ops=args.max_ops)
+    rate = run(args.threads, args.writes, lambda obj: batcher.insert(TABLE, obj).result())
+    print('%-24s %12.0f   (%d writes in %d batches)' % ('write batcher', rate, batcher.writes, batcher.batches))
+    batcher.close()
+    pool.execute('DROP TABLE IF EXISTS %s' % TABLE)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-t', '--threads', type=int, default=16)
+    parser.add_argument('-w', '--writes', type=int, default=500, help='writes per thread')
+    parser.add_argument('-d', '--delay', type=float, default=2.0, help='max batch delay in ms')
+    parser.add_argument('-m', '--max-ops', type=int, default=100)
+    parser.add_argument('--host')
+    parser.add_argument('--port', type=int, default=3306)
+    parser.add_argument('--user', default='root')
+    parser.add_argument('--password', default='')
+    parser.add_argument('--db', default='test')
+    bench(parser.parse_args())
@@ -0,0 +1,163 @@
+# coding: utf-8
+"""
+In-process DB API 2.0 module for the benchmarks, to pass as the `module` of DB.
+It is test/fakedb.py without the database: the exceptions, the paramstyle, the
+field types, the cursors' fetch and mogrify are those of fakedb, but no
+statement reaches sqlite nor is recorded in `fakedb.statements`, as both would
+be measured along with pysql. Every round trip (statement, COMMIT, ROLLBACK)
+waits `latency` seconds and SELECTs return canned result sets, so what is
+measured is pysql's own overhead plus the latency it is given.
+
+    fakedriver.respond(r'^SELECT .* FROM t1', ['id', 'name'], [(1, 'a'), (2, 'b')])
+    pool = DB(fakedriver, {'latency': 0.0002})
+
+Statements without a canned result return no rows, INSERTs get consecutive
+ids and a rowcount of their number of rows, other statements a rowcount of 1.
+"""
+
+import importlib.util
+import itertools
+import os
+import re
+import time
+
+
+def _load_fakedb():
+    # The fakedb of this tree, whatever the revision of pysql first on sys.path.
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'test', 'fakedb.py')
+    spec = importlib.util.spec_from_file_location('pysql_bench_fakedb', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+fakedb = _load_fakedb()
+
+apilevel = fakedb.apilevel
+threadsafety = fakedb.threadsafety
+paramstyle = fakedb.paramstyle
+Error = fakedb.Error
+InterfaceError = fakedb.InterfaceError
+DatabaseError = fakedb.DatabaseError
+OperationalError = fakedb.OperationalError
+IntegrityError = fakedb.IntegrityError
+ProgrammingError = fakedb.ProgrammingError
+NotSupportedError = fakedb.NotSupportedError
+CLIENT = fakedb.CLIENT
+FIELD_TYPE = fakedb.FIELD_TYPE
+
+# Number of statements executed, all connections together.
+executed = 0
+
+# Canned results, newest first: (compiled pattern, description, rows or callable).
+_responses = []
+
+
+def respond(pattern, names, rows):
+    """
+    Answer statements matching the regex `pattern` with `rows` of columns
+    `names`. `rows` may be a callable taking (connection, sql, params), like
+    with `fakedb.respond`. The description is typed by the first row.
+    """
+    sample = rows[0] if rows and not callable(rows) else ()
+    description = tuple((name, fakedb._field_type(sample[i]) if i < len(sample) else FIELD_TYPE.VAR_STRING,
+                         None, None, None, None, True)
+                        for i, name in enumerate(names))
+    _responses.insert(0, (re.compile(pattern, re.I), description, rows))
+
+
+def reset():
+    """Drop the canned results, keep the answers to the queries pysql sends on its own"""
+    global executed
+    executed = 0
+    del _responses[:]
+    variables = fakedb.DEFAULT_VARIABLES
+    respond(r'^\s*SELECT @@auto_increment_increment', ['increment', 'packet'],
+            [(variables['auto_increment_increment'], variables['max_allowed_packet'])])
+    respond(r'^\s*SELECT last_insert_id\(\)', ['id'], lambda conn, sql, params: [(conn.lastrowid,)])
+    respond(r'^\s*SELECT CONNECTION_ID\(\)', ['id'], lambda conn, sql, params: [(conn.connection_id,)])
+
+
+def connect(latency=0.0, client_flag=0, **config):
+    return Connection(latency, client_flag)
+
+
+_connection_ids = itertools.count(1)
+
+
+class Connection(object):
+
+    def __init__(self, latency=0.0, client_flag=0):
+        self.latency = latency
+        self.client_flag = client_flag
+        self.connection_id = next(_connection_ids)
+        self.lastrowid = 0
+        self.open = True
+
+    def _round_trip(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _check(self, method=None):
+        if not self.open:
+            raise InterfaceError(0, 'Connection is closed')
+
+    def cursor(self, cursorclass=None):
+        self._check('cursor')
+        return (cursorclass or Cursor)(self)
+
+    def commit(self):
+        self._round_trip()
+
+    def rollback(self):
+        self._round_trip()
+
+    def ping(self, reconnect=False):
+        self._round_trip()
+
+    def thread_id(self):
+        return self.connection_id
+
+    def close(self):
+        self.open = False
+
+
+class Cursor(fakedb.Cursor):
+    """fakedb's buffered cursor, executing against the canned results only"""
+
+    def execute(self, query, args=None):
+        global executed
+        executed += 1
+        conn = self.connection
+        conn._check('execute')
+        conn._round_trip()
+        self._pos = 0
+        self.lastrowid = 0
+        for pattern, description, rows in _responses:
+            if pattern.search(query):
+                rows = rows(conn, query, args) if callable(rows) else rows
+                self.description = description
+                self.rowcount = len(rows)
+                self._rows = rows
+                return self.rowcount
+        self.rowcount = 1
+        if query.lstrip()[:6].upper() in ('INSERT', 'REPLACE'):
+            # Rows of a multi-row INSERT ... VALUES (...),(...), the id is the one of the first.
+            self.rowcount = query.count('),(') + 1
+            self.lastrowid = conn.lastrowid + 1
+            conn.lastrowid += self.rowcount
+        self.description = None
+        self._rows = None
+        return self.rowcount
+
+
+class SSCursor(Cursor):
+    buffered = False
+
+
+class cursors(object):
+    Cursor = Cursor
+    SSCursor = SSCursor
+
+
+reset()
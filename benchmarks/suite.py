@@ -0,0 +1,236 @@
+# coding: utf-8
+"""
+pysql's own overhead on its hot paths, against the in-process driver of
+benchmarks/fakedriver.py: ops/s, memory allocated per op and peak memory of
+each case. `--compare` runs the same cases on two git revisions, or on one
+revision and the working tree, and flags the regressions.
+
+    python benchmarks/suite.py [-c insert,query] [-l 0.0001] [--json out.json]
+    python benchmarks/suite.py --compare master [HEAD] [--threshold 0.05]
+
+alloc/op is the peak of the memory allocated during one op (tracemalloc),
+peak the highest traced memory over the memory run, retained memory included.
+"""
+
+import argparse
+import collections
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import timeit
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+
+# The driver of this tree, whatever the revision of pysql being measured.
+sys.path.insert(0, HERE)
+
+import fakedriver
+
+
+TABLE = 't1'
+COLUMNS = ['id', 'name', 'age', 'score']
+
+
+def case_insert(pool, args):
+    obj = {'name': 'abc', 'age': 10, 'score': 1.5}
+    return lambda: pool.insert(TABLE, obj)
+
+
+def case_insertmany(pool, args):
+    objs = [{'name': 'name-%d' % i, 'age': i % 100, 'score': i / 7.0} for i in range(args.rows)]
+    return lambda: pool.insertmany(TABLE, objs)
+
+
+def case_update_in(pool, args):
+    ids = list(range(args.in_size))
+    return lambda: pool.update(TABLE, where={'id__in': ids}, obj={'age': 11})
+
+
+def case_query(pool, args):
+    rows = [(i, 'name-%d' % i, i % 100, i / 7.0) for i in range(args.rows)]
+    fakedriver.respond(r'^\s*SELECT .* FROM %s\b' % TABLE, COLUMNS, rows)
+    return lambda: list(pool.query(TABLE, where={'age__gte': 0}, page=1, page_num=args.rows))
+
+
+def case_transaction(pool, args):
+    obj = {'name': 'abc', 'age': 10}
+
+    def run():
+        with pool.transaction():
+            pool.insert(TABLE, obj)
+            pool.update(TABLE, where={'id': 1}, obj={'age': 11})
+    return run
+
+
+CASES = collections.OrderedDict([
+    ('insert', case_insert),
+    ('insertmany', case_insertmany),
+    ('update_in', case_update_in),
+    ('query', case_query),
+    ('transaction', case_transaction),
+])
+
+
+def measure_time(run, repeat, min_time):
+    """Best ops/s of `repeat` runs of at least `min_time` seconds"""
+    timer = timeit.Timer(run)
+    number, elapsed = timer.autorange()
+    number = max(1, int(number * min_time / max(elapsed, 1e-9)))
+    return number / min(timer.repeat(repeat, number))
+
+
+def measure_memory(run, number):
+    """(median bytes allocated during one op, peak bytes over `number` ops) by tracemalloc"""
+    tracemalloc.start()
+    try:
+        start = tracemalloc.get_traced_memory()[0]
+        allocs, peak = [], 0
+        for i in range(number):
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            run()
+            op_peak = tracemalloc.get_traced_memory()[1]
+            allocs.append(op_peak - before)
+            peak = max(peak, op_peak - start)
+    finally:
+        tracemalloc.stop()
+    allocs.sort()
+    return allocs[len(allocs) // 2], peak
+
+
+def run_cases(args):
+    """Measure the cases with the pysql found first on sys.path, return {case: result}"""
+    from pool import DB
+
+    results = collections.OrderedDict()
+    for name in args.cases:
+        fakedriver.reset()
+        try:
+            pool = DB(fakedriver, {'latency': args.latency})
+            run = CASES[name](pool, args)
+            run()  # warm up: connection, statement cache, server settings
+            ops = measure_time(run, args.repeat, args.min_time)
+            alloc, peak = measure_memory(run, args.memory_ops)
+        except Exception as e:
+            # Older revisions may lack the API of a case.
+            results[name] = {'error': '%s: %s' % (type(e).__name__, e)}
+            continue
+        results[name] = {'ops': ops, 'alloc': alloc, 'peak': peak}
+    return results
+
+
+def kib(size):
+    return '%.1f KiB' % (size / 1024.0)
+
+
+def report(results):
+    print('%-12s %12s %10s %12s %12s' % ('case', 'ops/s', 'us/op', 'alloc/op', 'peak'))
+    for name, result in results.items():
+        if 'error' in result:
+            print('%-12s %s' % (name, result['error']))
+            continue
+        print('%-12s %12.0f %10.1f %12s %12s' % (name, result['ops'], 1e6 / result['ops'],
+                                                 kib(result['alloc']), kib(result['peak'])))
+
+
+def export(rev, dest):
+    """Extract the tree of git revision `rev` to `dest`"""
+    archive = subprocess.run(['git', 'archive', '--format=tar', rev], cwd=ROOT, check=True,
+                             stdout=subprocess.PIPE).stdout
+    with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+        kwargs = {'filter': 'data'} if hasattr(tarfile, 'data_filter') else {}
+        tar.extractall(dest, **kwargs)
+
+
+def run_revision(rev, tmp, args):
+    """Run the cases on `rev` (None: the working tree) in a child process, return its results"""
+    root = ROOT
+    if rev is not None:
+        root = os.path.join(tmp, 'rev-%d' % len(os.listdir(tmp)))
+        export(rev, root)
+    out = os.path.join(tmp, 'results-%d.json' % len(os.listdir(tmp)))
+    cmd = [sys.executable, os.path.abspath(__file__), '--root', root, '--json', out,
+           '-c', ','.join(args.cases), '-l', repr(args.latency), '-r', str(args.repeat),
+           '--min-time', repr(args.min_time), '--memory-ops', str(args.memory_ops),
+           '--rows', str(args.rows), '--in-size', str(args.in_size)]
+    # Some revisions print every statement.
+    subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL)
+    with open(out) as f:
+        return json.load(f)['cases']
+
+
+def compare(args):
+    """Measure two revisions, print the changes, return the number of regressions"""
+    revs = list(args.compare)
+    if len(revs) == 1:
+        revs.append(None)
+    labels = [rev or 'working tree' for rev in revs]
+    tmp = tempfile.mkdtemp(prefix='pysql-bench-')
+    try:
+        old, new = [run_revision(rev, tmp, args) for rev in revs]
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    print('%s -> %s' % tuple(labels))
+    print('%-12s %12s %12s %9s %12s %12s %9s' % ('case', 'ops/s', 'ops/s', 'change', 'alloc/op', 'alloc/op',
+                                                 'change'))
+    regressions = 0
+    for name in args.cases:
+        a, b = old[name], new[name]
+        if 'error' in a or 'error' in b:
+            print('%-12s %s' % (name, a.get('error') or b.get('error')))
+            continue
+        speed = b['ops'] / a['ops'] - 1
+        alloc = b['alloc'] / float(a['alloc']) - 1 if a['alloc'] else 0.0
+        regressed = speed < -args.threshold or alloc > args.threshold
+        regressions += regressed
+        print('%-12s %12.0f %12.0f %+8.1f%% %12s %12s %+8.1f%%%s' % (
+            name, a['ops'], b['ops'], speed * 100, kib(a['alloc']), kib(b['alloc']), alloc * 100,
+            '  REGRESSION' if regressed else ''))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-c', '--cases', default=','.join(CASES),
+                        type=lambda s: [x for x in s.split(',') if x])
+    parser.add_argument('-l', '--latency', type=float, default=0.0, help='Seconds per round trip of the driver')
+    parser.add_argument('-r', '--repeat', type=int, default=5)
+    parser.add_argument('--min-time', type=float, default=0.2, help='Seconds of each timed run')
+    parser.add_argument('--memory-ops', type=int, default=50, help='Ops traced by tracemalloc')
+    parser.add_argument('--rows', type=int, default=1000, help='Rows of insertmany and query')
+    parser.add_argument('--in-size', type=int, default=5000, help='Values of the IN list of update_in')
+    parser.add_argument('--json', help='Write the results to this file')
+    parser.add_argument('--root', default=ROOT, help='Tree of the pysql measured')
+    parser.add_argument('--compare', nargs='+', metavar='REV',
+                        help='Compare two git revisions, or a revision and the working tree')
+    parser.add_argument('--threshold', type=float, default=0.05,
+                        help='Slowdown or allocation growth reported as a regression')
+    args = parser.parse_args()
+    for name in args.cases:
+        assert name in CASES, 'Unknown case %s, one of %s' % (name, ', '.join(CASES))
+    assert not args.compare or len(args.compare) <= 2, 'At most two revisions'
+
+    if args.compare:
+        return 1 if compare(args) else 0
+
+    sys.path.insert(0, args.root)
+    results = run_cases(args)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'python': platform.python_version(), 'root': args.root, 'cases': results}, f, indent=2)
+    else:
+        report(results)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
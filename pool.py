@@ -1,7 +1,29 @@
 # coding: utf-8
 
+import array
+import bisect
+import collections
+import contextlib
+import contextvars
 import datetime
+import errno
+import functools
+import heapq
+import inspect
+import itertools
+import json
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
 import threading
+import time
+import traceback
+import warnings
+import weakref
+from concurrent.futures import Future, ThreadPoolExecutor
 
 
 class ThreadDict(threading.local):
@@ -21,14 +43,11 @@ class ThreadDict(threading.local):
         1
     """
 
-    _instances = set()
+    _instances = weakref.WeakSet()
 
     def __init__(self):
         ThreadDict._instances.add(self)
 
-    def __del__(self):
-        ThreadDict._instances.remove(self)
-
     def __hash__(self):
         return id(self)
 
@@ -96,6 +115,60 @@ class ThreadDict(threading.local):
     __str__ = __repr__
 
 
+def _current_task():
+    """The asyncio task running in the current thread, or None"""
+    asyncio = sys.modules.get('asyncio')
+    loop = asyncio._get_running_loop() if asyncio is not None else None
+    return None if loop is None else asyncio.current_task(loop)
+
+
+class _Context(object):
+    """
+    State of a DB in one context (contextvars): the connection loaded, the
+    transactions, the deadline of the call... It is held by a ContextVar, so
+    every thread, asyncio task and greenlet sees its own, and kept idle
+    between calls to be reused by the next one. A state belongs to the thread
+    and asyncio task which created it: a context copied into another thread or
+    task (asyncio tasks, asyncio.to_thread) gets a state of its own.
+    """
+
+    def __init__(self):
+        self.__dict__.update(db=None, calls=0, thread=threading.get_ident(), task=_current_task())
+
+    def owned(self):
+        """True if the state belongs to the current thread and asyncio task"""
+        return self.thread == threading.get_ident() and self.task is _current_task()
+
+    def get(self, key, default=None):
+        return self.__dict__.get(key, default)
+
+    def pop(self, key, *args):
+        return self.__dict__.pop(key, *args)
+
+    def __contains__(self, key):
+        return key in self.__dict__
+
+    def clear(self):
+        thread, task = self.thread, self.task
+        self.__dict__.clear()
+        self.__dict__.update(db=None, calls=0, thread=thread, task=task)
+
+    def __repr__(self):
+        return '<Context %s>' % self.__dict__
+
+    __str__ = __repr__
+
+
+class _IdleContext(_Context):
+    """The state seen outside of any call: empty and read only"""
+
+    def __setattr__(self, key, value):
+        raise AttributeError('No call in progress to set %s on' % key)
+
+
+_IDLE = _IdleContext()
+
+
 class Item(dict):
     """
     A Item object is like a dictionary which can not only be used as `obj.foo`,
@@ -188,8 +261,10 @@ class SQLQuery(object):
             items = [other]
         elif isinstance(other, SQLQuery):
             items = other.items
+        elif isinstance(other, SQLBuilder):
+            items = other.sqlquery().items
         else:
-            raise NotImplemented
+            return NotImplemented
         return SQLQuery(self.items + items)
 
     def __radd__(self, other):
@@ -204,6 +279,8 @@ class SQLQuery(object):
             self.items.append(other)
         elif isinstance(other, SQLQuery):
             self.items.extend(other.items)
+        elif isinstance(other, SQLBuilder):
+            self.items.extend(other.sqlquery().items)
         else:
             raise Exception("NotImplement")
         return self
@@ -267,12 +344,137 @@ class SQLQuery(object):
         for i, item in enumerate(items):
             if i != 0:
                 target.items.append(sep)
-            target.items.append(item)
+            if isinstance(item, SQLQuery):
+                target.items.extend(item.items)
+            elif isinstance(item, SQLBuilder):
+                target.items.extend(item.sqlquery().items)
+            else:
+                target.items.append(item)
         if suffix:
             target.items.append(suffix)
         return target
 
 
+class SQLBuilder(object):
+    """
+    Append-only SQL builder. Literal fragments and parameters are kept in two
+    separate buffers, a parameter is marked by None in `parts`, and the query
+    string is rendered once and memoized until the next append.
+
+        >>> b = SQLBuilder('SELECT * FROM test WHERE name = ').param('joe')
+        >>> b.query()
+        'SELECT * FROM test WHERE name = %s'
+        >>> b.values()
+        ['joe']
+
+    `+` returns a new builder like SQLQuery does, builders should be grown
+    in place with `append`, `param`, `join` or `+=`.
+    """
+
+    __slots__ = ['parts', 'params', '_sql']
+
+    def __init__(self, sql=None):
+        self.parts = []
+        self.params = []
+        self._sql = None
+        if sql is not None:
+            self.append(sql)
+
+    def append(self, value):
+        """Append a literal, a SQLParam, a SQLQuery or another SQLBuilder"""
+        if isinstance(value, str):
+            self.parts.append(value)
+        elif isinstance(value, SQLBuilder):
+            self.parts.extend(value.parts)
+            self.params.extend(value.params)
+        elif isinstance(value, SQLParam):
+            self.parts.append(None)
+            self.params.append(value.value)
+        elif isinstance(value, SQLQuery):
+            for item in value.items:
+                self.append(item)
+        else:
+            self.parts.append(str(value))
+        self._sql = None
+        return self
+
+    def param(self, value):
+        """Append a parameter"""
+        self.parts.append(None)
+        self.params.append(value)
+        self._sql = None
+        return self
+
+    def join(self, items, sep=' ', prefix=None, suffix=None):
+        """
+        Append `items` separated by `sep`.
+            >>> SQLBuilder('IN ').join([SQLParam(1), SQLParam(2)], ',', prefix='(', suffix=')').query()
+            'IN (%s,%s)'
+        """
+        if prefix:
+            self.append(prefix)
+        for i, item in enumerate(items):
+            if i != 0:
+                self.parts.append(sep)
+            self.append(item)
+        if suffix:
+            self.append(suffix)
+        return self
+
+    def query(self):
+        """
+        Returns the query part of the sql query. Literal `%` are escaped only
+        when there are parameters, as DB API drivers format the query only then.
+        """
+        if self._sql is None:
+            if self.params:
+                self._sql = ''.join('%s' if x is None else x.replace('%', '%%') for x in self.parts)
+            else:
+                self._sql = ''.join(self.parts)
+        return self._sql
+
+    def values(self):
+        return self.params
+
+    def sqlquery(self):
+        """Convert to SQLQuery for callers working on `items`"""
+        params = iter(self.params)
+        return SQLQuery([SQLParam(next(params)) if x is None else x for x in self.parts])
+
+    def copy(self):
+        out = SQLBuilder()
+        out.parts = self.parts[:]
+        out.params = self.params[:]
+        out._sql = self._sql
+        return out
+
+    def __bool__(self):
+        return bool(self.parts)
+
+    __nonzero__ = __bool__
+
+    def __len__(self):
+        return len(self.query())
+
+    def __add__(self, other):
+        return self.copy().append(other)
+
+    def __radd__(self, other):
+        return SQLBuilder(other).append(self)
+
+    def __iadd__(self, other):
+        return self.append(other)
+
+    def __str__(self):
+        try:
+            return self.query() % tuple([sqlify(obj) for obj in self.params])
+        except (ValueError, TypeError):
+            return self.query()
+
+    def __repr__(self):
+        return '<sql: %s>' % repr(str(self))
+
+
 class Field(object):
     """
     Field is to combine keys and constants together like `num=Field('num+1')` etc.
@@ -280,6 +482,15 @@ class Field(object):
     def __init__(self, s):
         self.s = s
 
+    def __eq__(self, other):
+        return isinstance(other, Field) and self.s == other.s
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.s)
+
     def __str__(self):
         return str(self.s)
 
@@ -292,14 +503,16 @@ def sqlconvert(data, grouping=', '):
         :return: SQLQuery
     """
 
-    items = []
-    for k, v in data:
+    out = SQLBuilder()
+    for i, (k, v) in enumerate(data):
+        if i != 0:
+            out.append(grouping)
         if isinstance(v, Field):
             # update table set value=Field(value+1)
-            items.append(k + ' = ' + str(v))
+            out.append(k + ' = ' + str(v))
         else:
-            items.append(k + ' = ' + SQLParam(v))
-    return SQLQuery.join(items, grouping)
+            out.append(k + ' = ').param(v)
+    return out
 
 
 def sqlify(obj):
@@ -345,340 +558,3446 @@ def sqllist(values):
     """
     Make a list of data in a sql way
     >>> sqllist([1, 2, 3])
-    <sql: '(1, 2, 3)'>
+    <sql: '(1,2,3)'>
     """
-    return SQLQuery.join(values, sep=',', prefix='(', suffix=')')
+    return SQLBuilder().join(values, sep=',', prefix='(', suffix=')')
 
 
 def sqlquote(x):
     """
     Ensure `a` is quoted properly for use in a SQL query.
+    Lists are expanded into one parameter per item.
         >>> 'WHERE x in ' + sqlquote([1, 2, 3])
-        <sql: WHERE x in (1,2,3)>
+        <sql: 'WHERE x in (1,2,3)'>
     """
 
     if isinstance(x, (list, tuple)):
-        return sqllist(x)
-    return SQLParam(x).sqlquery()
+        out = SQLBuilder('(')
+        for i, v in enumerate(x):
+            if i != 0:
+                out.parts.append(',')
+            out.param(v)
+        return out.append(')')
+    return SQLBuilder().param(x)
 
 
-class DB(object):
-    """Basic MySQL CRUD API"""
+# Insert modes of `insert` and `insertmany` and their SQL verb.
+INSERT_MODES = {
+    'INSERT': 'INSERT',
+    'REPLACE': 'REPLACE',
+    'INSERT_IGNORE': 'INSERT IGNORE',
+}
 
-    def __init__(self, module, config):
-        """
-        :param
-            module: Module is the package like pymysql, MySQLdb etc.
-                    Create and connect to database server in local function.
-                    Wrap the DB Api to handle all kinds of Databases.
-            config: Config is the configuration of Database(host,passwd,port etc).
-        """
-        self.module = module
-        self.config = config
-        self._ctx = ThreadDict()
 
-    def _getctx(self):
-        if not self._ctx.get('db'):
-            self._load_context(self._ctx)
-        return self._ctx
+def encoded_size(value):
+    """Estimate of the bytes `value` takes in a query, escaping aside"""
+    if value is None:
+        return 4
+    if isinstance(value, str):
+        return (len(value) if value.isascii() else len(value.encode('utf-8'))) + 2
+    if isinstance(value, (bytes, bytearray)):
+        # Every byte may need a backslash.
+        return 2 * len(value) + 10
+    if isinstance(value, (int, float)):
+        return 20
+    if isinstance(value, (datetime.date, datetime.time)):
+        return 28
+    return len(str(value)) + 2
+
+
+# LOAD DATA modes of `bulk_load`, named like the insert modes.
+LOAD_DATA_MODES = {
+    'INSERT': '',
+    'REPLACE': ' REPLACE',
+    'INSERT_IGNORE': ' IGNORE',
+}
 
-    ctx = property(_getctx)
+_LOAD_DATA_ESCAPES = {ord('\\'): '\\\\', ord('\t'): '\\t', ord('\n'): '\\n', ord('\r'): '\\r', 0: '\\0'}
+_LOAD_DATA_BYTE_ESCAPES = {b'\\': b'\\\\', b'\t': b'\\t', b'\n': b'\\n', b'\r': b'\\r', b'\0': b'\\0'}
+_LOAD_DATA_BYTES = re.compile(b'[\\\\\t\n\r\0]')
 
-    def _load_context(self, ctx):
-        """Create a db connection"""
-        ctx.dbq_count = 0
-        ctx.transactions = []
-        ctx.db = self._connect(self.config)
 
-        def commit(unload=True):
-            ctx.db.commit()
-            if unload:
-                self._unload_context(self._ctx)
+def load_data_field(value, encoding='utf-8'):
+    """
+    Encode `value` as a field of the default LOAD DATA format (tab separated,
+    backslash escaped, NULL as \\N), rendered like `sqlify` renders it.
+        >>> load_data_field(None)
+        b'\\\\N'
+    """
+    if value is None:
+        return b'\\N'
+    if isinstance(value, bool):
+        return b'1' if value else b'0'
+    if isinstance(value, (bytes, bytearray)):
+        return _LOAD_DATA_BYTES.sub(lambda m: _LOAD_DATA_BYTE_ESCAPES[m.group()], bytes(value))
+    if isinstance(value, datetime.datetime):
+        value = value.isoformat()
+    elif not isinstance(value, str):
+        value = str(value)
+    return value.translate(_LOAD_DATA_ESCAPES).encode(encoding)
+
+
+def load_data_lines(rows, columns, charset='utf8'):
+    """Yield `rows`, dicts or sequences ordered like `columns`, as lines of the default LOAD DATA format"""
+    encoding = 'utf-8' if charset.lower().startswith('utf8') else charset
+    for row in rows:
+        if isinstance(row, dict):
+            row = [row[column] for column in columns]
+        yield b'\t'.join([load_data_field(value, encoding) for value in row]) + b'\n'
+
+
+class InsertIds(object):
+    """
+    Insert ids of `insertmany`, one range per chunk. It is a sequence of every
+    row's id, the ids of a chunk whose rows were not all inserted (IGNORE,
+    REPLACE or ON DUPLICATE KEY UPDATE) are unknown and read as None.
+    """
 
-        def rollback():
-            ctx.db.rollback()
-            self._unload_context(self._ctx)
+    def __init__(self):
+        self.chunks = []  # (row count, range or None)
 
-        ctx.commit = commit
-        ctx.rollback = rollback
+    def add(self, count, ids):
+        self.chunks.append((count, ids))
 
-    def _unload_context(self, ctx):
-        """Delete db connection, the connection will recycle in PoolDB"""
-        del ctx.db
+    @property
+    def ranges(self):
+        return [ids for count, ids in self.chunks]
 
-    def _connect(self, config):
-        """Connect to db server, and return a connection."""
-        def get_pooled_db():
-            from DBUtils import PooledDB
-            # Please configure mincached, maxchached, maxshared in config.
-            return PooledDB.PooledDB(creator=self.module, **config)
+    def __len__(self):
+        return sum(count for count, ids in self.chunks)
 
-        if getattr(self, '_pooleddb', None) is None:
-            self._pooleddb = get_pooled_db()
-        return self._pooleddb.connection()
+    def __iter__(self):
+        for count, ids in self.chunks:
+            if ids is None:
+                for _ in range(count):
+                    yield None
+            else:
+                for insert_id in ids:
+                    yield insert_id
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        for count, ids in self.chunks:
+            if 0 <= index < count:
+                return None if ids is None else ids[index]
+            index -= count
+        raise IndexError('Insert id index out of range')
 
-    def _db_cursor(self):
-        """Get cursor from ctx.db"""
-        return self.ctx.db.cursor()
+    def __repr__(self):
+        return '<InsertIds %r>' % self.ranges
 
-    def _db_execute(self, cursor, sqlquery):
-        """Execute a real sql query"""
-        self.ctx.dbq_count += 1
-        try:
-            query, params = self._process_query(sqlquery)
-            out = cursor.execute(query, params)
-        except Exception as e:
-            if self.ctx.transactions:
-                self.ctx.transactions[-1].rollback()
-            else:
-                self.ctx.rollback()
-            raise e
-        return out
 
-    def _process_query(self, sqlquery, debug=True):
-        """Separate sql and params from sqlquery"""
-        if debug:
-            print(sqlquery)
-        query = sqlquery.query()
-        params = sqlquery.values() or None  # None because of api `execute(sql, params=None)`
-        return query, params
+class CompiledQuery(object):
+    """
+    A rendered query string bound to its parameters, served by StatementCache.
+    It quacks like SQLQuery for `_db_execute`.
+    """
 
-    def insert(self, table, obj={}, mode='INSERT', dup={}):
-        """
-        Insert data into table with INSERT, REPLACE and INSERT_IGNORE mode.
-        :param
-            table: table name
-            obj: data inserted to table
-            mode: INSERT, REPLACE, INSERT_IGNORE mode
-            dup: duplicate if data exists.
-        """
-        mode = mode.upper()
-        assert mode in ('INSERT', 'REPLACE', 'INSERT_IGNORE'), 'Wrong insert mode: %s' % mode
+    __slots__ = ['sql', 'params']
 
-        kvs = sorted(obj.items(), key=lambda v: v[0])
-        keys = SQLQuery.join(map(lambda kv: kv[0], kvs), sep=', ', prefix='(', suffix=')')
-        values = SQLQuery.join(map(lambda kv: SQLParam(kv[1]), kvs), sep=', ', prefix='(', suffix=')')
+    def __init__(self, sql, params):
+        self.sql = sql
+        self.params = params
 
-        sqlquery = "%s INTO %s " % (mode, table) + keys + " VALUES " + values
-        if dup:
-            sqlquery += " ON DUPLICATE KEY UPDATE %s" % sqlconvert(dup.items())
+    def query(self):
+        return self.sql
 
-        cursor = self._db_cursor()
-        self._db_execute(cursor, sqlquery)
-        self._db_execute(cursor, SQLQuery('SELECT last_insert_id()'))
+    def values(self):
+        return self.params
 
+    def __str__(self):
         try:
-            out = cursor.fetchone()[0]
-        except Exception as e:
-            # TODO: error log
-            out = None
+            return self.sql % tuple([sqlify(obj) for obj in self.params])
+        except (ValueError, TypeError):
+            return self.sql
 
-        if not self.ctx.transactions:
-            self.ctx.commit()
-        return out
+    def __repr__(self):
+        return '<sql: %s>' % repr(str(self))
 
-    def insertmany(self, table, objs=[], mode='INSERT', dup={}):
-        mode = mode.upper()
-        assert mode in ('INSERT', 'REPLACE', 'INSERT_IGNORE'), 'Wrong insert mode: %s' % mode
 
-        if not objs:
-            return None
+class StatementCache(object):
+    """
+    Bounded LRU of rendered query strings keyed by statement shape, e.g.
+    ('UPDATE', table, columns, where keys and IN-list arity).
+    A `maxsize` of 0 disables the cache.
+    """
 
-        keys = objs[0].keys()
-        for obj in objs:
-            if obj.keys() != keys:
-                raise ValueError("Not all rows have the same keys")
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
 
-        keys = sorted(keys)
-        sqlquery = SQLQuery("%s INTO %s (%s) VALUES " % (mode, table, ",".join(keys)))
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        """Return the cached query string of `key` or None, raise TypeError if `key` is unhashable"""
+        with self._lock:
+            sql = self._data.get(key)
+            if sql is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._data.move_to_end(key)
+            return sql
 
-        for i, obj in enumerate(objs):
-            if i != 0:
-                sqlquery.append(",")
-            SQLQuery.join([SQLParam(obj[key]) for key in keys], sep=',', target=sqlquery, prefix='(', suffix=')')
+    def put(self, key, sql):
+        with self._lock:
+            self._data[key] = sql
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
 
-        if dup:
-            sqlquery.append("ON DUPLICATE KEY UPDATE %s" % sqlconvert(dup.items()))
+    def clear(self):
+        with self._lock:
+            self._data.clear()
 
-        cursor = self._db_cursor()
-        self._db_execute(cursor, sqlquery)
-        self._db_execute(cursor, SQLQuery("SELECT last_insert_id()"))
+    def stats(self):
+        return Item(hits=self.hits, misses=self.misses, evictions=self.evictions,
+                    size=len(self._data), maxsize=self.maxsize)
 
-        try:
-            out = cursor.fetchone()[0]
-            out = range(out, out + len(objs))
-        except Exception as e:
-            # TODO: error log
-            out = None
 
-        if not self.ctx.transactions:
-            self.ctx.commit()
-        return out
+def _rows_size(rows):
+    """Approximate memory used by a list of row tuples, in bytes"""
+    size = sys.getsizeof(rows)
+    for row in rows:
+        size += sys.getsizeof(row) + sum(sys.getsizeof(value) for value in row)
+    return size
 
-    def _where(self, where):
-        assert isinstance(where, dict), 'Wrong format %s' % where
 
-        where_clauses = []
-        for key, value in sorted(where.items(), key=lambda x: x[0]):
-            parts = key.split('__')
-            key, operator = (parts[0], parts[1]) if len(parts) == 2 else (parts[0], 'EQ')
-            where_clauses.append(key + sqloperator(operator) + sqlquote(value))
+def table_names(table):
+    """
+    Names of the tables of a `table` argument, without aliases
+        >>> table_names(['t1 a', 't2'])
+        ['t1', 't2']
+    """
+    tables = table if isinstance(table, (list, tuple)) else str(table).split(',')
+    return [t.split()[0].strip('`') for t in tables if t.strip()]
 
-        if where_clauses:
-            return SQLQuery.join(where_clauses, ' AND ')
-        return None
 
-    def _table(self, table):
-        if isinstance(table, (list, tuple)):
-            return ','.join(table)
-        return str(table)
+class ResultCache(object):
+    """
+    LRU of query results bounded by an estimate of their memory footprint,
+    entries expire after the TTL of their tables (`ttls`, default `ttl` seconds).
+    Writes through the pool invalidate every entry reading the written table.
+    A `maxbytes` of 0 disables the cache.
+    """
 
-    def update(self, table, where={}, obj={}):
-        """
-        Update Tables
-        :param where: The condition
-        :param obj: The part needed to be updated
-        """
+    def __init__(self, maxbytes=64 << 20, ttl=60.0, ttls=None):
+        self.maxbytes = maxbytes
+        self.ttl = ttl
+        self.ttls = dict(ttls or {})
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self.nbytes = 0
+        self._data = collections.OrderedDict()  # key -> (expires at, tables, size, result)
+        self._tables = collections.defaultdict(set)  # table -> keys
+        self._generations = collections.defaultdict(int)  # table -> count of invalidations
+        self._invalidated = {}  # table -> time of the last invalidation
+        self._lock = threading.Lock()
 
-        where = self._where(where)
-        values = sorted(obj.items(), key=lambda t: t[0])
-        query = 'UPDATE ' + self._table(table) + ' SET ' + sqlconvert(values)
-        if where:
-            query += ' WHERE ' + where
-        cursor = self._db_cursor()
-        self._db_execute(cursor, query)
-        if not self.ctx.transactions:
-            self.ctx.commit()
-        return cursor.rowcount
+    def __len__(self):
+        return len(self._data)
+
+    def generation(self, tables):
+        """Token to pass to `put`, so results read before an invalidation are not cached"""
+        with self._lock:
+            return tuple(self._generations[table] for table in tables)
+
+    def invalidated_at(self, tables):
+        """Time of the last invalidation of any of `tables`, None if never invalidated"""
+        with self._lock:
+            times = [self._invalidated[table] for table in tables if table in self._invalidated]
+        return max(times) if times else None
+
+    def get(self, key):
+        """Return the cached (description, rows) of `key` or None, raise TypeError if `key` is unhashable"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] <= time.time():
+                self._remove(key)
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._data.move_to_end(key)
+            return entry[3]
+
+    def put(self, key, tables, result, generation):
+        """Cache `result` = (description, rows) of a query reading `tables`"""
+        description, rows = result
+        size = _rows_size(rows)
+        if size > self.maxbytes:
+            return
+        ttl = min([self.ttls.get(table, self.ttl) for table in tables] or [self.ttl])
+        with self._lock:
+            if generation != tuple(self._generations[table] for table in tables):
+                return
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (time.time() + ttl, tables, size, result)
+            self.nbytes += size
+            for table in tables:
+                self._tables[table].add(key)
+            while self.nbytes > self.maxbytes:
+                self._remove(next(iter(self._data)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        expires, tables, size, result = self._data.pop(key)
+        self.nbytes -= size
+        for table in tables:
+            keys = self._tables[table]
+            keys.discard(key)
+            if not keys:
+                del self._tables[table]
+
+    def invalidate(self, tables):
+        """Drop the cached results reading any of `tables`"""
+        with self._lock:
+            now = time.time()
+            for table in tables:
+                self._generations[table] += 1
+                self._invalidated[table] = now
+                for key in list(self._tables.get(table, ())):
+                    self._remove(key)
+                    self.invalidations += 1
 
-    def delete(self, table, where={}, using=None):
-        """
-        Delete from table
-        :param table: list[t1, t2, t3, ...] or t
-        :param where: The condition
-        :param using: The condition
-        :return:
-        """
-        where = self._where(where)
-        cursor = self._db_cursor()
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._tables.clear()
+            self.nbytes = 0
 
-        query = 'DELETE FROM ' + self._table(table)
-        if using: query += ' USING ' + sqllist(using)
-        if where: query += ' WHERE ' + where
+    def stats(self):
+        lookups = self.hits + self.misses
+        return Item(hits=self.hits, misses=self.misses, hit_ratio=self.hits / lookups if lookups else 0.0,
+                    evictions=self.evictions, expirations=self.expirations, invalidations=self.invalidations,
+                    size=len(self._data), nbytes=self.nbytes, maxbytes=self.maxbytes)
 
-        if not isinstance(query, SQLQuery):
-            query = SQLQuery(query)
-        self._db_execute(cursor, query)
-        if not self.ctx.transactions:
-            self.ctx.commit()
-        return cursor.rowcount
 
-    def query(self, table, where={}, group_by=None, having=None, order_by=None, fields=['*'], page=0, page_num=10):
-        """
-        :param table: List[t1, t2, t3, ...] or t
-        :param where: The condition
-        :param group_by: make data into groups.
-        :param having: The condition
-        :param order_by: Sort Data
-        :param fields: Select fields from table
-        :param page: Default 0 means all data.
-        :param page_num: data each page
-        :return:
-        """
-        page, page_num = map(int, (page, page_num))
+def item_row(description):
+    """Row factory of `Item` rows, usable as `row.name` and `row['name']`"""
+    names = [x[0] for x in description]
+    return lambda row: Item(zip(names, row))
 
-        table = [table] if not isinstance(table, (list, tuple)) else table
-        limit, offset = [(None, None), (page_num, (page - 1) * page_num)][bool(page)]
-        sql_clauses = self.sql_clauses(fields, table, where, group_by, having, order_by, limit, offset)
-        clauses = [self.gen_clause(sql, val) for sql, val in sql_clauses if val is not None]
-        sqlquery = SQLQuery.join(clauses)
-        return self._query(sqlquery)
 
-    def _query(self, sqlquery):
-        cursor = self._db_cursor()
-        self._db_execute(cursor, sqlquery)
+def tuple_row(description):
+    """Row factory of the driver's raw tuples"""
+    return None
 
-        if cursor.description:
-            names = [x[0] for x in cursor.description]
-            def iterwrapper():
-                row = cursor.fetchone()
-                while row:
-                    yield Item(dict(zip(names, row)))
-                    row = cursor.fetchone()
-            out = iterwrapper()
-        else:
-            out = cursor.rowcount
 
-        if not self.ctx.transactions:
-            self.ctx.commit()
-        return out
+@functools.lru_cache(maxsize=256)
+def record_class(names):
+    """The namedtuple class of a column name tuple, created once per shape"""
+    return collections.namedtuple('Record', names, rename=True)
 
-    def sql_clauses(self, fields, tables, where, group, having, order, limit, offset):
-        return (
-            ('SELECT', fields),
-            ('FROM', tables),
-            ('WHERE', where),
-            ('GROUP BY', group),
-            ('HAVING', having),
-            ('ORDER BY', order),
+
+def record_row(description):
+    """Row factory of compact namedtuple records, `row.name` and `row[0]`"""
+    return record_class(tuple(x[0] for x in description))._make
+
+
+ROW_FACTORIES = {
+    'item': item_row,
+    'tuple': tuple_row,
+    'record': record_row,
+}
+
+
+# MySQL field type codes of cursor.description, see pymysql.constants.FIELD_TYPE.
+INT_FIELD_TYPES = frozenset([1, 2, 3, 8, 9, 13])  # TINY, SHORT, LONG, LONGLONG, INT24, YEAR
+FLOAT_FIELD_TYPES = frozenset([4, 5])  # FLOAT, DOUBLE
+
+
+def import_numpy():
+    """Return numpy, or None if it is not installed"""
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+class ColumnBuffer(object):
+    """
+    Growable column of one result field. Integer and float fields are stored in
+    a NumPy array when `numpy` is given, an array.array otherwise, and other
+    fields in a list. NULLs of typed columns are stored as 0 and flagged in
+    `mask`, which is only created once the first NULL shows up.
+    """
+
+    def __init__(self, typecode, numpy=None):
+        self.typecode = typecode  # 'q', 'd' or None for objects
+        self.numpy = numpy
+        self.size = 0
+        self.mask = None
+        self.data = self._new(typecode)
+
+    def _new(self, typecode):
+        if typecode is None:
+            return []
+        if self.numpy is not None:
+            return self.numpy.empty(0, dtype={'q': 'int64', 'd': 'float64', 'b': 'bool'}[typecode])
+        return array.array(typecode)
+
+    def _append(self, data, size, values):
+        """Append `values` at `size` of `data`, return the (maybe reallocated) buffer"""
+        if self.numpy is None or isinstance(data, list):
+            data.extend(values)
+            return data
+        end = size + len(values)
+        if end > len(data):
+            # Grow geometrically so appends stay amortized O(1).
+            data.resize(max(end, 2 * len(data), 1024), refcheck=False)
+        data[size:end] = values
+        return data
+
+    def extend(self, values):
+        n = len(values)
+        if self.typecode is not None:
+            nulls = None in values
+            if nulls:
+                if self.mask is None:
+                    self.mask = self._append(self._new('b'), 0, [False] * self.size)
+                flags = [v is None for v in values]
+                values = [0 if v is None else v for v in values]
+            if self.mask is not None:
+                self.mask = self._append(self.mask, self.size, flags if nulls else [False] * n)
+            try:
+                self.data = self._append(self.data, self.size, values)
+            except (OverflowError, TypeError, ValueError):
+                # e.g. BIGINT UNSIGNED beyond int64, keep the column as objects.
+                self._to_objects()
+                self.data.extend(values)
+            if self.typecode is None and nulls:
+                for i, flag in enumerate(flags, self.size):
+                    if flag:
+                        self.data[i] = None
+        else:
+            self.data.extend(values)
+        self.size += n
+
+    def _to_objects(self):
+        data = self.data[:self.size]
+        data = data.tolist() if hasattr(data, 'tolist') else list(data)
+        if self.mask is not None:
+            for i, flag in enumerate(self.mask[:self.size]):
+                if flag:
+                    data[i] = None
+        self.typecode, self.data, self.mask = None, data, None
+
+    def finish(self):
+        """Trim the buffers, return (column, NULL mask or None)"""
+        if self.numpy is not None:
+            if isinstance(self.data, list):
+                column = self.numpy.empty(self.size, dtype=object)
+                column[:] = self.data
+                self.data = column
+            else:
+                self.data.resize(self.size, refcheck=False)
+            if self.mask is not None:
+                self.mask.resize(self.size, refcheck=False)
+        return self.data, self.mask
+
+
+class ColumnSet(object):
+    """
+    Columnar result of `DB.query_columns`: `columns[name]` is the column array
+    and `nulls[name]` its NULL mask, None when the column is an object column
+    (NULLs are kept as None) or has no NULL.
+    """
+
+    def __init__(self, names, columns, nulls, rowcount):
+        self.names = names
+        self.columns = columns
+        self.nulls = nulls
+        self.rowcount = rowcount
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def __contains__(self, name):
+        return name in self.columns
+
+    def __len__(self):
+        return self.rowcount
+
+    def __repr__(self):
+        return '<ColumnSet %d rows %s>' % (self.rowcount, self.names)
+
+
+class ResultStream(object):
+    """
+    Rows of an unbuffered server side cursor, fetched `batch_size` rows at a time.
+    The connection is held until the rows are exhausted or the stream is closed,
+    use it as a context manager to release it deterministically:
+
+        with pool.query(table='t1', stream=True) as rows:
+            for row in rows:
+                ...
+    """
+
+    def __init__(self, cursor, batch_size=1000, release=None, make_row=None):
+        self.cursor = cursor
+        self.batch_size = batch_size
+        self.rowcount = cursor.rowcount
+        self._release = release
+        self._make_row = make_row
+        self._batch = iter(())
+        if not cursor.description:
+            self.close()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        for row in self._batch:
+            return row if self._make_row is None else self._make_row(row)
+        if self.cursor is not None:
+            rows = self.cursor.fetchmany(self.batch_size)
+            if rows:
+                self._batch = iter(rows)
+                return next(self)
+            self.close()
+        raise StopIteration
+
+    next = __next__
+
+    def batches(self):
+        """Yield the remaining rows as lists of up to `batch_size` rows"""
+        rows = [row if self._make_row is None else self._make_row(row) for row in self._batch]
+        self._batch = iter(())
+        if rows:
+            yield rows
+        while self.cursor is not None:
+            rows = self.cursor.fetchmany(self.batch_size)
+            if not rows:
+                self.close()
+                break
+            yield rows if self._make_row is None else list(map(self._make_row, rows))
+
+    def on_close(self, callback):
+        """Call `callback` when the stream is closed, at once if it is already"""
+        if self.cursor is None:
+            callback()
+            return
+        release = self._release
+
+        def chained():
+            try:
+                if release is not None:
+                    release()
+            finally:
+                callback()
+        self._release = chained
+
+    def close(self):
+        """Close the cursor and give the connection back"""
+        cursor, self.cursor = self.cursor, None
+        release, self._release = self._release, None
+        self._batch = iter(())
+        try:
+            if cursor is not None:
+                # Unbuffered cursors read the remaining rows off the wire on close.
+                cursor.close()
+        finally:
+            if release is not None:
+                release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+class PoolError(Exception):
+    """Connection pool error"""
+
+
+class TooManyConnections(PoolError):
+    """All `maxconnections` connections are in use and the pool is not blocking"""
+
+
+class PoolTimeout(PoolError):
+    """No connection could be checked out within `checkout_timeout` seconds"""
+
+
+class QueryTimeout(PoolError):
+    """A statement ran past the deadline of its call and was cancelled"""
+
+
+class ReplicaLagTimeout(PoolError):
+    """Replicas lagged longer than `max_replica_wait` between two batches of a batched write"""
+
+
+class Overloaded(PoolError):
+    """The call was shed by the admission controller: its queue is full or the call would miss its deadline"""
+
+
+class ConnectionLeakWarning(UserWarning):
+    """A connection has been checked out for more than the `leak_threshold` of its pool"""
+
+
+def warn_leak(leak):
+    """Default `leak_callback` of ConnectionPool: a ConnectionLeakWarning with the checkout stack"""
+    warnings.warn('Connection checked out for %.1fs by thread %s, at:\n%s' % (leak.held, leak.thread, leak.stack),
+                  ConnectionLeakWarning)
+
+
+# Upper bounds (seconds) of the checkout wait-time histogram buckets.
+WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, float('inf'))
+
+
+class _PoolEntry(object):
+    """A raw driver connection with its pool bookkeeping"""
+
+    __slots__ = ['con', 'created', 'last_used', 'usage', 'pid', 'checked_out', 'thread', 'frames', 'reported']
+
+    def __init__(self, con):
+        self.con = con
+        self.created = self.last_used = time.time()
+        self.usage = 0
+        self.pid = os.getpid()
+
+
+# Connections inherited from the parent process. They are kept referenced so
+# the driver never closes them: that would end the sessions of the parent.
+_inherited_connections = []
+
+
+class PooledConnection(object):
+    """
+    A connection checked out of a ConnectionPool, it proxies the driver
+    connection and `close()` gives it back to the pool.
+    """
+
+    def __init__(self, pool, entry):
+        self._pool = pool
+        self._entry = entry
+
+    def _con(self):
+        if self._entry is None:
+            raise PoolError('Connection has been returned to the pool')
+        return self._entry.con
+
+    def cursor(self, *args, **kwargs):
+        con = self._con()
+        self._entry.usage += 1
+        return con.cursor(*args, **kwargs)
+
+    def commit(self):
+        self._con().commit()
+
+    def rollback(self):
+        self._con().rollback()
+
+    def __getattr__(self, name):
+        return getattr(self._con(), name)
+
+    def close(self, discard=False):
+        """Give the connection back, `discard` closes it instead of keeping it idle"""
+        entry, self._entry = self._entry, None
+        if entry is not None:
+            self._pool._release(entry, discard)
+
+    def discard(self):
+        self.close(discard=True)
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+class ConnectionPool(object):
+    """
+    Thread-safe pool of dedicated connections, configured with the keys of
+    DBUtils PooledDB plus a few of its own:
+        mincached: Idle connections opened eagerly by `warmup()` and kept on eviction.
+        maxcached: Max idle connections kept, 0 means unlimited.
+        maxconnections: Max open connections, 0 means unlimited. Connections
+                        beyond `maxcached` are closed when given back.
+        blocking: Wait for a connection when `maxconnections` are in use,
+                  otherwise raise TooManyConnections.
+        maxusage: Max cursors per connection before it is reopened, 0 means unlimited.
+        setsession: SQL commands run on every new connection.
+        reset: Roll back connections given back to the pool.
+        checkout_timeout: Max seconds to wait for a connection when blocking.
+        idle_timeout: Idle connections beyond `mincached` are closed after that many seconds.
+        max_lifetime: Connections are closed that many seconds after being opened.
+        ping_interval: Connections idle for more than that many seconds are
+                       pinged before checkout, None never pings.
+        leak_threshold: Connections checked out for more than that many seconds
+                        are reported to `leak_callback` with the stack which
+                        checked them out, see `leaks()`. None disables the detector.
+        leak_callback: Called with the Item of each leak, `warn_leak` by default.
+    `maxshared`, `failures` and `ping` are accepted for compatibility and ignored.
+
+    A child process forked with the pool forgets the connections of the parent
+    and opens its own, see `_after_fork`.
+    """
+
+    _instances = weakref.WeakSet()
+
+    KEYS = ('mincached', 'maxcached', 'maxshared', 'maxconnections', 'blocking', 'maxusage', 'setsession',
+            'reset', 'failures', 'ping', 'checkout_timeout', 'idle_timeout', 'max_lifetime', 'ping_interval',
+            'leak_threshold', 'leak_callback')
+
+    def __init__(self, creator, config, mincached=0, maxcached=0, maxconnections=0, blocking=False,
+                 maxusage=0, setsession=None, reset=True, checkout_timeout=None, idle_timeout=None,
+                 max_lifetime=None, ping_interval=60, maxshared=0, failures=None, ping=None, leak_threshold=None,
+                 leak_callback=warn_leak):
+        self.creator = creator
+        self.config = config
+        self.mincached = mincached or 0
+        self.maxcached = maxcached or 0
+        if self.maxcached and self.maxcached < self.mincached:
+            self.maxcached = self.mincached
+        self.maxconnections = maxconnections or 0
+        if self.maxconnections and self.maxconnections < max(self.mincached, self.maxcached):
+            self.maxconnections = max(self.mincached, self.maxcached)
+        self.blocking = blocking
+        self.maxusage = maxusage or 0
+        self.setsession = setsession or []
+        self.reset = reset
+        self.checkout_timeout = checkout_timeout
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+        self.ping_interval = ping_interval
+        self.leak_threshold = leak_threshold
+        self.leak_callback = leak_callback
+        self._init_state()
+        ConnectionPool._instances.add(self)
+
+    def _init_state(self):
+        self._cond = threading.Condition()
+        self._idle = collections.deque()
+        self._size = 0
+        self._in_use = 0
+        self._waiters = 0
+        self._counters = Item(checkouts=0, created=0, closed=0, timeouts=0, rejected=0, ping_failures=0)
+        self._wait_histogram = [0] * len(WAIT_BUCKETS)
+        self._broken = set()  # ids of checked out driver connections closed when given back
+        self._checked_out = {}  # id(entry): entry, tracked by the leak detector
+        self._leak_thread = None
+
+    def _after_fork(self):
+        """
+        Start over in a forked child: the inherited connections share their
+        sockets with the parent, they are dropped without being closed or rolled
+        back, and `mincached` connections of its own are opened in the background.
+        """
+        _inherited_connections.extend(entry.con for entry in self._idle)
+        # The lock may have been held by a thread of the parent, which does not exist here.
+        self._init_state()
+        if self.mincached:
+            self.warmup()
+
+    @classmethod
+    def from_config(cls, creator, config):
+        """Split pool keys off `config`, return (pool, driver config)"""
+        config = dict(config)
+        options = dict((key, config.pop(key)) for key in cls.KEYS if key in config)
+        return cls(creator, config, **options), config
+
+    def _create(self):
+        con = self.creator.connect(**self.config)
+        try:
+            if self.setsession:
+                cursor = con.cursor()
+                for sql in self.setsession:
+                    cursor.execute(sql)
+                cursor.close()
+                con.commit()
+        except Exception:
+            con.close()
+            raise
+        with self._cond:
+            self._counters.created += 1
+        return _PoolEntry(con)
+
+    def _close(self, entry):
+        """Close a connection which has already left the pool's count"""
+        with self._cond:
+            self._counters.closed += 1
+        try:
+            entry.con.close()
+        except Exception:
+            pass
+
+    def _expired(self, entry, now):
+        if self.max_lifetime is not None and now - entry.created > self.max_lifetime:
+            return True
+        return bool(self.maxusage) and entry.usage >= self.maxusage
+
+    def _evict(self, now):
+        """Pop expired idle connections, the lock must be held"""
+        evicted = []
+        keep = collections.deque()
+        while self._idle:
+            # Oldest used first, so the most recently used connections survive.
+            entry = self._idle.popleft()
+            idle_for = now - entry.last_used
+            if self._expired(entry, now) or (self.idle_timeout is not None and idle_for > self.idle_timeout
+                                             and len(keep) + len(self._idle) >= self.mincached):
+                evicted.append(entry)
+                self._size -= 1
+            else:
+                keep.append(entry)
+        self._idle = keep
+        return evicted
+
+    def connection(self):
+        """Check out a connection, give it back with `close()`"""
+        start = time.time()
+        deadline = None if self.checkout_timeout is None else start + self.checkout_timeout
+        entry, evicted = None, []
+        with self._cond:
+            while True:
+                evicted.extend(self._evict(time.time()))
+                if self._idle:
+                    entry = self._idle.pop()
+                    break
+                if not self.maxconnections or self._size < self.maxconnections:
+                    self._size += 1
+                    break
+                if not self.blocking:
+                    self._counters.rejected += 1
+                    raise TooManyConnections('Too many connections: %d' % self.maxconnections)
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    self._counters.timeouts += 1
+                    raise PoolTimeout('No connection available within %ss' % self.checkout_timeout)
+                self._waiters += 1
+                try:
+                    self._cond.wait(remaining)
+                finally:
+                    self._waiters -= 1
+            self._in_use += 1
+            self._counters.checkouts += 1
+            waited = time.time() - start
+            for i, bound in enumerate(WAIT_BUCKETS):
+                if waited <= bound:
+                    self._wait_histogram[i] += 1
+                    break
+
+        for old in evicted:
+            self._close(old)
+        try:
+            if entry is None:
+                entry = self._create()
+            elif self.ping_interval is not None and time.time() - entry.last_used > self.ping_interval:
+                entry = self._validate(entry)
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+        if self.leak_threshold is not None:
+            self._track(entry)
+        return PooledConnection(self, entry)
+
+    def _track(self, entry):
+        """Remember when and where `entry` is checked out, for the leak detector"""
+        entry.checked_out = time.monotonic()
+        entry.thread = threading.current_thread().name
+        # From the caller of `connection()`, without the source lines: they are
+        # only looked up and formatted if the connection is reported leaked.
+        entry.frames = traceback.StackSummary.extract(traceback.walk_stack(sys._getframe(2)), lookup_lines=False)
+        entry.reported = False
+        with self._cond:
+            self._checked_out[id(entry)] = entry
+            if self._leak_thread is None:
+                interval = max(0.01, min(self.leak_threshold / 2.0, 5.0))
+                self._leak_thread = threading.Thread(target=ConnectionPool._watch_leaks,
+                                                     args=(weakref.ref(self), interval), name='pysql-leak-detector')
+                self._leak_thread.daemon = True
+                self._leak_thread.start()
+
+    @staticmethod
+    def _watch_leaks(ref, interval):
+        # A weak reference, the thread ends with the pool.
+        while True:
+            time.sleep(interval)
+            pool = ref()
+            if pool is None:
+                return
+            pool._report_leaks()
+            del pool
+
+    def _leaked(self, now):
+        with self._cond:
+            return [entry for entry in self._checked_out.values() if now - entry.checked_out > self.leak_threshold]
+
+    def _report_leaks(self):
+        """Call `leak_callback` once for each connection found leaked"""
+        now = time.monotonic()
+        for entry in self._leaked(now):
+            if entry.reported:
+                continue
+            entry.reported = True
+            try:
+                self.leak_callback(self._leak(entry, now))
+            except Exception:
+                pass
+
+    def leaks(self):
+        """
+        Connections checked out for more than `leak_threshold` seconds, longest
+        held first: Items of `held` (seconds), `thread` and `stack` of the checkout.
+        """
+        if self.leak_threshold is None:
+            return []
+        now = time.monotonic()
+        leaks = [self._leak(entry, now) for entry in self._leaked(now)]
+        return sorted(leaks, key=lambda leak: -leak.held)
+
+    @staticmethod
+    def _leak(entry, now):
+        """Item of a leaked connection, with the stack of its checkout, outermost frame first"""
+        stack = ''.join(traceback.format_list(entry.frames[::-1]))
+        return Item(held=now - entry.checked_out, thread=entry.thread, stack=stack)
+
+    def _validate(self, entry):
+        """Ping a connection which has been idle for a while, reopen it if it is gone"""
+        try:
+            try:
+                entry.con.ping(False)
+            except TypeError:
+                entry.con.ping()
+            return entry
+        except Exception:
+            with self._cond:
+                self._counters.ping_failures += 1
+            self._close(entry)
+            return self._create()
+
+    def mark_broken(self, con):
+        """Close the checked out driver connection `con` when it is given back, instead of keeping it"""
+        with self._cond:
+            self._broken.add(id(con))
+
+    def _release(self, entry, discard=False):
+        if entry.pid != os.getpid():
+            # Checked out before a fork, the connection belongs to the parent.
+            _inherited_connections.append(entry.con)
+            return
+        if self._broken:
+            with self._cond:
+                if id(entry.con) in self._broken:
+                    self._broken.discard(id(entry.con))
+                    discard = True
+        if not discard and self.reset:
+            try:
+                entry.con.rollback()
+            except Exception:
+                discard = True
+        now = time.time()
+        with self._cond:
+            self._in_use -= 1
+            if self._checked_out:
+                self._checked_out.pop(id(entry), None)
+            keep = not (discard or self._expired(entry, now) or
+                        (self.maxcached and len(self._idle) >= self.maxcached))
+            if keep:
+                entry.last_used = now
+                self._idle.append(entry)
+            else:
+                self._size -= 1
+            self._cond.notify()
+        if not keep:
+            self._close(entry)
+
+    def warmup(self, background=True):
+        """Open connections until `mincached` are idle, in a daemon thread if `background`"""
+        if background:
+            thread = threading.Thread(target=self.warmup, args=(False,), name='pysql-pool-warmup')
+            thread.daemon = True
+            thread.start()
+            return thread
+
+        while True:
+            with self._cond:
+                if len(self._idle) >= self.mincached or \
+                        (self.maxconnections and self._size >= self.maxconnections):
+                    return
+                self._size += 1
+            try:
+                entry = self._create()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                return
+            with self._cond:
+                self._idle.append(entry)
+                self._cond.notify()
+
+    def close(self):
+        """Close the idle connections"""
+        with self._cond:
+            idle, self._idle = self._idle, collections.deque()
+            self._size -= len(idle)
+        for entry in idle:
+            self._close(entry)
+
+    def stats(self):
+        """Snapshot of the pool: sizes, waiters, counters and checkout wait-time histogram"""
+        with self._cond:
+            out = Item(self._counters)
+            out.update(size=self._size, in_use=self._in_use, idle=len(self._idle), waiters=self._waiters)
+            out.wait_histogram = collections.OrderedDict(
+                ('+Inf' if bound == float('inf') else '%g' % bound, n)
+                for bound, n in zip(WAIT_BUCKETS, self._wait_histogram))
+            return out
+
+
+# Priority classes of admission control, lower is served first.
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BATCH = 2
+ADMISSION_MODES = ('fixed', 'aimd', 'gradient')
+
+
+class _Waiter(object):
+
+    __slots__ = ['priority', 'seq', 'event', 'granted', 'cancelled']
+
+    def __init__(self, priority, seq):
+        self.priority = priority
+        self.seq = seq
+        self.event = threading.Event()
+        self.granted = False
+        self.cancelled = False
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class AdmissionController(object):
+    """
+    Caps the calls in flight to `limit`, callers beyond it queue by priority
+    class then arrival. A call is shed with Overloaded when the queue holds
+    `queue_size` callers, or when its deadline passes or would be missed given
+    the queue ahead of it and the observed latency.
+
+    The limit is fixed, or adapted to the latency of the calls:
+        aimd: +1 while latencies stay under `target_latency`, times `backoff` above it.
+        gradient: scaled by the ratio of the long term to the recent latency, so
+                  the limit shrinks as soon as queueing in the server shows up.
+    """
+
+    def __init__(self, limit=32, mode='fixed', min_limit=1, max_limit=1000, queue_size=None, queue_timeout=None,
+                 target_latency=None, backoff=0.9, tolerance=1.5, smoothing=0.2):
+        """
+        :param
+            limit: Calls in flight, the initial limit of the adaptive modes.
+            queue_size: Max queued callers, None means unbounded.
+            queue_timeout: Max seconds a caller without a deadline waits, None waits forever.
+            target_latency: Latency (seconds) above which the aimd mode backs off.
+            tolerance: Gradient mode: recent latency up to `tolerance` times the long term one is not queueing.
+            smoothing: Gradient mode: weight of a new limit estimate.
+        """
+        assert mode in ADMISSION_MODES, 'Wrong admission mode: %s' % mode
+        assert mode != 'aimd' or target_latency, 'aimd needs a target_latency'
+        self.mode = mode
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = float(max(min_limit, min(limit, max_limit)))
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.target_latency = target_latency
+        self.backoff = backoff
+        self.tolerance = tolerance
+        self.smoothing = smoothing
+        self.in_flight = 0
+        self.latency = None       # recent latency, EWMA
+        self.long_latency = None  # long term latency, slow EWMA
+        self._queue = []
+        self._queued = 0
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._counters = Item(admitted=0, queued=0, rejected=0, timeouts=0)
+
+    def acquire(self, priority=PRIORITY_NORMAL, deadline=None):
+        """
+        Take a slot, waiting for one until `deadline` (a time.monotonic() value)
+        or `queue_timeout`. Raises Overloaded when shed.
+        """
+        now = time.monotonic()
+        if deadline is None and self.queue_timeout is not None:
+            deadline = now + self.queue_timeout
+        with self._lock:
+            if self.in_flight < int(self.limit) and not self._queued:
+                self.in_flight += 1
+                self._counters.admitted += 1
+                return
+            if deadline is not None and deadline <= now:
+                self._counters.rejected += 1
+                raise Overloaded('Deadline passed before admission')
+            if self.queue_size is not None and self._queued >= self.queue_size:
+                self._counters.rejected += 1
+                raise Overloaded('Admission queue full (%d callers)' % self._queued)
+            if deadline is not None and self.latency is not None:
+                ahead = sum(1 for w in self._queue if not w.cancelled and w.priority <= priority)
+                # Callers ahead are served `limit` at a time.
+                if now + (ahead + 1) * self.latency / max(int(self.limit), 1) > deadline:
+                    self._counters.rejected += 1
+                    raise Overloaded('Call would miss its deadline, %d callers ahead' % ahead)
+            waiter = _Waiter(priority, next(self._seq))
+            heapq.heappush(self._queue, waiter)
+            self._queued += 1
+            self._counters.queued += 1
+
+        waiter.event.wait(None if deadline is None else max(deadline - time.monotonic(), 0))
+        with self._lock:
+            if waiter.granted:
+                return
+            waiter.cancelled = True
+            self._queued -= 1
+            self._counters.timeouts += 1
+        raise Overloaded('No admission before the deadline')
+
+    def release(self, latency=None):
+        """Give a slot back, `latency` (seconds) of the call adapts the limit"""
+        with self._lock:
+            self.in_flight -= 1
+            if latency is not None:
+                self._observe(latency)
+            self._grant()
+
+    def _after_fork(self):
+        """Forget the calls and waiters of the parent's threads, runs in a forked child"""
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self._queue = []
+        self._queued = 0
+
+    def _grant(self):
+        """Hand free slots to the first waiters, the lock must be held"""
+        while self._queue and self.in_flight < int(self.limit):
+            waiter = heapq.heappop(self._queue)
+            if waiter.cancelled:
+                continue
+            waiter.granted = True
+            self._queued -= 1
+            self.in_flight += 1
+            self._counters.admitted += 1
+            waiter.event.set()
+
+    def _observe(self, latency):
+        """Update the latency averages and the limit, the lock must be held"""
+        self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+        self.long_latency = latency if self.long_latency is None else 0.99 * self.long_latency + 0.01 * latency
+        # Not limited by the cap: the latencies tell nothing about a larger limit.
+        saturated = self.in_flight + 1 >= int(self.limit) / 2 or self._queued
+
+        limit = self.limit
+        if self.mode == 'aimd':
+            if latency > self.target_latency:
+                limit = limit * self.backoff
+            elif saturated:
+                limit = limit + 1
+        elif self.mode == 'gradient':
+            gradient = max(0.5, min(1.0, self.tolerance * self.long_latency / max(self.latency, 1e-9)))
+            estimate = limit * gradient + (limit ** 0.5 if saturated else 0)
+            limit = (1 - self.smoothing) * limit + self.smoothing * estimate
+        self.limit = max(self.min_limit, min(limit, self.max_limit))
+
+    def stats(self):
+        """Current limit, calls in flight, queue depth, latency and counters"""
+        with self._lock:
+            out = Item(self._counters)
+            out.update(limit=int(self.limit), in_flight=self.in_flight, queue_depth=self._queued,
+                       latency=self.latency, mode=self.mode)
+            return out
+
+    def prometheus(self, prefix='pysql'):
+        """The stats in the Prometheus text exposition format"""
+        stats = self.stats()
+        lines = []
+        for name, kind, value in (('admission_limit', 'gauge', stats.limit),
+                                  ('admission_in_flight', 'gauge', stats.in_flight),
+                                  ('admission_queue_depth', 'gauge', stats.queue_depth),
+                                  ('admission_admitted_total', 'counter', stats.admitted),
+                                  ('admission_rejected_total', 'counter', stats.rejected),
+                                  ('admission_timeouts_total', 'counter', stats.timeouts)):
+            lines.append('# TYPE %s_%s %s' % (prefix, name, kind))
+            lines.append('%s_%s %d' % (prefix, name, value))
+        return '\n'.join(lines) + '\n'
+
+
+_SHAPE_LITERALS = re.compile(r"'(?:[^'\\]|\\.|'')*'|\"(?:[^\"\\]|\\.)*\"|\b\d+(?:\.\d+)?\b|%s")
+_SHAPE_LISTS = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+_SHAPE_ROWS = re.compile(r'\(\.\.\.\)(?:\s*,\s*\(\.\.\.\))+')
+
+
+def statement_shape(sql):
+    """
+    Normalized form of a statement: literals and placeholders as `?`, lists and
+    rows of a multiple-row INSERT collapsed.
+        >>> statement_shape("SELECT * FROM t1 WHERE id IN (%s, %s) AND name = 'a'")
+        'SELECT * FROM t1 WHERE id IN (...) AND name = ?'
+    """
+    shape = _SHAPE_LITERALS.sub('?', ' '.join(sql.split()))
+    shape = _SHAPE_LISTS.sub('(...)', shape)
+    return _SHAPE_ROWS.sub('(...), ...', shape)
+
+
+class QueryEvent(object):
+    """
+    A statement seen by the query hooks. Phase times are in seconds: `build`
+    renders the statement, counted from the call of the pool method (or the end
+    of its previous statement), `execute` is the driver round-trip, `fetch` and
+    `convert` read the rows and build the row objects of a buffered query.
+    """
+
+    __slots__ = ['sql', 'params', 'start', 'build', 'execute', 'fetch', 'convert', 'rowcount', 'error']
+
+    def __init__(self, sql, params, start):
+        self.sql = sql
+        self.params = params
+        self.start = start
+        self.build = self.execute = self.fetch = self.convert = 0.0
+        self.rowcount = None
+        self.error = None
+
+    @property
+    def duration(self):
+        return self.build + self.execute + self.fetch + self.convert
+
+    def __repr__(self):
+        return '<QueryEvent %r %.6fs>' % (self.sql, self.duration)
+
+
+class QueryHook(object):
+    """
+    Base class of the hooks of `DB.add_hook`, override any of the methods.
+    Hooks run in the thread of the statement, on every statement.
+    """
+
+    def before_execute(self, event):
+        pass
+
+    def after_execute(self, event):
+        pass
+
+    def on_error(self, event, error):
+        pass
+
+
+# Upper bounds (seconds) of the statement latency histogram buckets.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+                   float('inf'))
+PHASES = ('build', 'execute', 'fetch', 'convert')
+# Shape of the statements beyond `max_shapes`.
+OTHER_SHAPE = 'other'
+
+
+class _ShapeStats(object):
+
+    __slots__ = ['count', 'errors', 'rows', 'phases', 'histogram']
+
+    def __init__(self, buckets):
+        self.count = self.errors = self.rows = 0
+        self.phases = [0.0] * len(PHASES)
+        self.histogram = [0] * buckets
+
+
+def _prometheus_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class QueryRecorder(QueryHook):
+    """
+    Per statement shape (see `statement_shape`) counters of calls, errors and
+    rows, time per phase and a latency histogram:
+
+        recorder = QueryRecorder()
+        pool.add_hook(recorder)
+        recorder.snapshot()     # {shape: Item(count, errors, rows, total, build, ..., histogram)}
+        recorder.prometheus()   # Prometheus text exposition format
+
+    At most `max_shapes` shapes are kept, later ones are counted as OTHER_SHAPE.
+    """
+
+    def __init__(self, max_shapes=1000, buckets=LATENCY_BUCKETS):
+        self.max_shapes = max_shapes
+        self.buckets = tuple(buckets)
+        self._stats = {}
+        self._shapes = {}  # sql: shape, normalizing is costlier than recording
+        self._lock = threading.Lock()
+
+    def _shape(self, sql):
+        shape = self._shapes.get(sql)
+        if shape is None:
+            if len(self._shapes) >= 4 * self.max_shapes:
+                self._shapes.clear()
+            shape = self._shapes[sql] = statement_shape(sql)
+        return shape
+
+    def after_execute(self, event):
+        self._record(event)
+
+    def on_error(self, event, error):
+        self._record(event)
+
+    def _record(self, event):
+        shape = self._shape(event.sql)
+        duration = event.duration
+        bucket = bisect.bisect_left(self.buckets, duration)
+        with self._lock:
+            stats = self._stats.get(shape)
+            if stats is None:
+                if len(self._stats) >= self.max_shapes:
+                    shape = OTHER_SHAPE
+                    stats = self._stats.get(shape)
+                if stats is None:
+                    stats = self._stats[shape] = _ShapeStats(len(self.buckets))
+            stats.count += 1
+            if event.error is not None:
+                stats.errors += 1
+            elif event.rowcount and event.rowcount > 0:
+                stats.rows += event.rowcount
+            phases = stats.phases
+            phases[0] += event.build
+            phases[1] += event.execute
+            phases[2] += event.fetch
+            phases[3] += event.convert
+            stats.histogram[min(bucket, len(self.buckets) - 1)] += 1
+
+    def snapshot(self):
+        """{shape: Item} of the counters, the histogram counts the statements per bucket"""
+        with self._lock:
+            out = {}
+            for shape, stats in self._stats.items():
+                item = Item(count=stats.count, errors=stats.errors, rows=stats.rows, total=sum(stats.phases))
+                item.update(zip(PHASES, stats.phases))
+                item.histogram = collections.OrderedDict(
+                    ('+Inf' if bound == float('inf') else '%g' % bound, n)
+                    for bound, n in zip(self.buckets, stats.histogram))
+                out[shape] = item
+            return out
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+
+    def prometheus(self, prefix='pysql'):
+        """The counters in the Prometheus text exposition format"""
+        snapshot = sorted(self.snapshot().items())
+        lines = ['# HELP %s_query_duration_seconds Latency of the statements by shape.' % prefix,
+                 '# TYPE %s_query_duration_seconds histogram' % prefix]
+        for shape, item in snapshot:
+            label = 'shape="%s"' % _prometheus_label(shape)
+            cumulative = 0
+            for bound, n in item.histogram.items():
+                cumulative += n
+                lines.append('%s_query_duration_seconds_bucket{%s,le="%s"} %d' % (prefix, label, bound, cumulative))
+            lines.append('%s_query_duration_seconds_sum{%s} %r' % (prefix, label, item.total))
+            lines.append('%s_query_duration_seconds_count{%s} %d' % (prefix, label, item.count))
+
+        counters = (
+            ('query_phase_seconds_total', 'Time of the statements by shape and phase.',
+             [((shape, phase), item[phase]) for shape, item in snapshot for phase in PHASES]),
+            ('query_errors_total', 'Failed statements by shape.',
+             [((shape, None), item.errors) for shape, item in snapshot]),
+            ('query_rows_total', 'Rows read or written by shape.',
+             [((shape, None), item.rows) for shape, item in snapshot]))
+        for name, help, values in counters:
+            lines.append('# HELP %s_%s %s' % (prefix, name, help))
+            lines.append('# TYPE %s_%s counter' % (prefix, name))
+            for (shape, phase), value in values:
+                label = 'shape="%s"' % _prometheus_label(shape)
+                if phase:
+                    label += ',phase="%s"' % phase
+                lines.append('%s_%s{%s} %r' % (prefix, name, label, value))
+        return '\n'.join(lines) + '\n'
+
+
+_EXPLAINABLE = re.compile(r'^\s*(\(\s*)*(SELECT|INSERT|REPLACE|UPDATE|DELETE)\b', re.I)
+
+
+def plan_flags(plan):
+    """
+    (full_scan, filesort) of an `EXPLAIN FORMAT=JSON` plan: a table read with
+    access type ALL, a `using_filesort` step.
+    """
+    full_scan = filesort = False
+    nodes = [plan]
+    while nodes:
+        node = nodes.pop()
+        if isinstance(node, dict):
+            if node.get('access_type') == 'ALL':
+                full_scan = True
+            if node.get('using_filesort'):
+                filesort = True
+            nodes.extend(node.values())
+        elif isinstance(node, list):
+            nodes.extend(node)
+    return full_scan, filesort
+
+
+# Frames of these files are skipped when looking for the calling site of a statement.
+_INTERNAL_FILES = set([__file__])
+
+
+def _calling_site():
+    """`file:line in function` of the first caller outside pysql"""
+    frame = sys._getframe(1)
+    while frame is not None and frame.f_code.co_filename in _INTERNAL_FILES:
+        frame = frame.f_back
+    if frame is None:
+        return None
+    return '%s:%d in %s' % (frame.f_code.co_filename, frame.f_lineno, frame.f_code.co_name)
+
+
+def _json_value(value):
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    return str(value)
+
+
+class SlowQueryLog(QueryHook):
+    """
+    Statements slower than `threshold` seconds, with their shape, parameters,
+    duration and calling site. A fraction `explain_sample` of them is explained
+    (`EXPLAIN FORMAT=JSON`) on another connection of `db`, in the background,
+    and flagged when the plan has a full table scan or a filesort:
+
+        slow = SlowQueryLog(pool, threshold=0.1, explain_sample=0.1)
+        pool.add_hook(slow)
+        slow.entries(min_duration=0.5, full_scan=True)
+        slow.dump('slow.jsonl')
+
+    The last `maxlen` entries are kept.
+    """
+
+    def __init__(self, db, threshold=0.1, explain_sample=0.0, redact=False, maxlen=1000):
+        """
+        :param
+            db: DB running the EXPLAINs.
+            explain_sample: Fraction of the slow statements explained, 0 disables EXPLAIN.
+            redact: True drops the parameters, a callable takes them and returns what is kept.
+        """
+        self.db = db
+        self.threshold = threshold
+        self.explain_sample = explain_sample
+        self.redact = redact
+        self._entries = collections.deque(maxlen=maxlen)
+        self._pending = set()
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def after_execute(self, event):
+        if event.duration >= self.threshold:
+            self._record(event)
+
+    def on_error(self, event, error):
+        if event.duration >= self.threshold:
+            self._record(event)
+
+    def _record(self, event):
+        params = event.params
+        if self.redact:
+            params = self.redact(params) if callable(self.redact) else None
+        entry = Item(time=time.time(), shape=statement_shape(event.sql), sql=event.sql,
+                     params=None if params is None else [_json_value(p) for p in params],
+                     duration=event.duration, rowcount=event.rowcount,
+                     error=None if event.error is None else repr(event.error), site=_calling_site(),
+                     plan=None, full_scan=None, filesort=None, explain_error=None)
+        with self._lock:
+            self._entries.append(entry)
+            if (event.error is None and self.explain_sample and _EXPLAINABLE.match(event.sql)
+                    and random.random() < self.explain_sample):
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=1)
+                future = self._executor.submit(self._explain, entry, event.sql, event.params)
+                self._pending.add(future)
+                future.add_done_callback(self._pending.discard)
+
+    def _explain(self, entry, sql, params):
+        conn = None
+        try:
+            # An exhausted pool or a server gone skip the EXPLAIN, the statement is still logged.
+            conn = self.db.connection_pool.connection()
+            cursor = conn.cursor()
+            cursor.execute('EXPLAIN FORMAT=JSON ' + sql, params)
+            plan = json.loads(cursor.fetchone()[0])
+            conn.rollback()
+        except Exception as e:
+            entry.explain_error = repr(e)
+            return
+        finally:
+            if conn is not None:
+                conn.close()
+        entry.full_scan, entry.filesort = plan_flags(plan)
+        entry.plan = plan
+
+    def flush(self):
+        """Wait for the EXPLAINs in progress"""
+        with self._lock:
+            pending = list(self._pending)
+        for future in pending:
+            future.result()
+
+    def entries(self, shape=None, min_duration=0, full_scan=None, filesort=None):
+        """Entries, oldest first, optionally of one shape, at least `min_duration` long or flagged"""
+        with self._lock:
+            entries = list(self._entries)
+        return [entry for entry in entries
+                if (shape is None or entry.shape == shape) and entry.duration >= min_duration
+                and (full_scan is None or entry.full_scan == full_scan)
+                and (filesort is None or entry.filesort == filesort)]
+
+    def dump(self, out):
+        """Write the entries as JSON lines to a path or a file object, return the number written"""
+        entries = self.entries()
+        if isinstance(out, str):
+            with open(out, 'a') as f:
+                return self._dump(entries, f)
+        return self._dump(entries, out)
+
+    def _dump(self, entries, f):
+        for entry in entries:
+            f.write(json.dumps(entry, sort_keys=True) + '\n')
+        return len(entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def close(self):
+        """Wait for the EXPLAINs in progress and stop their thread"""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    def _after_fork(self):
+        # The EXPLAIN thread is not forked, a new one is started on demand.
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pending = set()
+
+
+_READ_QUERY = re.compile(r'^\s*(\(\s*)*SELECT\b', re.I)
+_LOCKING_READ = re.compile(r'\bFOR\s+(UPDATE|SHARE)\b|\bLOCK\s+IN\s+SHARE\s+MODE\b', re.I)
+
+
+# CLIENT.MULTI_STATEMENTS capability flag of the MySQL protocol, see pymysql.constants.CLIENT.
+MULTI_STATEMENTS = 1 << 16
+
+# Server errors after which replaying the transaction may succeed. A deadlock
+# rolls back the whole transaction, a lock wait timeout only the statement.
+ER_LOCK_WAIT_TIMEOUT = 1205
+ER_LOCK_DEADLOCK = 1213
+RETRY_ERRORS = (ER_LOCK_WAIT_TIMEOUT, ER_LOCK_DEADLOCK)
+
+
+def error_code(error):
+    """MySQL error number of a driver exception (`args[0]` of pymysql and MySQLdb errors), or None"""
+    args = getattr(error, 'args', None)
+    return args[0] if args and isinstance(args[0], int) else None
+
+
+# A statement stopped by KILL QUERY, a SELECT stopped by its MAX_EXECUTION_TIME hint.
+ER_QUERY_INTERRUPTED = 1317
+ER_QUERY_TIMEOUT = 3024
+_SELECT_KEYWORD = re.compile(r'\bSELECT\b', re.I)
+
+
+class _Watch(object):
+
+    __slots__ = ['deadline', 'seq', 'connection_id', 'cancelled', 'fired']
+
+    def __init__(self, deadline, seq, connection_id):
+        self.deadline = deadline
+        self.seq = seq
+        self.connection_id = connection_id
+        self.cancelled = False
+        self.fired = False
+
+    def __lt__(self, other):
+        return (self.deadline, self.seq) < (other.deadline, other.seq)
+
+
+class Watchdog(object):
+    """
+    Cancels statements running past their deadline: a background thread calls
+    `kill(connection_id)`, which sends `KILL QUERY` on a connection of its own.
+    """
+
+    def __init__(self, kill):
+        self.kill = kill
+        self.kills = 0
+        self.failures = 0
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def watch(self, deadline, connection_id):
+        """Kill the statement of `connection_id` at `deadline` (time.monotonic()) unless cancelled"""
+        watch = _Watch(deadline, next(self._seq), connection_id)
+        with self._cond:
+            heapq.heappush(self._heap, watch)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='pysql-watchdog')
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify()
+        return watch
+
+    def cancel(self, watch):
+        """Stop watching, return True if the kill has been sent or is being sent"""
+        with self._cond:
+            watch.cancelled = True
+            return watch.fired
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    while self._heap and self._heap[0].cancelled:
+                        heapq.heappop(self._heap)
+                    if not self._heap:
+                        self._cond.wait()
+                        continue
+                    wait = self._heap[0].deadline - time.monotonic()
+                    if wait <= 0:
+                        watch = heapq.heappop(self._heap)
+                        watch.fired = True
+                        break
+                    self._cond.wait(wait)
+            try:
+                self.kill(watch.connection_id)
+                self.kills += 1
+            except Exception:
+                self.failures += 1
+
+
+def is_read_query(sql):
+    """
+    True for plain SELECT statements, which may run on a replica.
+        >>> is_read_query('SELECT * FROM t1'), is_read_query('SELECT * FROM t1 FOR UPDATE')
+        (True, False)
+    """
+    return bool(_READ_QUERY.match(sql)) and not _LOCKING_READ.search(sql)
+
+
+REPLICA_STATUS_STATEMENTS = ('SHOW REPLICA STATUS', 'SHOW SLAVE STATUS')
+
+
+class ReplicaSet(object):
+    """
+    Read replicas of a DB. `choose()` picks one round-robin or with the least
+    queries in flight, skipping replicas whose replication lag is over `max_lag`
+    seconds. Lags are checked with SHOW REPLICA (or SLAVE) STATUS every `lag_check_interval`
+    seconds by a background thread, started on first use: until a replica has
+    been checked its lag is unknown and it is skipped.
+    """
+
+    STRATEGIES = ('round_robin', 'least_inflight')
+
+    def __init__(self, replicas, strategy='round_robin', max_lag=None, lag_check_interval=5.0):
+        assert strategy in self.STRATEGIES, 'Wrong replica strategy: %s' % strategy
+        self.replicas = list(replicas)
+        self.strategy = strategy
+        self.max_lag = max_lag
+        self.lag_check_interval = lag_check_interval
+        self._lock = threading.Lock()
+        self._counter = itertools.count()
+        self._inflight = dict((id(r), 0) for r in self.replicas)
+        self._lags = {}  # id(replica) -> (checked at, lag in seconds)
+        self._checker = None
+        self._closed = False
+        self._status_statements = {}  # id(replica) -> (the status statement the replica understands,)
+
+    def __len__(self):
+        return len(self.replicas)
+
+    def lag(self, replica):
+        """Replication lag of `replica` in seconds as last checked, inf when unknown or stopped"""
+        checked = self._lags.get(id(replica))
+        return float('inf') if checked is None else checked[1]
+
+    def _start_checker(self):
+        with self._lock:
+            if self._checker is not None or self._closed:
+                return
+            self._checker = threading.Thread(target=ReplicaSet._watch_lags, args=(weakref.ref(self),),
+                                             name='pysql-replica-lag')
+            self._checker.daemon = True
+            self._checker.start()
+
+    @staticmethod
+    def _watch_lags(ref):
+        # A weak reference, the thread ends with the replica set.
+        while True:
+            replicas = ref()
+            if replicas is None or replicas._closed:
+                return
+            replicas.check()
+            interval = max(replicas.lag_check_interval, 0.01)
+            del replicas
+            time.sleep(interval)
+
+    def check(self):
+        """Check the lag of every replica now"""
+        for replica in self.replicas:
+            self._lags[id(replica)] = (time.time(), self._check(replica))
+
+    def _check(self, replica):
+        # SHOW SLAVE STATUS is gone since MySQL 8.4, SHOW REPLICA STATUS came with 8.0.22.
+        statements = self._status_statements.get(id(replica), REPLICA_STATUS_STATEMENTS)
+        for sql in statements:
+            try:
+                rows = list(replica.execute(sql, row_factory='item'))
+            except Exception:
+                continue
+            self._status_statements[id(replica)] = (sql,)
+            lag = float('inf')
+            for row in rows:
+                value = row.get('Seconds_Behind_Source', row.get('Seconds_Behind_Master'))
+                lag = float('inf') if value is None else float(value)
+            return lag
+        # Retry both statements next time, the working one may have failed for another reason.
+        self._status_statements.pop(id(replica), None)
+        return float('inf')
+
+    def close(self):
+        """Stop the lag checks"""
+        self._closed = True
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+        self._checker = None
+
+    def healthy(self):
+        if self.max_lag is None:
+            return self.replicas
+        if self._checker is None:
+            self._start_checker()
+        return [r for r in self.replicas if self.lag(r) <= self.max_lag]
+
+    def choose(self):
+        """Return a replica, or None if none is healthy"""
+        replicas = self.healthy()
+        if not replicas:
+            return None
+        if self.strategy == 'least_inflight':
+            with self._lock:
+                return min(replicas, key=lambda r: self._inflight[id(r)])
+        return replicas[next(self._counter) % len(replicas)]
+
+    def begin(self, replica):
+        with self._lock:
+            self._inflight[id(replica)] += 1
+
+    def end(self, replica):
+        with self._lock:
+            self._inflight[id(replica)] -= 1
+
+    def inflight(self):
+        with self._lock:
+            return [self._inflight[id(r)] for r in self.replicas]
+
+
+class SQLCompiler(object):
+    """Render CRUD calls to SQL and rows to Python objects, shared by DB and AsyncSQLPool"""
+
+    def __init__(self, statement_cache_size=1024, row_factory='item'):
+        """
+        :param
+            statement_cache_size: Max compiled statement shapes kept, 0 disables the cache.
+            row_factory: Default row type of queries, see `_row_maker`.
+        """
+        self.statement_cache = StatementCache(statement_cache_size)
+        self.row_factory = row_factory
+
+    def _compiled(self, key, build, params):
+        """
+        Return the query of statement shape `key`: rendered by `build()` on a cache miss,
+        otherwise the cached query string bound to `params`.
+        """
+        cache = self.statement_cache
+        if not cache.maxsize:
+            return build()
+        try:
+            sql = cache.get(key)
+        except TypeError:
+            # Unhashable shape (e.g. list values in dup), don't cache it.
+            return build()
+        if sql is None:
+            sqlquery = build()
+            cache.put(key, sqlquery.query())
+            return sqlquery
+        return CompiledQuery(sql, params)
+
+    def _compile_insert(self, table, obj, mode, dup):
+        mode = mode.upper()
+        assert mode in INSERT_MODES, 'Wrong insert mode: %s' % mode
+
+        kvs = sorted(obj.items(), key=lambda v: v[0])
+
+        def build():
+            sqlquery = SQLBuilder("%s INTO %s (%s) VALUES " % (INSERT_MODES[mode], table, ', '.join(kv[0] for kv in kvs)))
+            sqlquery.join([SQLParam(kv[1]) for kv in kvs], sep=', ', prefix='(', suffix=')')
+            if dup:
+                sqlquery.append(" ON DUPLICATE KEY UPDATE %s" % sqlconvert(self._dup_items(dup)))
+            return sqlquery
+
+        # dup is rendered into the query text, so its values are part of the shape.
+        # True == 1 == 1.0 but they render differently, the type is part of the key too.
+        key = ('INSERT', mode, table, tuple(kv[0] for kv in kvs),
+               tuple((column, type(value), value) for column, value in self._dup_items(dup)))
+        return self._compiled(key, build, tuple(kv[1] for kv in kvs))
+
+    def _dup_items(self, dup):
+        """
+        (column, value) pairs of ON DUPLICATE KEY UPDATE. `dup` is a dict of
+        constants and Fields, or a list of columns taking the value of the
+        inserted row: ['name'] renders `name = VALUES(name)`.
+        """
+        if isinstance(dup, (list, tuple)):
+            return [(column, Field('VALUES(%s)' % column)) for column in dup]
+        return sorted(dup.items(), key=lambda kv: kv[0])
+
+    def _compile_updatemany(self, table, rows, keys):
+        """
+        UPDATE of rows with different values in one statement:
+        `SET c = CASE id WHEN %s THEN %s ... ELSE c END WHERE id IN (...)`.
+        A column missing in a row keeps its value in that row.
+        """
+        columns = sorted(set(column for row in rows for column in row if column not in keys))
+        assert columns, 'Nothing to update'
+
+        def match(out, row):
+            # Composite keys: `a = %s AND b = %s`
+            for i, key in enumerate(keys):
+                if i != 0:
+                    out.append(' AND ')
+                out.append(key + ' = ').param(row[key])
+
+        sqlquery = SQLBuilder('UPDATE %s SET ' % self._table(table))
+        for i, column in enumerate(columns):
+            if i != 0:
+                sqlquery.append(', ')
+            sqlquery.append(column + ' = CASE' + (' ' + keys[0] if len(keys) == 1 else ''))
+            for row in rows:
+                if column not in row:
+                    continue
+                if len(keys) == 1:
+                    sqlquery.append(' WHEN ').param(row[keys[0]])
+                else:
+                    match(sqlquery.append(' WHEN '), row)
+                sqlquery.append(' THEN ').param(row[column])
+            sqlquery.append(' ELSE %s END' % column)
+
+        if len(keys) == 1:
+            sqlquery.append(' WHERE %s IN ' % keys[0]).append(sqlquote([row[keys[0]] for row in rows]))
+        else:
+            sqlquery.append(' WHERE ')
+            for i, row in enumerate(rows):
+                sqlquery.append(' OR (' if i else '(')
+                match(sqlquery, row)
+                sqlquery.append(')')
+        return sqlquery
+
+    def _compile_insertmany(self, table, objs, mode, dup):
+        mode = mode.upper()
+        assert mode in INSERT_MODES, 'Wrong insert mode: %s' % mode
+
+        keys = objs[0].keys()
+        for obj in objs:
+            if obj.keys() != keys:
+                raise ValueError("Not all rows have the same keys")
+
+        keys = sorted(keys)
+        sqlquery = SQLBuilder("%s INTO %s (%s) VALUES " % (INSERT_MODES[mode], table, ",".join(keys)))
+
+        # Every row has the same shape, so write its fragments straight into the buffers.
+        parts, params = sqlquery.parts, sqlquery.params
+        for i, obj in enumerate(objs):
+            if i != 0:
+                parts.append(",")
+            parts.append('(')
+            for j, key in enumerate(keys):
+                if j != 0:
+                    parts.append(',')
+                parts.append(None)
+                params.append(obj[key])
+            parts.append(')')
+
+        if dup:
+            sqlquery.append(" ON DUPLICATE KEY UPDATE %s" % sqlconvert(self._dup_items(dup)))
+        return sqlquery
+
+    def _where(self, where):
+        assert isinstance(where, dict), 'Wrong format %s' % where
+
+        out = SQLBuilder()
+        for i, (key, value) in enumerate(sorted(where.items(), key=lambda x: x[0])):
+            parts = key.split('__')
+            key, operator = (parts[0], parts[1]) if len(parts) == 2 else (parts[0], 'EQ')
+            if i != 0:
+                out.append(' AND ')
+            out.append(key + sqloperator(operator)).append(sqlquote(value))
+
+        if out:
+            return out
+        return None
+
+    def _where_shape(self, where):
+        """
+        Return the shape and the parameters of a where dict, the shape keeps
+        the `key__op` strings and the arity of list values.
+        """
+        shape, params = [], []
+        for key, value in sorted(where.items(), key=lambda x: x[0]):
+            if isinstance(value, (list, tuple)):
+                shape.append((key, len(value)))
+                params.extend(value)
+            else:
+                shape.append(key)
+                params.append(value)
+        return tuple(shape), params
+
+    def _table(self, table):
+        if isinstance(table, (list, tuple)):
+            return ','.join(table)
+        return str(table)
+
+    def _compile_update(self, table, where, obj):
+        table = self._table(table)
+        values = sorted(obj.items(), key=lambda t: t[0])
+
+        def build():
+            where_query = self._where(where)
+            query = SQLBuilder('UPDATE ' + table + ' SET ').append(sqlconvert(values))
+            if where_query:
+                query.append(' WHERE ').append(where_query)
+            return query
+
+        where_shape, params = self._where_shape(where)
+        columns = tuple(kv if isinstance(kv[1], Field) else kv[0] for kv in values)
+        params[:0] = [kv[1] for kv in values if not isinstance(kv[1], Field)]
+        return self._compiled(('UPDATE', table, columns, where_shape), build, tuple(params))
+
+    def _compile_delete(self, table, where, using, order_by=None, limit=None):
+        table = self._table(table)
+
+        def build():
+            where_query = self._where(where)
+            query = SQLBuilder('DELETE FROM ' + table)
+            if using: query.append(' USING ').append(sqllist(using))
+            if where_query: query.append(' WHERE ').append(where_query)
+            if order_by: query.append(' ORDER BY ' + order_by)
+            if limit: query.append(' LIMIT %d' % limit)
+            return query
+
+        where_shape, params = self._where_shape(where)
+        key = ('DELETE', table, tuple(using) if using else None, where_shape, order_by, limit)
+        return self._compiled(key, build, tuple(params))
+
+    def _compile_select(self, table, where, group_by, having, order_by, fields, page, page_num):
+        page, page_num = map(int, (page, page_num))
+
+        table = [table] if not isinstance(table, (list, tuple)) else table
+        limit, offset = [(None, None), (page_num, (page - 1) * page_num)][bool(page)]
+
+        def build():
+            sql_clauses = self.sql_clauses(fields, table, where, group_by, having, order_by, limit, offset)
+            clauses = [self.gen_clause(sql, val) for sql, val in sql_clauses if val is not None]
+            return SQLBuilder().join([clause for clause in clauses if clause])
+
+        def freeze(val):
+            # Only plain clauses are cacheable, SQLQuery or dict items are built every time.
+            if val is None or isinstance(val, (str, int)):
+                return val
+            if isinstance(val, (list, tuple)) and all(isinstance(v, str) for v in val):
+                return tuple(val)
+            raise TypeError('Uncacheable clause: %r' % (val,))
+
+        if where is not None and not isinstance(where, dict):
+            return build()
+        try:
+            clauses = tuple(freeze(val) for val in (table, fields, group_by, having, order_by))
+        except TypeError:
+            return build()
+        where_shape, params = self._where_shape(where or {})
+        key = ('SELECT', clauses, where_shape, limit, offset)
+        return self._compiled(key, build, tuple(params))
+
+    def _row_maker(self, description, row_factory=None):
+        """
+        Return the function building a row from a driver tuple, None keeps the tuple.
+        `row_factory` is the name of a ROW_FACTORIES entry or a callable which
+        takes `cursor.description` and returns such a function.
+        """
+        row_factory = row_factory or self.row_factory
+        if not callable(row_factory):
+            assert row_factory in ROW_FACTORIES, 'Wrong row factory: %s' % row_factory
+            row_factory = ROW_FACTORIES[row_factory]
+        return row_factory(description)
+
+    def sql_clauses(self, fields, tables, where, group, having, order, limit, offset):
+        return (
+            ('SELECT', fields),
+            ('FROM', tables),
+            ('WHERE', where),
+            ('GROUP BY', group),
+            ('HAVING', having),
+            ('ORDER BY', order),
             ('LIMIT', limit),
-            ('OFFFSET', offset)
+            ('OFFSET', offset)
         )
 
-    def gen_clause(self, sql, val):
-        if isinstance(val, int):
-            out = SQLQuery(val)
-        if sql == 'WHERE' and isinstance(val, dict):
-            out = self._where(val)
-        elif isinstance(val, (list, tuple)):
-            out = []
-            for item in val:
-                if isinstance(item, dict):
-                    out.append(self._where(item))
-                # elif isinstance(item, SQLQuery):
-                #     out.append(item)
-                # else:
-                #     raise Exception('Unknown SQL: %s' % str(item))
+    def gen_clause(self, sql, val):
+        """
+        Render one clause of a SELECT, e.g. ('WHERE', {'id__gt': 3}) to `WHERE id > %s`.
+        Lists are joined with AND in WHERE and HAVING, with commas elsewhere.
+        Returns an empty SQLBuilder if there is nothing to render.
+        """
+        out = SQLBuilder()
+        if isinstance(val, dict):
+            if sql not in ('WHERE', 'HAVING'):
+                raise Exception("Unknow SQL: %s %s" % (sql, str(val)))
+            where = self._where(val)
+            if where:
+                out.append(sql + ' ').append(where)
+        elif isinstance(val, (list, tuple)):
+            sep = ' AND ' if sql in ('WHERE', 'HAVING') else ', '
+            items = [self._where(item) if isinstance(item, dict) else item for item in val]
+            items = [item for item in items if item]
+            if items:
+                out.append(sql + ' ').join(items, sep)
+        elif isinstance(val, (int, str, SQLQuery, SQLBuilder)):
+            out.append(sql + ' ').append(val)
+        else:
+            raise Exception("Unknow SQL: %s %s" % (sql, str(val)))
+        return out
+
+
+def operation(method):
+    """
+    Wrap a public DB method for the concerns of a whole call: its deadline
+    (the `timeout` argument of the method, or the pool's `query_timeout`),
+    its admission when the pool has an admission controller, and the start of
+    the build phase of its statements when hooks are set. Nested calls and
+    calls in a transaction are not admitted again, and run within the deadline
+    of the outer call. A call returning an open ResultStream keeps its slot
+    until the stream is closed. A call failing outside a transaction or a
+    `connection()` scope never leaves a connection checked out by the context.
+    """
+    names = list(inspect.signature(method).parameters)
+    timeout_at = names.index('timeout') - 1 if 'timeout' in names else None
+
+    def run(self, ctx, args, kwargs):
+        if not self.hooks or ctx.get('mark') is not None:
+            return method(self, *args, **kwargs)
+        ctx.mark = time.perf_counter()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            ctx.mark = None
+
+    def admit(self, ctx, args, kwargs):
+        admission = self.admission
+        if admission is None or ctx.get('admitted') or self._scoped():
+            return run(self, ctx, args, kwargs)
+        priority, deadline = self._admission_scope.get() or (PRIORITY_NORMAL, None)
+        call_deadline = ctx.get('deadline')
+        if call_deadline is not None and (deadline is None or call_deadline < deadline):
+            deadline = call_deadline
+        admission.acquire(priority, deadline)
+        ctx.admitted = True
+        start = time.monotonic()
+        held = False
+        try:
+            out = run(self, ctx, args, kwargs)
+            if isinstance(out, ResultStream) and out.cursor is not None:
+                # The statement is in flight until the stream is closed.
+                out.on_close(lambda: admission.release(time.monotonic() - start))
+                held = True
+            return out
+        finally:
+            ctx.admitted = False
+            if not held:
+                admission.release(time.monotonic() - start)
+
+    def call(self, ctx, args, kwargs):
+        timeout = None
+        if timeout_at is not None:
+            timeout = args[timeout_at] if len(args) > timeout_at else kwargs.get('timeout')
+        if timeout is None and self.admission is None and not self.hooks and self.query_timeout is None:
+            return method(self, *args, **kwargs)
+
+        previous = ctx.get('deadline')
+        if timeout is None and previous is None:
+            timeout = self.query_timeout
+        if timeout is None:
+            return admit(self, ctx, args, kwargs)
+        deadline = time.monotonic() + timeout
+        if previous is not None and previous <= deadline:
+            return admit(self, ctx, args, kwargs)
+        ctx.deadline = deadline
+        try:
+            return admit(self, ctx, args, kwargs)
+        finally:
+            ctx.deadline = previous
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        ctx = self._enter()
+        try:
+            return call(self, ctx, args, kwargs)
+        except BaseException:
+            self._release_context()
+            raise
+        finally:
+            self._leave(ctx)
+    return wrapper
+
+
+class DB(SQLCompiler):
+    """Basic MySQL CRUD API"""
+
+    _instances = weakref.WeakSet()
+
+    def __init__(self, module, config, statement_cache_size=1024, row_factory='item', replicas=None,
+                 replica_strategy='round_robin', replica_sticky_window=1.0, max_replica_lag=None,
+                 replica_lag_check_interval=5.0, result_cache_bytes=0, result_cache_ttl=60.0, result_cache_ttls=None,
+                 hooks=None, admission=None, query_timeout=None, max_replica_wait=300.0):
+        """
+        :param
+            module: Module is the package like pymysql, MySQLdb etc.
+                    Create and connect to database server in local function.
+                    Wrap the DB Api to handle all kinds of Databases.
+            config: Config is the configuration of Database(host,passwd,port etc).
+            statement_cache_size: Max compiled statement shapes kept, 0 disables the cache.
+            row_factory: Default row type of queries, see `_row_maker`.
+            replicas: Configs of read replicas, merged over `config`. SELECTs outside
+                      transactions are sent to them.
+            replica_strategy: 'round_robin' or 'least_inflight'.
+            replica_sticky_window: Seconds after a write during which the reads
+                                   of the same context stay on the primary.
+            max_replica_lag: Skip replicas lagging more than that many seconds.
+            replica_lag_check_interval: Seconds between two lag checks of a replica.
+            result_cache_bytes: Memory bound of the results of `query(cache=True)`, 0 disables the cache.
+            result_cache_ttl: Seconds a cached result is served.
+            result_cache_ttls: Per table TTLs, e.g. {'country': 3600}.
+            hooks: QueryHook instances called around every statement, see `add_hook`.
+            admission: AdmissionController, or a dict of its arguments, capping the
+                       calls in flight. None admits every call.
+            query_timeout: Default `timeout` of the calls, in seconds, see `query`.
+            max_replica_wait: Seconds a batched write waits for lagging replicas
+                              between two batches before ReplicaLagTimeout.
+        """
+        super(DB, self).__init__(statement_cache_size=statement_cache_size, row_factory=row_factory)
+        self.module = module
+        self.config = config
+        # State of the context, see _Context, and the contexts' own settings.
+        self._state = contextvars.ContextVar('pysql_state_%x' % id(self), default=None)
+        self._last_write = contextvars.ContextVar('pysql_last_write_%x' % id(self), default=None)
+        self._admission_scope = contextvars.ContextVar('pysql_admission_scope_%x' % id(self), default=None)
+        self.hooks = list(hooks or [])
+        if isinstance(admission, dict):
+            admission = AdmissionController(**admission)
+        self.admission = admission
+        self.query_timeout = query_timeout
+        self.max_replica_wait = max_replica_wait
+        self._watchdog = None
+        # Sessions in autocommit mode don't need a COMMIT after each statement.
+        self.autocommit = bool(config.get('autocommit'))
+        if 'multi_statements' in config:
+            config = dict(config)
+            if config.pop('multi_statements'):
+                config['client_flag'] = config.get('client_flag', 0) | MULTI_STATEMENTS
+        # mincached, maxcached, maxconnections etc. go to the pool, the rest to the driver.
+        self.connection_pool, self.connect_config = ConnectionPool.from_config(module, config)
+
+        self.replica_sticky_window = replica_sticky_window
+        self.replicas = None
+        if replicas:
+            # Statements are compiled by the primary, replicas only run them.
+            replicas = [DB(module, dict(config, **replica), statement_cache_size=0, row_factory=row_factory)
+                        for replica in replicas]
+            for replica in replicas:
+                # add_hook changes the list in place, replicas see the hooks of the primary.
+                replica.hooks = self.hooks
+            self.replicas = ReplicaSet(replicas, replica_strategy, max_replica_lag, replica_lag_check_interval)
+
+        self._lock = threading.Lock()
+        self._write_batcher = None
+        self._transaction_counters = dict(commits=0, rollbacks=0, retries=0, aborts=0)
+        self.result_cache = None
+        if result_cache_bytes:
+            self.result_cache = ResultCache(result_cache_bytes, result_cache_ttl, result_cache_ttls)
+        DB._instances.add(self)
+
+    def _after_fork(self):
+        """
+        Drop the state inherited from the parent process, runs in a forked child.
+        The connection of the forking thread's context goes away with it,
+        unclosed, see `ConnectionPool._release`.
+        """
+        self._state.set(None)
+        self._lock = threading.Lock()
+        for owner in (self.statement_cache, self.result_cache):
+            if owner is not None:
+                owner._lock = threading.Lock()
+        if self.replicas is not None:
+            self.replicas._after_fork()
+        # Their threads are not forked, they are started again on first use.
+        self._watchdog = None
+        self._write_batcher = None
+        for owner in [self.admission] + self.hooks:
+            if hasattr(owner, '_after_fork'):
+                owner._after_fork()
+
+    @property
+    def _ctx(self):
+        """State of the current call, an empty read only one before the first call of the context"""
+        return self._state.get() or _IDLE
+
+    def _own_ctx(self):
+        """State of the current context, unless it was copied from another thread or task"""
+        ctx = self._state.get()
+        return ctx if ctx is not None and ctx.owned() else _IDLE
+
+    def _enter(self):
+        """Start a call in the current context, return the state it runs with"""
+        ctx = self._state.get()
+        if ctx is None or not ctx.owned():
+            ctx = _Context()
+            self._state.set(ctx)
+        ctx.calls += 1
+        return ctx
+
+    def _leave(self, ctx):
+        """End a call started by `_enter`, the state stays for the next one"""
+        ctx.calls -= 1
+
+    def _scoped(self):
+        """True if a transaction or a `connection()` scope holds the connection of the context"""
+        ctx = self._own_ctx()
+        return ctx.db is not None and bool(ctx.get('transactions') or ctx.get('scopes'))
+
+    @contextlib.contextmanager
+    def connection(self):
+        """
+        Run the calls of the current context in the block on one connection,
+        checked out on entry and given back on exit, even when the block raises:
+
+            with pool.connection() as conn:
+                pool.insert(table='t1', obj={'name': 'abc'})
+                rows = pool.query(table='t1')   # same connection, on the primary
+
+        The calls still commit their statements outside transactions. Scopes
+        nest, the outermost gives the connection back, and rolls back first if
+        the block raised or left a transaction open. Threads and asyncio tasks
+        started with a copy of the context (asyncio.create_task,
+        asyncio.to_thread) don't share the connection, they use their own.
+        """
+        admitted = False
+        if self.admission is not None and not self._scoped() and not self._own_ctx().get('admitted'):
+            # The scope holds one slot until it ends, like a transaction.
+            priority, deadline = self._admission_scope.get() or (PRIORITY_NORMAL, None)
+            self.admission.acquire(priority, deadline)
+            admitted = True
+        try:
+            ctx = self.ctx
+            conn = ctx.db
+            # A transaction open before the scope gives the connection back when it ends.
+            outer = ctx.transactions[0] if ctx.transactions else None
+            ctx.scopes = ctx.get('scopes', 0) + 1
+            failed = True
+            try:
+                yield conn
+                failed = False
+            finally:
+                ctx.scopes -= 1
+                if not ctx.scopes and ctx.get('db') is not None:
+                    try:
+                        if ctx.transactions:
+                            if ctx.transactions[0] is not outer:
+                                ctx.transactions[0].rollback()
+                        elif failed:
+                            ctx.rollback()
+                        else:
+                            self._unload_context(ctx)
+                    except Exception:
+                        # The error of the block goes up, not the one of the rollback.
+                        if not failed:
+                            raise
+        finally:
+            if admitted:
+                self.admission.release()
+
+    def _release_context(self):
+        """
+        Roll back and give back the connection of a failed call, unless a
+        transaction or a `connection()` scope holds it, so that no error path
+        leaves it checked out by the context.
+        """
+        ctx = self._ctx
+        if ctx.get('db') is not None and not ctx.get('transactions') and not ctx.get('scopes'):
+            try:
+                ctx.rollback()
+            except Exception:
+                pass
+
+    @operation
+    def _run_call(self, func, timeout=None):
+        """
+        Run `func()` as a call of the pool, for work done outside the public
+        methods (chunks of `iter_table`, `Batch.send`, group commits): it is
+        admitted and runs within `timeout` or the pool's `query_timeout`.
+        """
+        return func()
+
+    @contextlib.contextmanager
+    def _replica_call(self, replica):
+        """Run the block on `replica` within the deadline of the current call"""
+        rctx = replica._enter()
+        rctx.deadline = self._ctx.get('deadline')
+        try:
+            yield
+        finally:
+            rctx.deadline = None
+            replica._leave(rctx)
+
+    @contextlib.contextmanager
+    def admission_scope(self, priority=PRIORITY_NORMAL, timeout=None):
+        """
+        Priority class and queueing deadline of the calls of the current thread in the block:
+
+            with pool.admission_scope(PRIORITY_BATCH, timeout=0.5):
+                pool.insertmany(...)
+        """
+        token = self._admission_scope.set((priority, None if timeout is None else time.monotonic() + timeout))
+        try:
+            yield
+        finally:
+            self._admission_scope.reset(token)
+
+    def _getctx(self):
+        ctx = self._state.get()
+        if ctx is None or not ctx.owned():
+            ctx = _Context()
+            self._state.set(ctx)
+        if ctx.db is None:
+            self._load_context(ctx)
+        return ctx
+
+    ctx = property(_getctx)
+
+    def _load_context(self, ctx):
+        """Create a db connection"""
+        ctx.dbq_count = 0
+        ctx.transactions = []
+        ctx.db = self._connect(self.config)
+        ctx.written_tables = set()
+        ctx.autocommit = self.autocommit
+        ctx.begun = False
+        if 'commit' in ctx:
+            # Made once for the state, which is reused by the next calls of the context.
+            return
+
+        def begin():
+            # Sessions in autocommit mode need an explicit transaction.
+            ctx.db.cursor().execute('BEGIN')
+            ctx.begun = True
+
+        def commit(unload=True, committed=False):
+            # `committed`: the COMMIT was sent along with the statements.
+            try:
+                if not committed and (not self.autocommit or ctx.begun):
+                    ctx.db.commit()
+            except Exception:
+                rollback(unload)
+                raise
+            ctx.begun = False
+            if ctx.written_tables:
+                # Cached results are dropped once the writes are visible to other connections.
+                self.result_cache.invalidate(ctx.written_tables)
+                ctx.written_tables = set()
+            if unload and not ctx.get('scopes'):
+                self._unload_context(ctx)
+
+        def rollback(unload=True):
+            try:
+                ctx.db.rollback()
+            finally:
+                ctx.begun = False
+                ctx.written_tables = set()
+                # A `connection()` scope keeps its connection until it ends.
+                if unload and not ctx.get('scopes'):
+                    self._unload_context(ctx)
+
+        ctx.begin = begin
+        ctx.commit = commit
+        ctx.rollback = rollback
+
+    def _unload_context(self, ctx):
+        """Give db connection back to the connection pool"""
+        db = ctx.db
+        ctx.db = None
+        db.close()
+
+    def _connect(self, config):
+        """Check out a connection of the connection pool."""
+        return self.connection_pool.connection()
+
+    def _db_cursor(self):
+        """Get cursor from ctx.db"""
+        return self.ctx.db.cursor()
+
+    def _db_execute(self, cursor, sqlquery, finish=True):
+        """Execute a real sql query, see `_execute` for `finish`"""
+        self.ctx.dbq_count += 1
+        try:
+            if self.replicas is not None and not is_read_query(sqlquery.query()):
+                self._last_write.set(time.time())
+            out = self._execute(cursor, sqlquery, finish)
+        except Exception as e:
+            self._rollback_on_error(e)
+            raise e
+        return out
+
+    def _rollback_on_error(self, error):
+        """
+        Roll back after a failed statement: the innermost open transaction, all
+        of them after a deadlock since the server rolled back everything.
+        """
+        ctx = self.ctx
+        if not ctx.transactions:
+            ctx.rollback()
+        elif error_code(error) == ER_LOCK_DEADLOCK:
+            ctx.transactions[0].rollback()
+        else:
+            ctx.transactions[-1].rollback()
+
+    def _process_query(self, sqlquery):
+        """Separate sql and params from sqlquery"""
+        query = sqlquery.query()
+        params = sqlquery.values() or None  # None because of api `execute(sql, params=None)`
+        return query, params
+
+    def add_hook(self, hook):
+        """Call `hook`, a QueryHook, around every statement of the pool and its replicas"""
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def _execute(self, cursor, sqlquery, finish=True):
+        """
+        Execute `sqlquery` on `cursor` and report it to the hooks. With hooks and
+        `finish=False` the QueryEvent is left in `self._ctx.event`, the caller
+        adds the fetch and convert phases and passes it to `_finish_event`.
+        """
+        if not self.hooks:
+            return self._driver_execute(cursor, *self._process_query(sqlquery))
+
+        start = time.perf_counter()
+        mark = self._ctx.get('mark')
+        query, params = self._process_query(sqlquery)
+        event = QueryEvent(query, params, start)
+        begin = time.perf_counter()
+        event.build = begin - (start if mark is None else mark)
+        for hook in self.hooks:
+            hook.before_execute(event)
+
+        begin = time.perf_counter()
+        try:
+            out = self._driver_execute(cursor, query, params)
+        except Exception as e:
+            event.execute = time.perf_counter() - begin
+            event.error = e
+            for hook in self.hooks:
+                hook.on_error(event, e)
+            raise
+        event.execute = time.perf_counter() - begin
+        event.rowcount = cursor.rowcount
+        if finish:
+            self._finish_event(event)
+        else:
+            self._ctx.event = event
+        return out
+
+    def _driver_execute(self, cursor, query, params):
+        """Execute on the driver, within the deadline of the call if it has one"""
+        deadline = self._ctx.get('deadline')
+        if deadline is None:
+            return cursor.execute(query, params)
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise QueryTimeout('Deadline passed before the statement: %s' % query)
+        if is_read_query(query):
+            # The server stops the SELECT itself, nothing to clean up.
+            hint = 'SELECT /*+ MAX_EXECUTION_TIME(%d) */' % max(int(remaining * 1000), 1)
+            try:
+                return cursor.execute(_SELECT_KEYWORD.sub(hint, query, count=1), params)
+            except Exception as e:
+                if error_code(e) == ER_QUERY_TIMEOUT:
+                    raise QueryTimeout('SELECT ran past the deadline of its call: %s' % query)
+                raise
+
+        conn = cursor.connection
+        watchdog = self._get_watchdog()
+        watch = watchdog.watch(deadline, self._connection_id(conn))
+        try:
+            out = cursor.execute(query, params)
+        except Exception as e:
+            if watchdog.cancel(watch) and error_code(e) == ER_QUERY_INTERRUPTED:
+                raise QueryTimeout('Statement killed at the deadline of its call: %s' % query)
+            raise
+        if watchdog.cancel(watch):
+            # Done as the KILL was sent, it may hit the next statement: don't reuse the connection.
+            # The statement did complete (and may be committed), so its result is returned.
+            self.connection_pool.mark_broken(conn)
+        return out
+
+    def _get_watchdog(self):
+        if self._watchdog is None:
+            with self._lock:
+                if self._watchdog is None:
+                    self._watchdog = Watchdog(self._kill_query)
+        return self._watchdog
+
+    def _connection_id(self, conn):
+        """Server id of a driver connection, `thread_id()` of pymysql and MySQLdb"""
+        thread_id = getattr(conn, 'thread_id', None)
+        if thread_id is not None:
+            return thread_id() if callable(thread_id) else thread_id
+        cursor = conn.cursor()
+        cursor.execute('SELECT CONNECTION_ID()')
+        return cursor.fetchone()[0]
+
+    def _kill_query(self, connection_id):
+        """Stop the statement of `connection_id`, on a connection out of the pool, which may be exhausted"""
+        conn = self.module.connect(**self.connect_config)
+        try:
+            conn.cursor().execute('KILL QUERY %d' % int(connection_id))
+        finally:
+            conn.close()
+
+    def _remaining(self):
+        """Seconds left before the deadline of the current call, or None"""
+        deadline = self._ctx.get('deadline')
+        return None if deadline is None else deadline - time.monotonic()
+
+    def _finish_event(self, event):
+        if self._ctx.get('mark') is not None:
+            # The next statement of the call is built from now on.
+            self._ctx.mark = time.perf_counter()
+        for hook in self.hooks:
+            hook.after_execute(event)
+
+    def _fetch_rows(self, cursor, make_row, event, batch_size=1000):
+        """
+        Rows of an instrumented query, timing the fetch and convert phases of
+        `event`. Rows are read `batch_size` at a time like without hooks, so the
+        event is reported once the rows are exhausted or dropped.
+        """
+        fetch = convert = 0.0
+        try:
+            while True:
+                start = time.perf_counter()
+                rows = cursor.fetchmany(batch_size)
+                fetch += time.perf_counter() - start
+                if not rows:
+                    return
+                if make_row is not None:
+                    start = time.perf_counter()
+                    rows = [make_row(row) for row in rows]
+                    convert += time.perf_counter() - start
+                for row in rows:
+                    yield row
+        finally:
+            event.fetch = fetch
+            if make_row is not None:
+                event.convert = convert
+            self._finish_event(event)
+
+    @operation
+    def insert(self, table, obj={}, mode='INSERT', dup={}):
+        """
+        Insert data into table with INSERT, REPLACE and INSERT_IGNORE mode.
+        :param
+            table: table name
+            obj: data inserted to table
+            mode: INSERT, REPLACE, INSERT_IGNORE mode
+            dup: duplicate if data exists, a dict of the values set in the existing
+                 row, or a list of columns set to the inserted values.
+        """
+        sqlquery = self._compile_insert(table, obj, mode, dup)
+
+        cursor = self._db_cursor()
+        self._db_execute(cursor, sqlquery)
+        self._written(table)
+        # The driver reads the insert id off the OK packet, no SELECT last_insert_id() needed.
+        out = cursor.lastrowid or None
+
+        if not self.ctx.transactions:
+            self.ctx.commit()
+        return out
+
+    @operation
+    def insertmany(self, table, objs=[], mode='INSERT', dup={}, chunk_size=1000, chunk_bytes=None, atomic=False):
+        """
+        Insert rows with multiple-row INSERT statements of up to `chunk_size` rows
+        and about `chunk_bytes` bytes.
+        :param
+            objs: Any iterable of dicts with the same keys, consumed chunk by chunk.
+            chunk_bytes: Defaults to half of the server's max_allowed_packet.
+            atomic: Insert every chunk in one transaction, otherwise each chunk
+                    is committed on its own. Ignored in a transaction.
+        :return: InsertIds of the rows, None if there is no row.
+        """
+        if not objs:
+            return None
+
+        settings = self.server_settings()
+        if chunk_bytes is None:
+            # Escaping may make values longer than estimated.
+            chunk_bytes = settings.max_allowed_packet // 2
+        increment = settings.auto_increment_increment
+
+        out = InsertIds()
+        keys = None
+        try:
+            if atomic:
+                self._begin_unless_transaction()
+            for chunk in self._insert_chunks(objs, chunk_size, chunk_bytes):
+                if keys is None:
+                    keys = chunk[0].keys()
+                elif chunk[0].keys() != keys:
+                    raise ValueError("Not all rows have the same keys")
+
+                sqlquery = self._compile_insertmany(table, chunk, mode, dup)
+                cursor = self._db_cursor()
+                self._db_execute(cursor, sqlquery)
+                self._written(table)
+                rowcount, first = cursor.rowcount, cursor.lastrowid
+                # Ids are known if every row got one: IGNORE skips rows, REPLACE counts
+                # replaced rows twice. ON DUPLICATE KEY UPDATE counts updated rows twice
+                # and unchanged rows not at all, so the two may cancel out.
+                if first and rowcount == len(chunk) and not dup:
+                    out.add(len(chunk), range(first, first + len(chunk) * increment, increment))
+                else:
+                    out.add(len(chunk), None)
+
+                if not atomic and not self.ctx.transactions:
+                    self.ctx.commit()
+        except Exception:
+            if atomic and self._ctx.get('db') is not None and not self._ctx.transactions:
+                self.ctx.rollback()
+            raise
+
+        if atomic and self._ctx.get('db') is not None and not self._ctx.transactions:
+            self.ctx.commit()
+        return out if out.chunks else None
+
+    @operation
+    def updatemany(self, table, rows, key='id', method='case', chunk_size=1000, chunk_bytes=None):
+        """
+        Update many rows with their own values, one statement and one transaction
+        per chunk of `chunk_size` rows (and about `chunk_bytes` bytes).
+        :param
+            rows: Iterable of dicts holding the key columns and the columns to set.
+            key: Column name or tuple of column names identifying a row.
+            method: 'case' renders `UPDATE .. SET c = CASE key WHEN .. END WHERE key IN (..)`.
+                    'upsert' renders `INSERT .. ON DUPLICATE KEY UPDATE c = VALUES(c)`, it
+                    inserts missing rows and needs rows of the same columns.
+        :return: Affected rows in total. MySQL counts an upserted row twice when it is
+                 updated and not at all when its values don't change.
+        """
+        assert method in ('case', 'upsert'), 'Wrong updatemany method: %s' % method
+        keys = [key] if isinstance(key, str) else list(key)
+        if chunk_bytes is None:
+            chunk_bytes = self.server_settings().max_allowed_packet // 2
+
+        rowcount = 0
+        for chunk in self._insert_chunks(rows, chunk_size, chunk_bytes):
+            for row in chunk:
+                assert all(k in row for k in keys), 'Key %s missing in %r' % (key, row)
+            if method == 'case':
+                sqlquery = self._compile_updatemany(table, chunk, keys)
+            else:
+                columns = [column for column in sorted(chunk[0]) if column not in keys]
+                sqlquery = self._compile_insertmany(table, chunk, 'INSERT', columns)
+            cursor = self._db_cursor()
+            self._db_execute(cursor, sqlquery)
+            self._written(table)
+            rowcount += cursor.rowcount
+            if not self.ctx.transactions:
+                self.ctx.commit()
+        return rowcount
+
+    def _insert_chunks(self, objs, chunk_size, chunk_bytes):
+        """Split `objs` into lists of up to `chunk_size` rows and about `chunk_bytes` bytes"""
+        chunk, size = [], 0
+        for obj in objs:
+            row_size = len(obj) + 2 + sum(encoded_size(value) for value in obj.values())
+            if chunk and (len(chunk) >= chunk_size or size + row_size > chunk_bytes):
+                yield chunk
+                chunk, size = [], 0
+            chunk.append(obj)
+            size += row_size
+        if chunk:
+            yield chunk
+
+    def _begin_unless_transaction(self):
+        """Open a transaction on autocommit sessions for statements committed together"""
+        ctx = self.ctx
+        if self.autocommit and not ctx.transactions and not ctx.begun:
+            ctx.begin()
+
+    def server_settings(self):
+        """
+        auto_increment_increment and max_allowed_packet of the server, read once.
+        Errors go up and the settings are read again on the next call.
+        """
+        settings = getattr(self, '_server_settings', None)
+        if settings is None:
+            rows = self._query(SQLQuery('SELECT @@auto_increment_increment, @@max_allowed_packet'),
+                               row_factory='tuple', use_primary=True)
+            try:
+                increment, packet = map(int, next(rows))
+            finally:
+                # With hooks the rows are a generator, closing it finishes the event of the statement.
+                close = getattr(rows, 'close', None)
+                if close is not None:
+                    close()
+            settings = Item(auto_increment_increment=increment, max_allowed_packet=packet)
+            self._server_settings = settings
+        return settings
+
+    @operation
+    def bulk_load(self, table, rows, columns=None, mode='INSERT', via=None, chunk_rows=100000, timeout=None):
+        """
+        Stream rows into a table with LOAD DATA LOCAL INFILE, much faster than INSERT.
+        The driver must allow it (`local_infile: true` in the config).
+        :param
+            rows: Any iterable of dicts or of sequences ordered like `columns`.
+            columns: Columns loaded, defaults to the keys of the first dict.
+            mode: INSERT, REPLACE or INSERT_IGNORE, like `insert`. LOAD DATA LOCAL
+                  skips duplicates in INSERT mode too, they are reported as warnings.
+            via: 'pipe' streams the rows through a named pipe in one statement,
+                 'file' loads temporary files of `chunk_rows` rows. Defaults to
+                 'pipe' where named pipes exist.
+            timeout: Seconds for the whole load, defaults to the pool's `query_timeout`.
+        :return: Item of the rows sent, the rows loaded and the warnings.
+        """
+        assert mode.upper() in LOAD_DATA_MODES, 'Wrong load mode: %s' % mode
+        rows = iter(rows)
+        first = next(rows, None)
+        out = Item(sent=0, loaded=0, warnings=0)
+        if first is None:
+            return out
+        if columns is None:
+            assert isinstance(first, dict), 'columns are required to load sequences'
+            columns = sorted(first)
+
+        def count(rows):
+            for row in rows:
+                out.sent += 1
+                yield row
+
+        lines = load_data_lines(count(itertools.chain([first], rows)), columns,
+                                self.connect_config.get('charset', 'utf8'))
+        via = via or ('pipe' if hasattr(os, 'mkfifo') else 'file')
+        assert via in ('pipe', 'file'), 'Wrong load method: %s' % via
+
+        tmpdir = tempfile.mkdtemp(prefix='pysql-load-')
+        try:
+            self._begin_unless_transaction()
+            if via == 'pipe':
+                loads = [self._load_pipe(table, columns, mode, lines, os.path.join(tmpdir, 'rows'))]
+            else:
+                loads = (self._load_file(table, columns, mode, chunk, os.path.join(tmpdir, 'rows'))
+                         for chunk in iter(lambda: list(itertools.islice(lines, chunk_rows)), []))
+            for loaded, warnings in loads:
+                out.loaded += loaded
+                out.warnings += warnings
+        except Exception:
+            if self._ctx.get('db') is not None and not self._ctx.transactions:
+                self.ctx.rollback()
+            raise
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+        if not self.ctx.transactions:
+            self.ctx.commit()
+        return out
+
+    def _load_data(self, table, columns, mode, path):
+        """Run LOAD DATA LOCAL INFILE of `path`, return the rows loaded and the warnings"""
+        sqlquery = SQLBuilder('LOAD DATA LOCAL INFILE ').param(path)
+        sqlquery.append('%s INTO TABLE %s CHARACTER SET %s (%s)' % (
+            LOAD_DATA_MODES[mode.upper()], table, self.connect_config.get('charset', 'utf8'), ','.join(columns)))
+        cursor = self._db_cursor()
+        self._db_execute(cursor, sqlquery)
+        self._written(table)
+        loaded = cursor.rowcount
+        self._db_execute(cursor, SQLQuery('SELECT @@warning_count'))
+        return loaded, int(cursor.fetchone()[0])
+
+    def _load_file(self, table, columns, mode, lines, path):
+        with open(path, 'wb') as f:
+            f.writelines(lines)
+        return self._load_data(table, columns, mode, path)
+
+    def _load_pipe(self, table, columns, mode, lines, path):
+        """Load `lines` written by a thread into the named pipe `path` while the driver reads it"""
+        os.mkfifo(path, 0o600)
+        errors = []
+        stop = threading.Event()
+
+        def feed():
+            try:
+                # A blocking open would wait forever if the driver never opens the pipe.
+                while True:
+                    try:
+                        fd = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+                        break
+                    except OSError as e:
+                        # ENXIO: no reader yet.
+                        if e.errno != errno.ENXIO or stop.is_set():
+                            raise
+                        stop.wait(0.001)
+                os.set_blocking(fd, True)
+                with open(fd, 'wb', buffering=1 << 20) as f:
+                    f.writelines(lines)
+            except BrokenPipeError:
+                # The driver stopped reading, its error is raised by the statement.
+                pass
+            except Exception as e:
+                if not stop.is_set():
+                    errors.append(e)
+
+        writer = threading.Thread(target=feed, name='pysql-bulk-load')
+        writer.daemon = True
+        writer.start()
+        try:
+            out = self._load_data(table, columns, mode, path)
+        finally:
+            stop.set()
+            # The writer ends at once unless a driver holding the pipe open stopped reading.
+            writer.join(5.0)
+        if errors:
+            # The server saw a truncated file, the caller rolls the load back.
+            raise errors[0]
+        return out
+
+    @operation
+    def update(self, table, where={}, obj={}, batch_size=None, pk='id', sleep=0, max_replica_lag=None,
+               progress=None, timeout=None):
+        """
+        Update Tables
+        :param where: The condition
+        :param obj: The part needed to be updated
+        :param batch_size: Update the rows `batch_size` at a time in `pk` order, each
+                           batch in its own transaction, see `_throttle` for `sleep`,
+                           `max_replica_lag` and `progress`.
+        :param timeout: Seconds for the whole call, see `query`.
+        """
+        if batch_size:
+            return self._update_batches(table, where, obj, batch_size, pk, sleep, max_replica_lag, progress)
+
+        query = self._compile_update(table, where, obj)
+        cursor = self._db_cursor()
+        self._db_execute(cursor, query)
+        self._written(table)
+        if not self.ctx.transactions:
+            self.ctx.commit()
+        return cursor.rowcount
+
+    @operation
+    def delete(self, table, where={}, using=None, batch_size=None, pk='id', sleep=0, max_replica_lag=None,
+               progress=None, timeout=None):
+        """
+        Delete from table
+        :param table: list[t1, t2, t3, ...] or t
+        :param where: The condition
+        :param using: The condition
+        :param batch_size: Run `DELETE .. ORDER BY pk LIMIT batch_size` until no row is
+                           left, each batch in its own transaction, see `_throttle` for
+                           `sleep`, `max_replica_lag` and `progress`.
+        :param timeout: Seconds for the whole call, see `query`.
+        :return:
+        """
+        if batch_size:
+            assert not using, 'Batched deletes take a single table'
+            assert not self._ctx.get('transactions'), 'Batched deletes commit, they cannot run in a transaction'
+            query = self._compile_delete(table, where, None, order_by=pk, limit=batch_size)
+            total = 0
+            while True:
+                cursor = self._db_cursor()
+                self._db_execute(cursor, query)
+                self._written(table)
+                self.ctx.commit()
+                total += cursor.rowcount
+                if cursor.rowcount < batch_size:
+                    break
+                self._throttle(total, sleep, max_replica_lag, progress)
+            if progress is not None:
+                progress(total)
+            return total
+
+        query = self._compile_delete(table, where, using)
+        cursor = self._db_cursor()
+        self._db_execute(cursor, query)
+        self._written(table)
+        if not self.ctx.transactions:
+            self.ctx.commit()
+        return cursor.rowcount
+
+    def _update_batches(self, table, where, obj, batch_size, pk, sleep, max_replica_lag, progress):
+        """
+        Update the rows in `pk` ranges of `batch_size` rows. Updated rows may still
+        match `where`, so the statement is not repeated but walks the key:
+        `WHERE .. AND pk > <previous bound> AND pk <= <bound>`, the bound is the
+        `batch_size`th key after the previous bound.
+        """
+        assert not self._ctx.get('transactions'), 'Batched updates commit, they cannot run in a transaction'
+
+        def narrow(where, key, value, pick):
+            where = dict(where)
+            where[key] = pick(where[key], value) if key in where else value
+            return where
+
+        total, low = 0, None
+        while True:
+            batch_where = where if low is None else narrow(where, pk + '__gt', low, max)
+            bound = self._compile_select(table, batch_where, None, None, pk, [pk], batch_size, 1)
+            high = next(self._query(bound, row_factory='tuple', use_primary=True), None)
+            if high is not None:
+                batch_where = narrow(batch_where, pk + '__lte', high[0], min)
+
+            cursor = self._db_cursor()
+            self._db_execute(cursor, self._compile_update(table, batch_where, obj))
+            self._written(table)
+            self.ctx.commit()
+            total += cursor.rowcount
+            if high is None:
+                break
+            low = high[0]
+            self._throttle(total, sleep, max_replica_lag, progress)
+        if progress is not None:
+            progress(total)
+        return total
+
+    def _throttle(self, total, sleep=0, max_replica_lag=None, progress=None):
+        """
+        Pause between two batches of a batched write.
+        :param total: Rows written so far, passed to `progress(total)`.
+        :param sleep: Seconds to sleep.
+        :param max_replica_lag: Wait while a replica lags more than that many seconds,
+                                up to `max_replica_wait`. Replicas of unknown lag
+                                (stopped, or unable to tell) are not waited for.
+        """
+        if progress is not None:
+            progress(total)
+        if sleep:
+            remaining = self._remaining()
+            if remaining is not None and remaining < sleep:
+                raise QueryTimeout('Deadline passed after %d rows' % total)
+            time.sleep(sleep)
+        if max_replica_lag is not None and self.replicas is not None:
+            replicas = self.replicas
+            give_up = time.monotonic() + self.max_replica_wait
+            # A batched write may wait, it checks the lags itself.
+            replicas.check()
+            while any(max_replica_lag < replicas.lag(replica) < float('inf') for replica in replicas.replicas):
+                remaining = self._remaining()
+                if remaining is not None and remaining <= 0:
+                    raise QueryTimeout('Deadline passed waiting for replicas after %d rows' % total)
+                if time.monotonic() >= give_up:
+                    raise ReplicaLagTimeout('Replicas lagged over %ss for %ss after %d rows'
+                                            % (max_replica_lag, self.max_replica_wait, total))
+                time.sleep(min(replicas.lag_check_interval, 1.0, max(give_up - time.monotonic(), 0)))
+                replicas.check()
+
+    def batch(self):
+        """Return a Batch sending the statements queued in its block together"""
+        return Batch(self)
+
+    def write_batcher(self, max_delay=None, max_ops=None):
+        """
+        Return the WriteBatcher of the pool, created on first use, which group
+        commits writes of all threads. `max_delay` and `max_ops` (default 0.005
+        and 100) apply on creation, later calls giving others raise ValueError.
+        """
+        with self._lock:
+            batcher = self._write_batcher
+            if batcher is None:
+                batcher = self._write_batcher = WriteBatcher(
+                    self, 0.005 if max_delay is None else max_delay, 100 if max_ops is None else max_ops)
+            elif (max_delay not in (None, batcher.max_delay)) or (max_ops not in (None, batcher.max_ops)):
+                raise ValueError('The WriteBatcher exists with max_delay=%s, max_ops=%s'
+                                 % (batcher.max_delay, batcher.max_ops))
+            return batcher
+
+    def _written(self, table):
+        """Invalidate the cached results of `table` on the next commit"""
+        if self.result_cache is not None:
+            self.ctx.written_tables.update(table_names(table))
+
+    @operation
+    def query(self, table, where={}, group_by=None, having=None, order_by=None, fields=['*'], page=0, page_num=10,
+              stream=False, batch_size=1000, row_factory=None, use_primary=False, cache=False, timeout=None):
+        """
+        :param table: List[t1, t2, t3, ...] or t
+        :param where: The condition
+        :param group_by: make data into groups.
+        :param having: The condition
+        :param order_by: Sort Data
+        :param fields: Select fields from table
+        :param page: Default 0 means all data.
+        :param page_num: data each page
+        :param stream: Read rows with an unbuffered server side cursor, returns a ResultStream.
+        :param batch_size: Rows fetched per round in stream mode.
+        :param row_factory: 'item', 'tuple', 'record' or a callable, defaults to the pool's.
+        :param use_primary: Don't send the query to a replica.
+        :param cache: Serve the rows from the result cache, or cache them. Ignored in
+                      stream mode, in transactions and if the pool has no result cache.
+        :param timeout: Seconds for the whole call, defaults to the pool's `query_timeout`.
+                        SELECTs carry a MAX_EXECUTION_TIME hint, other statements are
+                        stopped with KILL QUERY, and QueryTimeout is raised. Every
+                        statement of the call shares the budget.
+        :return:
+        """
+        sqlquery = self._compile_select(table, where, group_by, having, order_by, fields, page, page_num)
+        if cache and self.result_cache is not None and not stream and not self._ctx.get('transactions'):
+            return self._cached_query(table, sqlquery, row_factory, use_primary)
+        return self._query(sqlquery, stream=stream, batch_size=batch_size, row_factory=row_factory,
+                           use_primary=use_primary)
+
+    @operation
+    def query_columns(self, table, where={}, group_by=None, having=None, order_by=None, fields=['*'], page=0,
+                      page_num=10, batch_size=10000, use_numpy=None, use_primary=False, timeout=None):
+        """
+        Query like `query`, but gather the result by column into typed buffers,
+        fetched `batch_size` rows at a time from a server side cursor.
+        :param use_numpy: Build NumPy arrays, defaults to True if NumPy is installed,
+                          otherwise integer and float columns are array.array.
+        :param use_primary: Don't send the query to a replica.
+        :param timeout: Seconds for the call, defaults to the pool's `query_timeout`.
+        :return: ColumnSet
+        """
+        numpy = import_numpy() if use_numpy is not False else None
+        if use_numpy and numpy is None:
+            raise ImportError('Unable to import numpy')
+
+        sqlquery = self._compile_select(table, where, group_by, having, order_by, fields, page, page_num)
+        replica = self._replica_for(sqlquery, use_primary)
+        if replica is not None:
+            self.replicas.begin(replica)
+        try:
+            if replica is not None:
+                with self._replica_call(replica):
+                    rows = replica._stream(sqlquery, batch_size, row_factory='tuple')
+            else:
+                rows = self._stream(sqlquery, batch_size, row_factory='tuple')
+        except BaseException:
+            if replica is not None:
+                self.replicas.end(replica)
+            raise
+        if replica is not None:
+            rows.on_close(functools.partial(self.replicas.end, replica))
+
+        with rows:
+            description = rows.cursor.description if rows.cursor is not None else None
+            if not description:
+                return ColumnSet([], {}, {}, 0)
+
+            names = [x[0] for x in description]
+            buffers = []
+            for x in description:
+                typecode = 'q' if x[1] in INT_FIELD_TYPES else 'd' if x[1] in FLOAT_FIELD_TYPES else None
+                buffers.append(ColumnBuffer(typecode, numpy))
+
+            rowcount = 0
+            for batch in rows.batches():
+                rowcount += len(batch)
+                for buf, values in zip(buffers, zip(*batch)):
+                    buf.extend(values)
+
+        columns, nulls = {}, {}
+        for name, buf in zip(names, buffers):
+            columns[name], nulls[name] = buf.finish()
+        return ColumnSet(names, columns, nulls, rowcount)
+
+    def iter_table(self, table, where={}, key='id', chunk_size=1000, fields=['*'], desc=False, chunks=False,
+                   row_factory=None, use_primary=False, timeout=None):
+        """
+        Walk a table in `key` order with keyset pagination: each chunk is read by
+        `WHERE key > <last key> ORDER BY key LIMIT chunk_size`, so every chunk
+        costs the same, unlike OFFSET paging. Outside a transaction one connection
+        is used for the whole walk, each chunk is read in its own transaction.
+        :param key: Column name or tuple of column names of a unique (composite) key.
+        :param desc: Walk in descending key order.
+        :param chunks: Yield lists of rows instead of rows.
+        :param timeout: Seconds for each chunk, defaults to the pool's `query_timeout`.
+                        Each chunk is admitted on its own, not the whole walk.
+        """
+        keys = [key] if isinstance(key, str) else list(key)
+        fields = list(fields)
+        if '*' not in fields:
+            fields += [k for k in keys if k not in fields]
+        order_by = ', '.join(k + ' DESC' for k in keys) if desc else ', '.join(keys)
+
+        def compile(last):
+            conditions = [where or {}]
+            if last is not None:
+                conditions.append(self._keyset_where(keys, last, desc))
+            return self._compile_select(table, conditions, None, None, order_by, fields, 1, chunk_size)
+
+        # Where the walk runs is decided by the call, not by the first `next()`.
+        in_transaction = self._scoped()
+        db = None if in_transaction else self._replica_for(compile(None), use_primary) or self
+        return self._walk_table(db, compile, keys, chunk_size, chunks, row_factory, timeout)
+
+    def _walk_table(self, db, compile, keys, chunk_size, chunks, row_factory, timeout=None):
+        """Generator of `iter_table`, on `db`'s own connection, or in the transaction if `db` is None"""
+        in_transaction = db is None
+        conn = self.ctx.db if in_transaction else db._connect(db.config)
+
+        def read(sqlquery):
+            cursor = conn.cursor()
+            if in_transaction:
+                self._db_execute(cursor, sqlquery)
+            elif db is self:
+                self._execute(cursor, sqlquery)
+            else:
+                with self._replica_call(db):
+                    db._execute(cursor, sqlquery)
+            rows = cursor.fetchall()
+            if not in_transaction:
+                conn.commit()
+            return cursor, rows
+
+        ok = False
+        try:
+            last, indexes, make_row = None, None, None
+            while True:
+                # The rows are read between the `next()` calls, each chunk is a call of its own.
+                cursor, rows = self._run_call(functools.partial(read, compile(last)), timeout)
+                if not rows:
+                    break
+                if indexes is None:
+                    # Result columns are not qualified by their table.
+                    names = [x[0] for x in cursor.description]
+                    indexes = [names.index(k.split('.')[-1]) for k in keys]
+                    make_row = self._row_maker(cursor.description, row_factory)
+                last = tuple(rows[-1][i] for i in indexes)
+                if make_row is not None:
+                    rows = list(map(make_row, rows))
+                if chunks:
+                    yield rows
                 else:
-                    out.append(item)
-            if sql == 'SELECT':
-                out = SQLQuery.join(out, ' AND ')
+                    for row in rows:
+                        yield row
+                if len(rows) < chunk_size:
+                    break
+            ok = True
+        finally:
+            if not in_transaction:
+                if not ok:
+                    try:
+                        conn.rollback()
+                    except Exception:
+                        pass
+                conn.close()
+
+    def _keyset_where(self, keys, values, desc=False):
+        """
+        Condition of the rows after `values` in `keys` order, e.g. for keys (a, b):
+        `(a > %s OR (a = %s AND b > %s))`
+        """
+        operator = ' < ' if desc else ' > '
+        out = SQLBuilder('(')
+        for i in range(len(keys)):
+            if i != 0:
+                out.append(' OR ')
+            if i:
+                out.append('(')
+                for j in range(i):
+                    out.append(keys[j] + ' = ').param(values[j]).append(' AND ')
+            out.append(keys[i] + operator).param(values[i])
+            if i:
+                out.append(')')
+        return out.append(')')
+
+    def _cached_query(self, table, sqlquery, row_factory=None, use_primary=False):
+        """Rows of `sqlquery` from the result cache, run it on a miss"""
+        cache = self.result_cache
+        tables = table_names(table)
+        try:
+            # where dicts are compiled in key order, so the statement is the normalized shape.
+            key = (sqlquery.query(), tuple(sqlquery.values() or ()))
+            result = cache.get(key)
+        except TypeError:
+            return self._query(sqlquery, row_factory=row_factory, use_primary=use_primary)
+
+        if result is None:
+            generation = cache.generation(tables)
+            # A replica may not have replayed a recent write yet, its rows would be served for the whole TTL.
+            populate = self.replicas is None or use_primary or self._replicas_caught_up(tables)
+            descriptions = []
+
+            def capture(description):
+                descriptions.append(description)
+                return None
+
+            rows = self._query(sqlquery, row_factory=capture, use_primary=use_primary)
+            if not descriptions:
+                return rows
+            result = (descriptions[0], list(rows))
+            if populate:
+                cache.put(key, tables, result, generation)
+
+        description, rows = result
+        make_row = self._row_maker(description, row_factory)
+        return iter(rows) if make_row is None else map(make_row, rows)
+
+    def _replicas_caught_up(self, tables):
+        """
+        True if every replica has replayed the last invalidation of `tables`:
+        it is older than the sticky window and the known lag of each replica.
+        """
+        invalidated = self.result_cache.invalidated_at(tables)
+        if invalidated is None:
+            return True
+        replicas = self.replicas
+        replicas._start_checker()
+        lag = max(replicas.lag(replica) for replica in replicas.replicas)
+        return time.time() - invalidated > max(lag, self.replica_sticky_window)
+
+    def _replica_for(self, sqlquery, use_primary=False):
+        """
+        Return the replica to run `sqlquery` on, or None for the primary: writes,
+        locking reads, transactions, `connection()` scopes and reads shortly
+        after a write of the same context stay on the primary.
+        """
+        if self.replicas is None or use_primary:
+            return None
+        if self._scoped():
+            return None
+        last_write = self._last_write.get()
+        if last_write is not None and time.time() - last_write < self.replica_sticky_window:
+            return None
+        if not is_read_query(sqlquery.query()):
+            return None
+        return self.replicas.choose()
+
+    def _query(self, sqlquery, stream=False, batch_size=1000, row_factory=None, use_primary=False):
+        replica = self._replica_for(sqlquery, use_primary)
+        if replica is not None:
+            self.replicas.begin(replica)
+            try:
+                with self._replica_call(replica):
+                    out = replica._query(sqlquery, stream, batch_size, row_factory or self.row_factory)
+            except BaseException:
+                self.replicas.end(replica)
+                raise
+            if isinstance(out, ResultStream):
+                # A stream keeps the replica busy until it is closed.
+                out.on_close(functools.partial(self.replicas.end, replica))
+            else:
+                self.replicas.end(replica)
+            return out
+
+        if stream:
+            return self._stream(sqlquery, batch_size, row_factory)
+
+        cursor = self._db_cursor()
+        self._db_execute(cursor, sqlquery, finish=False)
+        event = self._ctx.pop('event', None) if self.hooks else None
+
+        if cursor.description:
+            make_row = self._row_maker(cursor.description, row_factory)
+            if event is not None:
+                out = self._fetch_rows(cursor, make_row, event)
             else:
-                out = SQLQuery.join(out, ',')
-        elif isinstance(val, SQLQuery):
-            out = val
+                rows = iter(cursor.fetchone, None)
+                out = rows if make_row is None else map(make_row, rows)
         else:
-            raise Exception("Unknow SQL: %s %s" % (sql, str(val)))
+            out = cursor.rowcount
+            if event is not None:
+                self._finish_event(event)
+
+        if not self.ctx.transactions:
+            self.ctx.commit()
+        return out
 
-        def xjoin(a, b):
-            if a and b: return a + ' ' + b
-            else: return ' '
-        return xjoin(sql, out)
+    def _ss_cursorclass(self):
+        """Return the unbuffered cursor class of the driver (SSCursor of pymysql, MySQLdb), or None"""
+        cursors = getattr(self.module, 'cursors', None)
+        return getattr(cursors, 'SSCursor', None)
 
-    def execute(self, sql):
+    def _stream(self, sqlquery, batch_size, row_factory=None):
+        """
+        Execute `sqlquery` with an unbuffered cursor. Outside a transaction the
+        stream checks out its own connection, and gives it back when it is closed.
+        """
+        cursorclass = self._ss_cursorclass()
+        if self._scoped():
+            # Inside a transaction or a `connection()` scope the stream shares its
+            # connection, so it must be consumed before the next statement.
+            cursor = self.ctx.db.cursor(cursorclass) if cursorclass else self.ctx.db.cursor()
+            self._db_execute(cursor, sqlquery)
+            return ResultStream(cursor, batch_size, make_row=self._stream_row_maker(cursor, row_factory))
+
+        db = self._connect(self.config)
+        try:
+            cursor = db.cursor(cursorclass) if cursorclass else db.cursor()
+            self._execute(cursor, sqlquery)
+        except Exception as e:
+            db.rollback()
+            db.close()
+            raise e
+
+        def release():
+            try:
+                db.commit()
+            finally:
+                db.close()
+
+        return ResultStream(cursor, batch_size, release, self._stream_row_maker(cursor, row_factory))
+
+    def _stream_row_maker(self, cursor, row_factory):
+        if cursor.description:
+            return self._row_maker(cursor.description, row_factory)
+        return None
+
+    @operation
+    def execute(self, sql, stream=False, batch_size=1000, row_factory=None, use_primary=False, timeout=None):
         """
         Execute raw sql
+        :param stream: Read rows with an unbuffered server side cursor, returns a ResultStream.
+        :param batch_size: Rows fetched per round in stream mode.
+        :param row_factory: 'item', 'tuple', 'record' or a callable, defaults to the pool's.
+        :param use_primary: Don't send a SELECT to a replica.
+        :param timeout: Seconds for the statement, see `query`.
+        """
+        sqlquery = SQLBuilder(sql)
+        return self._query(sqlquery, stream=stream, batch_size=batch_size, row_factory=row_factory,
+                           use_primary=use_primary)
+
+    def transaction(self, retries=0, backoff=0.01, max_backoff=1.0):
+        """
+        Return a Transaction of the current thread, see `Transaction`:
+
+            with pool.transaction():
+                ...
+
+            @pool.transaction(retries=3)
+            def transfer(src, dst, amount):
+                ...
+        :param
+            retries: Times the decorated function is replayed after a deadlock
+                     or a lock wait timeout.
+            backoff: Seconds of the first backoff, doubled by each retry and jittered.
+            max_backoff: Upper bound of a backoff.
         """
-        sqlquery = SQLQuery(sql)
-        return self._query(sqlquery)
+        return Transaction(self, retries, backoff, max_backoff)
+
+    def _count_transaction(self, name):
+        with self._lock:
+            self._transaction_counters[name] += 1
 
-    def transaction(self):
-        return Transaction(self.ctx)
+    def transaction_stats(self):
+        """Counters of top level transactions: commits, rollbacks, retries and aborts (out of retries)"""
+        with self._lock:
+            return Item(self._transaction_counters)
 
 
 class Transaction(object):
     """
-    Database Transaction: wrap ctx and commit transactions
+    Database Transaction of the current thread, nested transactions use savepoints.
+    It begins when the block is entered (or on `begin()`), commits at the end of
+    the block and rolls back on an exception.
+
+    Used as a decorator, or with `run(func)`, the function is called in a new
+    transaction and replayed on a deadlock or a lock wait timeout, `retries`
+    times at most, after a jittered exponential backoff. A `with` block cannot
+    be replayed, it only rolls back. Nested transactions are never replayed on
+    their own, the error goes up to the outermost one.
     """
 
-    def __init__(self, ctx):
-        self.ctx = ctx
+    def __init__(self, db, retries=0, backoff=0.01, max_backoff=1.0):
+        self.db = db
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.ctx = None
+        self.engine = None
+        self.transaction_count = None
+        self.finished = False
+        self._admitted = False
+
+    def begin(self):
+        assert self.ctx is None, 'Transaction already begun'
+        db = self.db
+        if db.admission is not None and not db._scoped() and not db._own_ctx().get('admitted'):
+            # A top level transaction holds one slot until it ends, its statements are not admitted again.
+            priority, deadline = db._admission_scope.get() or (PRIORITY_NORMAL, None)
+            db.admission.acquire(priority, deadline)
+            self._admitted = True
+        try:
+            self._begin()
+        except Exception:
+            self._release_admission()
+            raise
+        return self
+
+    def _release_admission(self):
+        if self._admitted:
+            self._admitted = False
+            self.db.admission.release()
+
+    def _begin(self):
+        self.ctx = ctx = self.db.ctx
         self.transaction_count = transaction_count = len(ctx.transactions)
+        savepoint = 'sp_%d' % transaction_count
 
         class TransactionEngine(object):
             """Transaction Engine used in top level transaction"""
             def do_transact(self):
                 ctx.commit(unload=False)
+                if ctx.autocommit:
+                    ctx.begin()
 
             def do_commit(self):
                 ctx.commit()
@@ -692,17 +4011,17 @@ class Transaction(object):
                 Transaction Engine used in sub transaction.
             """
             def query(self, q):
-                cursor = ctx.db.cursor()
-                ctx.db_execute(cursor, SQLQuery(q % transaction_count))
+                ctx.dbq_count += 1
+                ctx.db.cursor().execute(q % savepoint)
 
             def do_transact(self):
-                self.query('SAVEPOINT point_%s')
+                self.query('SAVEPOINT %s')
 
             def do_commit(self):
-                self.query('RELEASE SAVEPOINT point_%s')
+                self.query('RELEASE SAVEPOINT %s')
 
             def do_rollback(self):
-                self.query('ROLLBACK TO SAVEPIONT sp_%s')
+                self.query('ROLLBACK TO SAVEPOINT %s')
 
 
         class DummyEngine(object):
@@ -725,6 +4044,416 @@ class Transaction(object):
         self.engine.do_transact()
         self.ctx.transactions.append(self)
 
+    def commit(self):
+        if self.finished:
+            return
+        transactions = self.ctx.transactions
+        assert transactions and transactions[-1] is self, 'Inner transactions must finish first'
+        transactions.pop()
+        self.finished = True
+        try:
+            self.engine.do_commit()
+        except Exception:
+            if not self.transaction_count and self.db._ctx.get('db') is not None:
+                self.ctx.rollback()
+            raise
+        finally:
+            self._release_admission()
+        if not self.transaction_count:
+            self.db._count_transaction('commits')
+
+    def rollback(self):
+        if self.finished:
+            return
+        transactions = self.ctx.transactions
+        # Inner transactions still open end with this one.
+        while transactions and transactions[-1] is not self:
+            transactions.pop().finished = True
+        if transactions:
+            transactions.pop()
+        self.finished = True
+        try:
+            self.engine.do_rollback()
+        finally:
+            self._release_admission()
+        if not self.transaction_count:
+            self.db._count_transaction('rollbacks')
+
+    def __enter__(self):
+        return self.begin()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+        return False
+
+    def run(self, func, *args, **kwargs):
+        """Call `func` in a new transaction, replayed on lock errors, return its result"""
+        db = self.db
+        for attempt in itertools.count():
+            tx = Transaction(db, self.retries, self.backoff, self.max_backoff)
+            try:
+                with tx:
+                    return func(*args, **kwargs)
+            except Exception as e:
+                if error_code(e) not in RETRY_ERRORS or tx.transaction_count:
+                    raise
+                if attempt >= self.retries:
+                    db._count_transaction('aborts')
+                    raise
+            db._count_transaction('retries')
+            time.sleep(random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt)))
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            return self.run(func, *args, **kwargs)
+        return wrapper
+
+
+class _Write(object):
+    """A write queued in a WriteBatcher"""
+
+    __slots__ = ['kind', 'table', 'args', 'future']
+
+    def __init__(self, kind, table, args):
+        self.kind = kind
+        self.table = table
+        self.args = args
+        self.future = Future()
+
+    def merge_key(self):
+        """Consecutive writes of the same key are sent as one multi-row INSERT"""
+        if self.kind != 'insert':
+            return None
+        obj, mode, dup = self.args
+        if mode.upper() != 'INSERT' or dup:
+            return None
+        return (self.table, tuple(sorted(obj)))
+
+
+class WriteBatcher(object):
+    """
+    Group commit of writes from many threads: writes are queued, a thread runs
+    up to `max_ops` of them, or those queued within `max_delay` seconds of the
+    first, in one transaction on its own connection. Consecutive plain inserts
+    into the same table and columns are merged into a multi-row INSERT. Every
+    write returns a Future of its insert id or rowcount:
+
+        batcher = pool.write_batcher()
+        insert_id = batcher.insert(table='t1', obj={'name': 'abc'}).result()
+
+    If the transaction fails, the writes of the batch are run again one by one,
+    so only the failing write gets the error.
+    """
+
+    def __init__(self, db, max_delay=0.005, max_ops=100):
+        self.db = db
+        self.max_delay = max_delay
+        self.max_ops = max_ops
+        self.batches = 0
+        self.writes = 0
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='pysql-write-batcher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _put(self, write):
+        with self._cond:
+            if self._closed:
+                raise PoolError('WriteBatcher is closed')
+            self._queue.append(write)
+            if len(self._queue) == 1 or len(self._queue) >= self.max_ops:
+                self._cond.notify()
+        return write.future
+
+    def insert(self, table, obj={}, mode='INSERT', dup={}):
+        """Queue an insert, the future gives the insert id"""
+        return self._put(_Write('insert', table, (obj, mode, dup)))
+
+    def update(self, table, where={}, obj={}):
+        """Queue an update, the future gives the rowcount"""
+        return self._put(_Write('update', table, (where, obj)))
+
+    def delete(self, table, where={}, using=None):
+        """Queue a delete, the future gives the rowcount"""
+        return self._put(_Write('delete', table, (where, using)))
+
+    def flush(self):
+        """Wait until the writes queued so far are committed"""
+        with self._cond:
+            last = self._queue[-1].future if self._queue else None
+        if last is not None:
+            try:
+                last.result()
+            except Exception:
+                pass
+
+    def close(self):
+        """Commit the queued writes and stop the thread"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._closed:
+                    self._cond.wait()
+                if not self._queue:
+                    return
+                deadline = time.monotonic() + self.max_delay
+                while len(self._queue) < self.max_ops and not self._closed:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = [self._queue.popleft() for _ in range(min(len(self._queue), self.max_ops))]
+            self._commit(batch)
+
+    def _commit(self, batch):
+        try:
+            self.db._run_call(functools.partial(self._commit_batch, batch))
+        except BaseException as e:
+            # The thread goes on, no future of the batch is left waiting.
+            for write in batch:
+                if not write.future.done():
+                    write.future.set_exception(e)
+            if not isinstance(e, Exception):
+                raise
+
+    def _commit_batch(self, batch):
+        db = self.db
+        increment = None
+        if any(write.kind == 'insert' for write in batch):
+            # Read before the checkout: on a pool of one connection a second one would never come.
+            increment = db.server_settings().auto_increment_increment
+        conn = db._connect(db.config)
+        try:
+            try:
+                results = self._execute(conn, batch, increment)
+                conn.commit()
+            except Exception:
+                self._rollback(conn)
+                results = None
+
+            if results is None:
+                # Find the failing writes, the others are committed one by one.
+                for write in batch:
+                    try:
+                        result = self._execute(conn, [write], increment)[0]
+                        conn.commit()
+                    except Exception as e:
+                        self._rollback(conn)
+                        write.future.set_exception(e)
+                    else:
+                        write.future.set_result(result)
+            else:
+                for write, result in zip(batch, results):
+                    write.future.set_result(result)
+        finally:
+            conn.close()
+
+        self.batches += 1
+        self.writes += len(batch)
+        if db.result_cache is not None:
+            db.result_cache.invalidate(set(name for write in batch for name in table_names(write.table)))
+
+    @staticmethod
+    def _rollback(conn):
+        # The error of the write is the one reported.
+        try:
+            conn.rollback()
+        except Exception:
+            pass
+
+    def _execute(self, conn, batch, increment):
+        """Run the writes of `batch` on `conn`, return their results"""
+        db = self.db
+        cursor = conn.cursor()
+        if db.autocommit:
+            # Sessions in autocommit mode need an explicit transaction, or each write commits on its own.
+            cursor.execute('BEGIN')
+        results = []
+        for key, group in itertools.groupby(batch, key=lambda write: write.merge_key() or id(write)):
+            group = list(group)
+            write = group[0]
+            if len(group) > 1:
+                sqlquery = db._compile_insertmany(write.table, [w.args[0] for w in group], 'INSERT', {})
+            elif write.kind == 'insert':
+                sqlquery = db._compile_insert(write.table, *write.args)
+            elif write.kind == 'update':
+                sqlquery = db._compile_update(write.table, *write.args)
+            else:
+                sqlquery = db._compile_delete(write.table, *write.args)
+            db._execute(cursor, sqlquery)
+
+            if write.kind != 'insert':
+                results.append(cursor.rowcount)
+            elif len(group) > 1:
+                results.extend(cursor.lastrowid + i * increment for i in range(len(group)))
+            else:
+                results.append(cursor.lastrowid)
+        return results
+
+
+class Batch(object):
+    """
+    Statements queued and sent together when the block ends, each call returns
+    a Future of its insert id, InsertIds or rowcount:
+
+        with pool.batch() as b:
+            insert = b.insert(table='t1', obj={'name': 'abc'})
+            b.update(table='t1', where={'id': 3}, obj={'age': 11})
+        print(insert.result())
+
+    When the connection allows multiple statements (`multi_statements: true` in
+    the config, beware that raw `execute` strings then allow stacked queries)
+    the statements and the COMMIT go in one round-trip, otherwise they run one
+    after another and are committed once. With `autocommit: true` sessions no
+    COMMIT is sent and each statement is committed on its own. In a transaction
+    the statements are part of it.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self._queue = []  # (kind, table, sqlquery, rows, future)
+
+    def _put(self, kind, table, sqlquery, rows=1):
+        future = Future()
+        self._queue.append((kind, table, sqlquery, rows, future))
+        return future
+
+    def insert(self, table, obj={}, mode='INSERT', dup={}):
+        return self._put('insert', table, self.db._compile_insert(table, obj, mode, dup))
+
+    def insertmany(self, table, objs=[], mode='INSERT', dup={}):
+        objs = list(objs)
+        # The rowcount of ON DUPLICATE KEY UPDATE doesn't tell whether every row got an id.
+        kind = 'upsertmany' if dup else 'insertmany'
+        return self._put(kind, table, self.db._compile_insertmany(table, objs, mode, dup), len(objs))
+
+    def update(self, table, where={}, obj={}):
+        return self._put('update', table, self.db._compile_update(table, where, obj))
+
+    def delete(self, table, where={}, using=None):
+        return self._put('delete', table, self.db._compile_delete(table, where, using))
+
+    def execute(self, sql):
+        return self._put('execute', None, SQLBuilder(sql))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.send()
+        else:
+            self._fail(exc_value)
+        return False
+
+    def _fail(self, error):
+        queue, self._queue = self._queue, []
+        for kind, table, sqlquery, rows, future in queue:
+            if not future.done():
+                future.set_exception(error)
+
+    def send(self):
+        """Send the queued statements, resolve their futures"""
+        if self._queue:
+            self.db._run_call(self._send)
+
+    def _send(self):
+        db = self.db
+        increment = None
+        if any(kind == 'insertmany' for kind, table, sqlquery, rows, future in self._queue):
+            # Read before the statements run, their futures can't fail once they are committed.
+            try:
+                increment = db.server_settings().auto_increment_increment
+            except Exception as e:
+                self._fail(e)
+                raise
+        ctx = db.ctx
+        in_transaction = bool(ctx.transactions)
+        cursor = db._db_cursor()
+        multi = bool(getattr(ctx.db, 'client_flag', 0) & MULTI_STATEMENTS) and hasattr(cursor, 'mogrify')
+        commit = multi and not in_transaction and not db.autocommit
+        try:
+            if multi:
+                try:
+                    results = self._send_multi(cursor, commit)
+                except Exception as e:
+                    # `_db_execute` rolls back on errors, not `_execute`.
+                    if db._ctx.get('db') is not None:
+                        db._rollback_on_error(e)
+                    raise
+            else:
+                results = []
+                for kind, table, sqlquery, rows, future in self._queue:
+                    db._db_execute(cursor, sqlquery)
+                    results.append((cursor.rowcount, cursor.lastrowid))
+        except Exception as e:
+            self._fail(e)
+            raise
+
+        for kind, table, sqlquery, rows, future in self._queue:
+            if table is not None:
+                db._written(table)
+        if not in_transaction:
+            ctx.commit(committed=commit)
+
+        queue, self._queue = self._queue, []
+        for (kind, table, sqlquery, rows, future), (rowcount, lastrowid) in zip(queue, results):
+            if kind == 'insert':
+                future.set_result(lastrowid or None)
+            elif kind in ('insertmany', 'upsertmany'):
+                ids = InsertIds()
+                ids.add(rows, range(lastrowid, lastrowid + rows * increment, increment)
+                        if kind == 'insertmany' and lastrowid and rowcount == rows else None)
+                future.set_result(ids)
+            else:
+                future.set_result(rowcount)
+
+    def _send_multi(self, cursor, commit):
+        """Send every statement in one round-trip, return their (rowcount, lastrowid)"""
+        db = self.db
+        statements = [cursor.mogrify(*db._process_query(sqlquery)) for kind, table, sqlquery, rows, future
+                      in self._queue]
+        if commit:
+            statements.append('COMMIT')
+        if db.replicas is not None:
+            db._last_write.set(time.time())
+        db.ctx.dbq_count += 1
+        db._execute(cursor, CompiledQuery(';\n'.join(statements), ()))
+        results = []
+        for i in range(len(self._queue)):
+            if i:
+                cursor.nextset()
+            results.append((cursor.rowcount, cursor.lastrowid))
+        if commit:
+            cursor.nextset()
+        return results
+
+
+def _after_fork_in_child():
+    """
+    Make the pools usable in a child forked by a preforking server: the pools
+    and contexts created in the parent, e.g. by gunicorn --preload, are reset.
+    """
+    for db in list(DB._instances):
+        db._after_fork()
+    for pool in list(ConnectionPool._instances):
+        pool._after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
 
 class SQLPool(DB):
     """
@@ -736,8 +4465,22 @@ class SQLPool(DB):
 
         config['port'] = int(config['port'])
         config['charset'] = config.get('charset', 'utf8')
-
-        super(SQLPool, self).__init__(module, config)
+        options = {}
+        for key in ('statement_cache_size', 'row_factory', 'replicas', 'replica_strategy',
+                    'replica_sticky_window', 'max_replica_lag', 'replica_lag_check_interval',
+                    'result_cache_bytes', 'result_cache_ttl', 'result_cache_ttls', 'hooks', 'admission',
+                    'query_timeout', 'max_replica_wait'):
+            if key in config:
+                options[key] = config.pop(key)
+        for replica in options.get('replicas') or []:
+            if 'port' in replica:
+                replica['port'] = int(replica['port'])
+
+        super(SQLPool, self).__init__(module, config, **options)
+        # Open mincached connections now, so the first queries don't pay for connecting.
+        self.connection_pool.warmup()
+        for replica in self.replicas.replicas if self.replicas else []:
+            replica.connection_pool.warmup()
 
         # self.support_multiple_insert = True
 
@@ -751,4 +4494,5 @@ def import_driver(drivers):
             return __import__(driver)
         except ImportError:
             pass
-    raise ImportError('Unable to import ' + ' or '.join(drivers))
\ No newline at end of file
+    raise ImportError('Unable to import ' + ' or '.join(drivers))
+
@@ -0,0 +1,290 @@
+# coding: utf-8
+"""
+Horizontal sharding over several pools with the CRUD API of SQLPool.
+
+    pool = ShardedPool([SQLPool(**config0), SQLPool(**config1)], shard_key='user_id')
+    pool.insert(table='t1', obj={'user_id': 7, 'name': 'abc'})   # one shard
+    pool.query(table='t1', where={'user_id__in': [1, 2, 7]})     # the shards holding 1, 2 and 7
+    pool.query(table='t1', order_by='id DESC', page=1)            # every shard, merged
+
+Statements pinning the shard key (`key`, `key__eq` or `key__in`) go to the
+shards owning the values, the others are scattered to every shard on a
+thread pool. Sorted results are merged shard by shard (k-way merge over
+streams) instead of being concatenated in memory. GROUP BY, HAVING and
+aggregates are evaluated per shard.
+"""
+
+import contextvars
+import functools
+import heapq
+import itertools
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+
+def default_shard_func(value, count):
+    """Shard index of `value`: integers modulo `count`, anything else by crc32"""
+    if isinstance(value, int):
+        return value % count
+    if not isinstance(value, bytes):
+        value = str(value).encode('utf-8')
+    return zlib.crc32(value) % count
+
+
+@functools.total_ordering
+class _Desc(object):
+    """Sort key wrapper inverting the order, for DESC columns"""
+
+    __slots__ = ['value']
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+
+def parse_order_by(order_by):
+    """
+    Parse an ORDER BY clause to (column, descending) pairs.
+        >>> parse_order_by('age DESC, t1.id')
+        [('age', True), ('id', False)]
+    """
+    if isinstance(order_by, (list, tuple)):
+        order_by = ', '.join(order_by)
+    assert isinstance(order_by, str), 'Cannot merge shards ordered by %r' % (order_by,)
+
+    out = []
+    for term in order_by.split(','):
+        words = term.split()
+        assert 1 <= len(words) <= 2, 'Cannot merge shards ordered by %r' % term
+        direction = words[1].upper() if len(words) == 2 else 'ASC'
+        assert direction in ('ASC', 'DESC'), 'Wrong order direction: %s' % term
+        # Result columns are not qualified by their table.
+        out.append((words[0].split('.')[-1].strip('`'), direction == 'DESC'))
+    return out
+
+
+def _sort_key(order, row, names):
+    """
+    Sort key of `row` for `order`, NULLs first like MySQL. Mappings are read by
+    name, sequences (tuple and record rows) by the index in `names`.
+    """
+    key = []
+    for name, desc in order:
+        value = row[name] if isinstance(row, dict) else row[names.index(name)]
+        value = (value is not None, value)
+        key.append(_Desc(value) if desc else value)
+    return key
+
+
+class MergedResult(object):
+    """
+    Rows of a query scattered to several shards. Each shard is read by a server
+    side cursor, the shards hold their connections until the rows are exhausted
+    or the result is closed.
+    """
+
+    def __init__(self, streams, order=None, offset=0, limit=None):
+        self.streams = streams
+        self._rows = self._merge(streams, order, offset, limit)
+
+    def _merge(self, streams, order, offset, limit):
+        streams = [s for s in streams if not isinstance(s, int)]
+        if order:
+            iterables = []
+            for no, stream in enumerate(streams):
+                names = [d[0] for d in stream.cursor.description] if stream.cursor is not None else []
+                key = functools.partial(_sort_key, order, names=names)
+                iterables.append(((key(row), no, row) for row in stream))
+            # The stream number breaks ties, rows themselves are never compared.
+            rows = (row for key, no, row in heapq.merge(*iterables))
+        else:
+            rows = itertools.chain.from_iterable(streams)
+        stop = None if limit is None else offset + limit
+        try:
+            for row in itertools.islice(rows, offset, stop):
+                yield row
+        finally:
+            self.close()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._rows)
+
+    next = __next__
+
+    def close(self):
+        """Close every shard stream and give the connections back"""
+        for stream in self.streams:
+            if not isinstance(stream, int):
+                stream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class ShardedPool(object):
+    """Route the CRUD API of SQLPool to shards by the value of `shard_key`"""
+
+    def __init__(self, shards, shard_key, shard_func=default_shard_func, max_workers=None):
+        """
+        :param
+            shards: DB or SQLPool instances, one per shard.
+            shard_key: Column deciding the shard of a row.
+            shard_func: Takes a shard key value and the number of shards, returns the shard index.
+            max_workers: Threads scattering statements, defaults to one per shard.
+        """
+        assert shards, 'No shard'
+        self.shards = list(shards)
+        self.shard_key = shard_key
+        self.shard_func = shard_func
+        self.executor = ThreadPoolExecutor(max_workers=max_workers or len(self.shards))
+
+    def shard_for(self, value):
+        """Return the index of the shard owning shard key `value`"""
+        index = self.shard_func(value, len(self.shards))
+        assert 0 <= index < len(self.shards), 'Wrong shard %r of %r' % (index, value)
+        return index
+
+    def _route(self, where):
+        """
+        Return {shard index: where} of the shards a where dict touches. `key__in`
+        lists are narrowed to the values each shard owns.
+        """
+        where = where or {}
+        key = self.shard_key
+        for name in (key, key + '__eq', key + '__EQ'):
+            if name in where:
+                return {self.shard_for(where[name]): where}
+
+        for name in (key + '__in', key + '__IN'):
+            if name in where:
+                values = {}
+                for value in where[name]:
+                    values.setdefault(self.shard_for(value), []).append(value)
+                return dict((index, dict(where, **{name: vals})) for index, vals in values.items())
+
+        return dict((index, where) for index in range(len(self.shards)))
+
+    def _scatter(self, calls):
+        """
+        Run {shard index: function of the shard}, return {shard index: result}.
+        The calls run in copies of the caller's context, with its admission scopes.
+        """
+        if len(calls) == 1:
+            (index, call), = calls.items()
+            return {index: call(self.shards[index])}
+        futures = dict((index, self.executor.submit(contextvars.copy_context().run, call, self.shards[index]))
+                       for index, call in calls.items())
+        results, error = {}, None
+        for index, future in futures.items():
+            try:
+                results[index] = future.result()
+            except Exception as e:
+                error = error or e
+        if error is not None:
+            # Give back the connections of the streams opened by the other shards.
+            for result in results.values():
+                if hasattr(result, 'close'):
+                    result.close()
+            raise error
+        return results
+
+    def insert(self, table, obj={}, mode='INSERT', dup={}):
+        assert self.shard_key in obj, 'Shard key %s missing in %r' % (self.shard_key, obj)
+        return self.shards[self.shard_for(obj[self.shard_key])].insert(table, obj, mode, dup)
+
+    def insertmany(self, table, objs=[], mode='INSERT', dup={}):
+        """
+        Insert the rows with one batch per shard, the batches run in parallel.
+        `objs` is any iterable of dicts, read once. Returns the insert ids in
+        the order of `objs`, ids are per shard.
+        """
+        rows, positions = {}, {}
+        count = 0
+        for pos, obj in enumerate(objs):
+            assert self.shard_key in obj, 'Shard key %s missing in %r' % (self.shard_key, obj)
+            index = self.shard_for(obj[self.shard_key])
+            rows.setdefault(index, []).append(obj)
+            positions.setdefault(index, []).append(pos)
+            count += 1
+        if not count:
+            return None
+
+        calls = dict((index, functools.partial(lambda shard, rows: shard.insertmany(table, rows, mode, dup),
+                                               rows=shard_rows))
+                     for index, shard_rows in rows.items())
+        results = self._scatter(calls)
+
+        out = [None] * count
+        for index, ids in results.items():
+            if ids is None:
+                continue
+            for pos, insert_id in zip(positions[index], ids):
+                out[pos] = insert_id
+        return out
+
+    def update(self, table, where={}, obj={}, timeout=None):
+        """Update the shards the where dict touches, return the total rowcount"""
+        assert self.shard_key not in obj, 'Rows cannot move between shards'
+        calls = dict((index, functools.partial(lambda shard, where: shard.update(table, where, obj, timeout=timeout),
+                                               where=where))
+                     for index, where in self._route(where).items())
+        return sum(self._scatter(calls).values())
+
+    def delete(self, table, where={}, using=None, timeout=None):
+        """Delete from the shards the where dict touches, return the total rowcount"""
+        calls = dict((index, functools.partial(lambda shard, where: shard.delete(table, where, using, timeout=timeout),
+                                               where=where))
+                     for index, where in self._route(where).items())
+        return sum(self._scatter(calls).values())
+
+    def query(self, table, where={}, group_by=None, having=None, order_by=None, fields=['*'], page=0, page_num=10,
+              stream=False, batch_size=1000, row_factory=None, use_primary=False, cache=False, timeout=None):
+        """
+        Same arguments as `DB.query`. A query pinned to one shard runs there,
+        otherwise each shard returns its first `page * page_num` rows in
+        `order_by` order and they are merged. Returns a MergedResult when
+        several shards are read, it is a stream of rows. `cache` only applies
+        to queries pinned to one shard, `timeout` to the statement of each shard.
+        """
+        routes = self._route(where)
+        if len(routes) == 1:
+            (index, where), = routes.items()
+            return self.shards[index].query(table, where, group_by, having, order_by, fields, page, page_num,
+                                            stream, batch_size, row_factory, use_primary, cache, timeout)
+
+        order = parse_order_by(order_by) if order_by else None
+        page, page_num = int(page), int(page_num)
+        # Any shard may hold every row of the page, each shard is read up to its end.
+        shard_page, shard_page_num = (1, page * page_num) if page else (0, page_num)
+
+        def call(shard, where):
+            return shard.query(table, where, group_by, having, order_by, fields, shard_page, shard_page_num,
+                               True, batch_size, row_factory, use_primary, timeout=timeout)
+
+        calls = dict((index, functools.partial(call, where=where)) for index, where in routes.items())
+        results = self._scatter(calls)
+        streams = [results[index] for index in sorted(results)]
+        offset, limit = ((page - 1) * page_num, page_num) if page else (0, None)
+        return MergedResult(streams, order, offset, limit)
+
+    def execute(self, sql, row_factory=None, timeout=None):
+        """Execute raw sql on every shard, return the results in shard order"""
+        calls = dict((index, lambda shard: shard.execute(sql, row_factory=row_factory, timeout=timeout))
+                     for index in range(len(self.shards)))
+        results = self._scatter(calls)
+        return [results[index] for index in range(len(self.shards))]
+
+    def close(self):
+        """Stop the scatter threads"""
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,95 @@
+# coding: utf-8
+"""
+asyncio stand-in for an async MySQL driver such as aiomysql, built on test.fakedb.
+Statements run in worker threads so waiting for a lock does not block the loop.
+"""
+
+import asyncio
+
+from test import fakedb
+from test.fakedb import (Error, InterfaceError, DatabaseError, OperationalError,  # noqa: F401
+                         IntegrityError, ProgrammingError, NotSupportedError)
+
+
+async def connect(host='127.0.0.1', port=3306, db='test', user=None, password=None, **kwargs):
+    await asyncio.sleep(0)
+    return Connection(fakedb.connect(host=host, port=port, db=db))
+
+
+class Connection(object):
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    @property
+    def host(self):
+        return self._conn.host
+
+    @property
+    def open(self):
+        return self._conn.open
+
+    async def cursor(self, cursorclass=None):
+        cursorclass = cursorclass or Cursor
+        return cursorclass(self._conn.cursor(cursorclass.sync_class))
+
+    async def commit(self):
+        await asyncio.to_thread(self._conn.commit)
+
+    async def rollback(self):
+        await asyncio.to_thread(self._conn.rollback)
+
+    async def ping(self, reconnect=False):
+        self._conn.ping()
+
+    def close(self):
+        self._conn.close()
+
+    async def ensure_closed(self):
+        self._conn.close()
+
+
+class Cursor(object):
+
+    sync_class = fakedb.Cursor
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    @property
+    def connection(self):
+        return self._cursor.connection
+
+    @property
+    def description(self):
+        return self._cursor.description
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    @property
+    def lastrowid(self):
+        return self._cursor.lastrowid
+
+    async def execute(self, query, args=None):
+        # Statements may wait for locks, keep the event loop running meanwhile.
+        return await asyncio.to_thread(self._cursor.execute, query, args)
+
+    async def fetchone(self):
+        return self._cursor.fetchone()
+
+    async def fetchmany(self, size=None):
+        await asyncio.sleep(0)
+        return self._cursor.fetchmany(size)
+
+    async def fetchall(self):
+        return self._cursor.fetchall()
+
+    async def close(self):
+        self._cursor.close()
+
+
+class SSCursor(Cursor):
+
+    sync_class = fakedb.SSCursor
@@ -0,0 +1,513 @@
+# coding: utf-8
+"""
+In-process stand-in for a MySQL DB API module such as pymysql or MySQLdb,
+so pysql can be tested without a server:
+
+    >>> from test import fakedb
+    >>> pool = DB(fakedb, {'host': 'primary', 'db': 'bar'})
+
+Every (host, port, db) is a separate sqlite database. The MySQL dialect used by
+pysql (`%s` markers, INSERT IGNORE, last_insert_id() ...) is translated to sqlite.
+All executed statements are recorded in `fakedb.statements`.
+"""
+
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+import threading
+import weakref
+
+
+apilevel = '2.0'
+threadsafety = 1
+paramstyle = 'format'
+
+# (host, sql, params) of every executed statement.
+statements = []
+
+DEFAULT_VARIABLES = {
+    'auto_increment_increment': 1,
+    'max_allowed_packet': 4 << 20,
+    'warning_count': 0,
+}
+
+# Server variables read by `SELECT @@name`.
+variables = dict(DEFAULT_VARIABLES)
+
+# Canned results: (host or None, compiled pattern, column names, rows or callable).
+_responses = []
+
+_lock = threading.Lock()
+_tmpdir = None
+_connection_ids = iter(range(1, 1 << 62))
+# Open connections by id, for KILL QUERY.
+_connections = weakref.WeakValueDictionary()
+# (pid, connection id, method) of connections used by a process other than the
+# one which opened them, e.g. a forked child: they share the parent's session.
+shared_uses = []
+
+
+class Error(Exception):
+    pass
+
+
+class InterfaceError(Error):
+    pass
+
+
+class DatabaseError(Error):
+    pass
+
+
+class OperationalError(DatabaseError):
+    pass
+
+
+class IntegrityError(DatabaseError):
+    pass
+
+
+class ProgrammingError(DatabaseError):
+    pass
+
+
+class NotSupportedError(DatabaseError):
+    pass
+
+
+# MySQL client capability flags, see pymysql.constants.CLIENT
+class CLIENT(object):
+    MULTI_STATEMENTS = 1 << 16
+
+
+# MySQL field types, see pymysql.constants.FIELD_TYPE
+class FIELD_TYPE(object):
+    DOUBLE = 5
+    NULL = 6
+    LONGLONG = 8
+    BLOB = 252
+    VAR_STRING = 253
+
+
+def _field_type(value):
+    if isinstance(value, bool) or isinstance(value, int):
+        return FIELD_TYPE.LONGLONG
+    if isinstance(value, float):
+        return FIELD_TYPE.DOUBLE
+    if isinstance(value, bytes):
+        return FIELD_TYPE.BLOB
+    if value is None:
+        return FIELD_TYPE.NULL
+    return FIELD_TYPE.VAR_STRING
+
+
+def reset():
+    """Drop every database, canned results and recorded statements"""
+    global _tmpdir
+    with _lock:
+        if _tmpdir is not None:
+            shutil.rmtree(_tmpdir, ignore_errors=True)
+            _tmpdir = None
+        del statements[:]
+        del shared_uses[:]
+        del _responses[:]
+        variables.clear()
+        variables.update(DEFAULT_VARIABLES)
+
+
+def respond(pattern, names, rows, host=None):
+    """
+    Answer statements matching the regex `pattern` (on `host`, or any host) with
+    canned `rows` of columns `names`. `rows` may be a callable taking
+    (connection, sql, params), and raise an exception to emulate an error.
+    """
+    with _lock:
+        _responses.insert(0, (host, re.compile(pattern, re.I), names, rows))
+
+
+def _canned(conn, sql, params):
+    for host, pattern, names, rows in _responses:
+        if (host is None or host == conn.host) and pattern.search(sql):
+            if callable(rows):
+                rows = rows(conn, sql, params)
+            return names, [tuple(row) for row in rows]
+    return None
+
+
+def _database_path(host, port, db):
+    global _tmpdir
+    with _lock:
+        if _tmpdir is None:
+            _tmpdir = tempfile.mkdtemp(prefix='pysql-fakedb-')
+        return os.path.join(_tmpdir, '%s-%s-%s.sqlite' % (host, port, db))
+
+
+def connect(host='127.0.0.1', port=3306, db='test', user=None, passwd=None, charset=None, client_flag=0,
+            autocommit=False, **kwargs):
+    return Connection(host, port, db, client_flag, autocommit)
+
+
+_TRANSLATIONS = (
+    (re.compile(r'^\s*INSERT[_ ]IGNORE\s+INTO', re.I), 'INSERT OR IGNORE INTO'),
+    (re.compile(r'\bVALUES\((\w+)\)', re.I), r'excluded.\1'),
+    (re.compile(r'\bON DUPLICATE KEY UPDATE\b', re.I), 'ON CONFLICT DO UPDATE SET'),
+    # sqlite locks the whole database, locking reads are plain reads.
+    (re.compile(r'\s+(FOR UPDATE|LOCK IN SHARE MODE)\s*$', re.I), ''),
+)
+
+
+def translate(sql, params):
+    """Translate pysql's MySQL dialect to sqlite"""
+    for pattern, repl in _TRANSLATIONS:
+        sql = pattern.sub(repl, sql)
+    sql = re.sub(r'@@(?:session\.|global\.)?(\w+)', lambda m: repr(variables[m.group(1).lower()]), sql)
+    if params is not None:
+        sql = sql.replace('%s', '?').replace('%%', '%')
+    return sql
+
+
+class Connection(object):
+
+    def __init__(self, host, port, db, client_flag=0, autocommit=False):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.client_flag = client_flag
+        self.autocommit_mode = autocommit
+        self.pid = os.getpid()
+        self.connection_id = next(_connection_ids)
+        self.open = True
+        self.in_transaction = False
+        self.lastrowid = None
+        self._conn = sqlite3.connect(_database_path(host, port, db), isolation_level=None,
+                                     check_same_thread=False, timeout=30)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.create_function('last_insert_id', 0, lambda: self.lastrowid)
+        self._conn.create_function('connection_id', 0, lambda: self.connection_id)
+        _connections[self.connection_id] = self
+
+    def _check(self, method=None):
+        if self.pid != os.getpid():
+            shared_uses.append((os.getpid(), self.connection_id, method))
+        if not self.open:
+            raise InterfaceError(0, 'Connection is closed')
+
+    def cursor(self, cursorclass=None):
+        self._check('cursor')
+        return (cursorclass or Cursor)(self)
+
+    def begin(self):
+        if not self.in_transaction:
+            # Take the write lock up front, like InnoDB row locks make writers wait.
+            self._conn.execute('BEGIN IMMEDIATE')
+            self.in_transaction = True
+
+    def commit(self):
+        self._check('commit')
+        if self.in_transaction:
+            self._conn.execute('COMMIT')
+            self.in_transaction = False
+
+    def rollback(self):
+        self._check('rollback')
+        if self.in_transaction:
+            # sqlite already rolled back the transaction of an interrupted write.
+            if self._conn.in_transaction:
+                self._conn.execute('ROLLBACK')
+            self.in_transaction = False
+
+    def ping(self, reconnect=False):
+        self._check('ping')
+
+    def thread_id(self):
+        return self.connection_id
+
+    def close(self):
+        if self.open:
+            if self.pid != os.getpid():
+                shared_uses.append((os.getpid(), self.connection_id, 'close'))
+            self.open = False
+            self._conn.close()
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+_KILL_QUERY = re.compile(r'\s*KILL QUERY (\d+)\s*$', re.I)
+_MAX_EXECUTION_TIME = re.compile(r'/\*\+ MAX_EXECUTION_TIME\((\d+)\) \*/')
+_LOAD_DATA = re.compile(r'\s*LOAD DATA LOCAL INFILE %s( REPLACE| IGNORE)? INTO TABLE (\S+)'
+                        r'(?: CHARACTER SET \w+)? \(([^)]*)\)$', re.I)
+_UNESCAPE = re.compile(br'\\(.)')
+_UNESCAPES = {b'n': b'\n', b't': b'\t', b'r': b'\r', b'0': b'\0'}
+
+
+def _load_field(field):
+    if field == b'\\N':
+        return None
+    field = _UNESCAPE.sub(lambda m: _UNESCAPES.get(m.group(1), m.group(1)), field)
+    try:
+        return field.decode('utf-8')
+    except UnicodeDecodeError:
+        return field
+
+
+def _load_data(conn, match, args):
+    """
+    LOAD DATA LOCAL INFILE in the default format. Like MySQL, duplicates are
+    skipped in INSERT mode and counted as warnings.
+    """
+    mode, table, columns = match.groups()
+    columns = [c.strip() for c in columns.split(',')]
+    verb = 'INSERT OR REPLACE' if (mode or '').strip().upper() == 'REPLACE' else 'INSERT OR IGNORE'
+    sql = '%s INTO %s (%s) VALUES (%s)' % (verb, table, ','.join(columns), ','.join('?' * len(columns)))
+    if not conn.autocommit_mode:
+        conn.begin()
+    loaded = skipped = 0
+    with open(args[0], 'rb') as f:
+        for line in f:
+            fields = [_load_field(field) for field in line.rstrip(b'\n').split(b'\t')]
+            if conn._conn.execute(sql, fields).rowcount > 0:
+                loaded += 1
+            else:
+                skipped += 1
+    variables['warning_count'] = skipped
+    return loaded
+
+
+_STATEMENT = re.compile(r"(?:'(?:[^']|'')*'|\"[^\"]*\"|`[^`]*`|[^;'\"`])+")
+
+
+def _split_statements(sql):
+    """Statements of a multiple statement query"""
+    return [statement.strip() for statement in _STATEMENT.findall(sql) if statement.strip()] or [sql]
+
+
+def _literal(value):
+    if value is None:
+        return 'NULL'
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, (int, float)):
+        return repr(value)
+    if isinstance(value, (bytes, bytearray)):
+        return "X'%s'" % bytes(value).hex()
+    if not isinstance(value, str):
+        value = value.isoformat() if hasattr(value, 'isoformat') else str(value)
+    return "'%s'" % value.replace("'", "''")
+
+
+class _CannedResult(object):
+    """Quacks like a sqlite cursor for canned rows"""
+
+    def __init__(self, names, rows):
+        self.description = tuple((name,) + (None,) * 6 for name in names) if names else None
+        self._rows = list(rows)
+
+    def fetchmany(self, size):
+        rows, self._rows = self._rows[:size], self._rows[size:]
+        return rows
+
+    def fetchall(self):
+        rows, self._rows = self._rows, []
+        return rows
+
+
+class Cursor(object):
+    """Buffered cursor: like pymysql.cursors.Cursor all rows are fetched by `execute`"""
+
+    buffered = True
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.description = None
+        self.rowcount = -1
+        self.lastrowid = None
+        self.arraysize = 1
+        self._cursor = None
+        self._rows = None
+        self._pos = 0
+        self._sets = []
+
+    def execute(self, query, args=None):
+        conn = self.connection
+        conn._check('execute')
+        with _lock:
+            statements.append((conn.host, query, args))
+
+        queries = _split_statements(query) if args is None else [query]
+        if len(queries) > 1 and not conn.client_flag & CLIENT.MULTI_STATEMENTS:
+            raise ProgrammingError(1064, 'You have an error in your SQL syntax near %r' % queries[1])
+
+        # The first statement's result is current, the others wait for nextset().
+        self._sets = []
+        for sql in queries:
+            self._execute(sql, args)
+            self._sets.append((self.rowcount, self.lastrowid, self.description, self._cursor, self._rows))
+        self.nextset()
+        return self.rowcount
+
+    def _execute(self, query, args):
+        conn = self.connection
+        self.lastrowid = 0
+        canned = _canned(conn, query, args)
+        if canned is not None:
+            names, rows = canned
+            self.rowcount = len(rows)
+            self._set_result(_CannedResult(names, rows))
+            return
+
+        load = _LOAD_DATA.match(query)
+        if load is not None:
+            self.rowcount = _load_data(conn, load, args)
+            self._set_result(_CannedResult(None, []))
+            return
+
+        kill = _KILL_QUERY.match(query)
+        if kill is not None:
+            # sqlite stops the running statement of the connection, like KILL QUERY.
+            target = _connections.get(int(kill.group(1)))
+            if target is not None and target.open:
+                target._conn.interrupt()
+            self.rowcount = 0
+            self._set_result(_CannedResult(None, []))
+            return
+
+        verb = query.split(None, 1)[0].upper() if query.strip() else ''
+        if verb in ('BEGIN', 'COMMIT') or re.match(r'\s*ROLLBACK\s*$', query, re.I):
+            getattr(conn, {'BEGIN': 'begin', 'COMMIT': 'commit'}.get(verb, 'rollback'))()
+            self.rowcount = 0
+            self._set_result(_CannedResult(None, []))
+            return
+
+        sql = translate(query, args)
+        if not conn.autocommit_mode and not re.match(r'\s*(SELECT|SHOW|EXPLAIN|RELEASE|ROLLBACK)\b',
+                                                     sql, re.I):
+            conn.begin()
+        # The optimizer hint of a SELECT stops it after that many milliseconds.
+        limit = _MAX_EXECUTION_TIME.search(sql)
+        expired = []
+        timer = None
+        if limit is not None:
+            timer = threading.Timer(int(limit.group(1)) / 1000.0,
+                                    lambda: expired.append(1) or conn._conn.interrupt())
+            timer.start()
+        try:
+            cursor = conn._conn.execute(sql, tuple(args or ()))
+            self.rowcount = cursor.rowcount
+            if cursor.rowcount > 0 and re.match(r'\s*(INSERT|REPLACE)\b', sql, re.I):
+                # MySQL reports the id of the first row of a multiple-row insert.
+                self.lastrowid = conn.lastrowid = cursor.lastrowid - cursor.rowcount + 1
+            self._set_result(cursor)
+        except sqlite3.IntegrityError as e:
+            raise IntegrityError(1062, str(e))
+        except sqlite3.Error as e:
+            if str(e) == 'interrupted':
+                if expired:
+                    raise OperationalError(3024, 'Query execution was interrupted, maximum statement execution '
+                                                 'time exceeded')
+                raise OperationalError(1317, 'Query execution was interrupted')
+            raise OperationalError(1064, str(e))
+        finally:
+            if timer is not None:
+                timer.cancel()
+
+    def nextset(self):
+        """Move to the result of the next statement of a multiple statement query"""
+        if not self._sets:
+            return None
+        self.rowcount, self.lastrowid, self.description, self._cursor, self._rows = self._sets.pop(0)
+        self._pos = 0
+        return True
+
+    def mogrify(self, query, args=None):
+        """The query with `args` rendered as sqlite literals"""
+        if args is None:
+            return query
+        parts = query.split('%s')
+        out = [parts[0]]
+        for arg, part in zip(args, parts[1:]):
+            out.append(_literal(arg))
+            out.append(part)
+        return ''.join(out).replace('%%', '%')
+
+    def _set_result(self, cursor):
+        self.description = None
+        self._cursor = cursor
+        self._rows = None
+        self._pos = 0
+        if cursor.description is None:
+            return
+        rows = self._rows = cursor.fetchall()
+        self.rowcount = len(rows)
+        self._describe(cursor, rows[:1])
+
+    def _describe(self, cursor, rows):
+        first = rows[0] if rows else [None] * len(cursor.description)
+        self.description = tuple((d[0], _field_type(v), None, None, None, None, True)
+                                 for d, v in zip(cursor.description, first))
+
+    def fetchone(self):
+        if self._rows and self._pos < len(self._rows):
+            self._pos += 1
+            return self._rows[self._pos - 1]
+        return None
+
+    def fetchmany(self, size=None):
+        start = self._pos
+        self._pos = min(start + (size or self.arraysize), len(self._rows or ()))
+        return (self._rows or [])[start:self._pos]
+
+    def fetchall(self):
+        rows, start = self._rows or [], self._pos
+        self._pos = len(rows)
+        return rows[start:]
+
+    def close(self):
+        self._rows = None
+        self._cursor = None
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+
+class SSCursor(Cursor):
+    """Unbuffered cursor: rows are read from the database while fetching"""
+
+    buffered = False
+
+    def _set_result(self, cursor):
+        self.description = None
+        self._cursor = cursor
+        self._peek = []
+        if cursor.description is None:
+            return
+        self._peek = cursor.fetchmany(1)
+        self._describe(cursor, self._peek)
+
+    def fetchone(self):
+        rows = self.fetchmany(1)
+        return rows[0] if rows else None
+
+    def fetchmany(self, size=None):
+        size = size or self.arraysize
+        rows, self._peek = self._peek, []
+        if self._cursor is not None and len(rows) < size:
+            rows.extend(self._cursor.fetchmany(size - len(rows)))
+        return rows
+
+    def fetchall(self):
+        rows, self._peek = self._peek, []
+        if self._cursor is not None:
+            rows.extend(self._cursor.fetchall())
+        return rows
+
+
+class cursors(object):
+    """Stands for the `cursors` submodule of pymysql and MySQLdb"""
+    Cursor = Cursor
+    SSCursor = SSCursor
@@ -0,0 +1,193 @@
+# coding: utf-8
+
+import threading
+import time
+import unittest
+
+from pool import (DB, AdmissionController, Overloaded, PRIORITY_BATCH, PRIORITY_INTERACTIVE)
+from test import fakedb
+
+
+class TestAdmission(unittest.TestCase):
+    """
+        Test pysql admission control
+    """
+
+    def setUp(self):
+        fakedb.reset()
+        self.running = 0
+        self.peak = 0
+        self.order = []
+        self.gate = threading.Event()
+        self.lock = threading.Lock()
+        fakedb.respond(r'^SELECT (\w+)', ['x'], self._slow)
+
+    def _slow(self, conn, sql, params):
+        with self.lock:
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+            self.order.append(sql.split()[1])
+        self.gate.wait(5)
+        with self.lock:
+            self.running -= 1
+        return [(1,)]
+
+    def _pool(self, **admission):
+        return DB(fakedb, {'host': 'localhost', 'db': 'bar', 'maxconnections': 0}, admission=admission)
+
+    def _start(self, target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.start()
+        return thread
+
+    def _wait(self, check):
+        deadline = time.time() + 5
+        while not check() and time.time() < deadline:
+            time.sleep(0.001)
+        assert check()
+
+    def testLimit(self):
+        pool = self._pool(limit=2)
+        threads = [self._start(lambda: list(pool.execute('SELECT a'))) for _ in range(6)]
+        self._wait(lambda: pool.admission.stats().queue_depth == 4 and self.running == 2)
+        self.gate.set()
+        for thread in threads:
+            thread.join()
+        stats = pool.admission.stats()
+        assert self.peak == 2 and stats.admitted == 6 and stats.queued == 4 and stats.in_flight == 0, stats
+
+    def testPriority(self):
+        pool = self._pool(limit=1)
+
+        def call(name, priority):
+            with pool.admission_scope(priority):
+                list(pool.execute('SELECT %s' % name))
+
+        threads = [self._start(call, 'first', PRIORITY_BATCH)]
+        self._wait(lambda: self.running == 1)
+        threads.append(self._start(call, 'batch', PRIORITY_BATCH))
+        self._wait(lambda: pool.admission.stats().queue_depth == 1)
+        threads.append(self._start(call, 'interactive', PRIORITY_INTERACTIVE))
+        self._wait(lambda: pool.admission.stats().queue_depth == 2)
+        self.gate.set()
+        for thread in threads:
+            thread.join()
+        assert self.order == ['first', 'interactive', 'batch'], self.order
+
+    def testShedding(self):
+        pool = self._pool(limit=1, queue_size=1)
+        threads = [self._start(lambda: list(pool.execute('SELECT a')))]
+        self._wait(lambda: self.running == 1)
+        threads.append(self._start(lambda: list(pool.execute('SELECT b'))))
+        self._wait(lambda: pool.admission.stats().queue_depth == 1)
+        with self.assertRaises(Overloaded):
+            pool.execute('SELECT c')
+        self.gate.set()
+        for thread in threads:
+            thread.join()
+        assert pool.admission.stats().rejected == 1
+
+    def testDeadline(self):
+        pool = self._pool(limit=1)
+        thread = self._start(lambda: list(pool.execute('SELECT a')))
+        self._wait(lambda: self.running == 1)
+        start = time.time()
+        with self.assertRaises(Overloaded):
+            with pool.admission_scope(timeout=0.05):
+                pool.execute('SELECT b')
+        assert 0.04 < time.time() - start < 1
+        assert pool.admission.stats().timeouts == 1 and pool.admission.stats().queue_depth == 0
+
+        # Calls expected to wait longer than their deadline are shed right away.
+        pool.admission.latency = 10.0
+        start = time.time()
+        with self.assertRaises(Overloaded):
+            with pool.admission_scope(timeout=1):
+                pool.execute('SELECT b')
+        assert time.time() - start < 0.5
+        self.gate.set()
+        thread.join()
+        assert self.order == ['a']
+
+    def testTransaction(self):
+        pool = self._pool(limit=1)
+        self.gate.set()
+        with pool.transaction():
+            assert pool.admission.stats().in_flight == 1
+            list(pool.execute('SELECT a'))
+            with pool.transaction():
+                list(pool.execute('SELECT b'))
+        assert pool.admission.stats().in_flight == 0 and pool.admission.stats().admitted == 1
+
+    def testStream(self):
+        pool = self._pool(limit=1)
+        self.gate.set()
+        rows = pool.execute('SELECT a', stream=True)
+        assert pool.admission.stats().in_flight == 1, 'The stream holds its slot'
+        rows.close()
+        assert pool.admission.stats().in_flight == 0
+        assert list(pool.execute('SELECT b')) and pool.admission.stats().in_flight == 0
+
+    def testEntryPoints(self):
+        pool = DB(fakedb, {'host': 'localhost', 'db': 'bar', 'local_infile': True}, admission={'limit': 1})
+        self.gate.set()
+        pool.execute('CREATE TABLE t40 (id INTEGER PRIMARY KEY AUTOINCREMENT, name varchar(32))')
+        admitted = pool.admission.stats().admitted
+
+        def check(calls):
+            stats = pool.admission.stats()
+            assert stats.admitted == admitted + calls and stats.in_flight == 0, stats
+
+        with pool.batch() as b:
+            b.insert('t40', {'name': 'a'})
+            b.insert('t40', {'name': 'b'})
+        admitted += 1
+        check(0)
+
+        batcher = pool.write_batcher(max_delay=0)
+        batcher.insert('t40', {'name': 'c'}).result()
+        batcher.close()
+        check(1)
+        admitted += 1
+
+        assert len(list(pool.iter_table('t40', chunk_size=2))) == 3
+        check(2)
+        admitted += 2
+
+        assert pool.query_columns('t40').rowcount == 3
+        check(1)
+        admitted += 1
+
+        assert pool.bulk_load('t40', [{'name': 'd'}], via='file').loaded == 1
+        check(1)
+
+    def testAIMD(self):
+        admission = AdmissionController(limit=4, mode='aimd', target_latency=0.01)
+        for i in range(4):
+            admission.acquire()
+        admission.release(0.001)
+        assert admission.stats().limit == 5
+        admission.release(0.5)
+        assert admission.stats().limit == 4
+
+    def testGradient(self):
+        admission = AdmissionController(limit=20, mode='gradient', min_limit=2)
+        for i in range(50):
+            admission.acquire()
+            admission.release(0.01)
+        assert admission.stats().limit == 20, 'Idle pools keep their limit'
+        for i in range(50):
+            admission.acquire()
+            admission.release(0.1)
+        assert admission.stats().limit < 10, admission.stats()
+
+    def testPrometheus(self):
+        admission = AdmissionController(limit=3)
+        admission.acquire()
+        text = admission.prometheus()
+        assert '# TYPE pysql_admission_limit gauge\npysql_admission_limit 3\n' in text
+        assert 'pysql_admission_in_flight 1\n' in text
+
+
+if __name__ == '__main__':
+    unittest.main()
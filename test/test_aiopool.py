@@ -0,0 +1,127 @@
+# coding: utf-8
+
+import asyncio
+import unittest
+
+from aiopool import AsyncSQLPool
+from test import fakeaiodb, fakedb
+
+
+class TestAsyncPool(unittest.TestCase):
+    """
+        Test pysql asyncio API
+    """
+    TABLE = 't10'
+    TABLE_SCHEMA = """
+        CREATE TABLE IF NOT EXISTS `%s`(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name varchar(32) DEFAULT '' UNIQUE,
+            age smallint DEFAULT '0'
+        );
+    """ % TABLE
+
+    def setUp(self):
+        fakedb.reset()
+        self.pool = AsyncSQLPool(module=fakeaiodb, host='async', db='bar', maxcached=2, maxconnections=2)
+        self.table = TestAsyncPool.TABLE
+
+    def _run(self, coro):
+        async def main():
+            await self.pool.execute(TestAsyncPool.TABLE_SCHEMA)
+            try:
+                return await coro
+            finally:
+                await self.pool.close()
+        return asyncio.run(main())
+
+    def testCrud(self):
+        async def crud():
+            insert_id = await self.pool.insert(self.table, {'name': 'a', 'age': 1})
+            insert_ids = await self.pool.insertmany(self.table, [{'name': 'b', 'age': 2}, {'name': 'c', 'age': 3}])
+            assert list(insert_ids) == [insert_id + 1, insert_id + 2], insert_ids
+
+            affected_rows = await self.pool.update(self.table, where={'id__in': list(insert_ids)}, obj={'age': 9})
+            assert affected_rows == 2, affected_rows
+
+            ages = [row.age async for row in self.pool.query(self.table, order_by=['id'], batch_size=1)]
+            assert ages == [1, 9, 9], ages
+
+            assert await self.pool.delete(self.table, where={'age': 9}) == 2
+            rows = await self.pool.query(self.table, row_factory='tuple', fields=['name'])
+            assert rows == [('a',)], rows
+        self._run(crud())
+
+    def testTransaction(self):
+        async def transact():
+            async with self.pool.transaction():
+                await self.pool.insert(self.table, {'name': 'a'})
+                try:
+                    async with self.pool.transaction():
+                        await self.pool.insert(self.table, {'name': 'b'})
+                        raise ValueError()
+                except ValueError:
+                    pass
+            try:
+                async with self.pool.transaction():
+                    await self.pool.insert(self.table, {'name': 'c'})
+                    await self.pool.insert(self.table, {'name': 'a'})
+            except fakeaiodb.IntegrityError:
+                pass
+            return [row.name for row in await self.pool.query(self.table)]
+        names = self._run(transact())
+        assert names == ['a'], names
+
+    def testConcurrency(self):
+        async def worker(i):
+            async with self.pool.transaction():
+                await self.pool.insert(self.table, {'name': 'n%d' % i})
+                await asyncio.sleep(0)
+                return [row.name async for row in self.pool.query(self.table, where={'name': 'n%d' % i})]
+
+        async def gather():
+            return await asyncio.gather(*[worker(i) for i in range(6)])
+        results = self._run(gather())
+        assert results == [['n%d' % i] for i in range(6)], results
+        assert self.pool._pool.size <= 2, self.pool._pool.size
+
+    def testChildTask(self):
+        async def child():
+            assert self.pool._current_state() is None, 'Child task sees the transaction'
+            async with self.pool.transaction() as tx:
+                return tx.state.conn
+
+        async def parent():
+            async with self.pool.transaction() as tx:
+                conn = await asyncio.create_task(child())
+                assert self.pool._current_state() is tx.state, 'Transaction lost'
+                return conn is tx.state.conn
+        assert not self._run(parent()), 'Child task shares the connection of the transaction'
+
+    def testInsertIds(self):
+        async def insert():
+            fakedb.variables['auto_increment_increment'] = 2
+            await self.pool.insert(self.table, {'id': 100, 'name': 'x'})
+            await self.pool.delete(self.table, where={'id': 100})
+            ids = await self.pool.insertmany(self.table, [{'name': 'n%d' % i} for i in range(3)])
+            ignored = await self.pool.insertmany(self.table, [{'name': 'n0'}, {'name': 'n9'}], mode='INSERT_IGNORE')
+            return ids, ignored
+        ids, ignored = self._run(insert())
+        assert ids.ranges == [range(101, 107, 2)], ids
+        assert list(ignored) == [None, None], 'Ids guessed for skipped rows: %s' % ignored
+
+    def testAbandonedResult(self):
+        async def abandon():
+            await self.pool.insertmany(self.table, [{'name': 'n%d' % i} for i in range(3)])
+            rows = self.pool.query(self.table, batch_size=1)
+            await rows.__anext__()
+            size = self.pool._pool.size
+            del rows
+            for i in range(3):
+                await asyncio.sleep(0)
+            return size, self.pool._pool.size
+        before, after = self._run(abandon())
+        assert after == before - 1, 'Connection not given back: %s -> %s' % (before, after)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+# coding: utf-8
+
+import unittest
+
+from pool import DB
+from test import fakedb
+
+
+class TestBatch(unittest.TestCase):
+    """
+        Test pysql pipelined batches of statements
+    """
+    TABLE = 't20'
+    TABLE_SCHEMA = """
+        CREATE TABLE IF NOT EXISTS `%s`(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name varchar(32) UNIQUE,
+            age int DEFAULT 0
+        );
+    """ % TABLE
+
+    def setUp(self):
+        fakedb.reset()
+        self.table = TestBatch.TABLE
+        self.config = {'host': 'localhost', 'db': 'bar'}
+        DB(fakedb, self.config).execute(TestBatch.TABLE_SCHEMA)
+        del fakedb.statements[:]
+
+    def _sent(self):
+        # Statements of the batches, without the server settings read by insertmany.
+        return [sql for host, sql, params in fakedb.statements if '@@' not in sql]
+
+    def _rows(self):
+        # Read on another pool, so only committed rows are seen.
+        return [(r.id, r.name, r.age) for r in DB(fakedb, self.config).query(self.table, order_by='id')]
+
+    def _batch(self, pool):
+        with pool.batch() as b:
+            futures = [
+                b.insert(self.table, {'name': 'a', 'age': 1}),
+                b.insertmany(self.table, [{'name': 'b', 'age': 2}, {'name': 'c', 'age': 3}]),
+                b.update(self.table, where={'name': 'a'}, obj={'age': 10}),
+                b.delete(self.table, where={'name': 'c'}),
+                b.execute("UPDATE %s SET age = age + 1" % self.table),
+            ]
+        return [f.result() for f in futures]
+
+    def testMultiStatements(self):
+        pool = DB(fakedb, dict(self.config, multi_statements=True))
+        results = self._batch(pool)
+        assert results[0] == 1 and list(results[1]) == [2, 3] and results[2:] == [1, 1, 2], results
+        sent = self._sent()
+        assert len(sent) == 1 and sent[0].endswith(";\nCOMMIT"), sent
+        assert self._rows() == [(1, 'a', 11), (2, 'b', 3)]
+        assert pool.connection_pool.stats().in_use == 0
+
+    def testSequential(self):
+        pool = DB(fakedb, self.config)
+        results = self._batch(pool)
+        assert results[0] == 1 and list(results[1]) == [2, 3] and results[2:] == [1, 1, 2], results
+        assert len(self._sent()) == 5
+        assert self._rows() == [(1, 'a', 11), (2, 'b', 3)]
+
+    def testAutocommit(self):
+        pool = DB(fakedb, dict(self.config, multi_statements=True, autocommit=True))
+        self._batch(pool)
+        assert 'COMMIT' not in self._sent()[0]
+        assert self._rows() == [(1, 'a', 11), (2, 'b', 3)]
+
+        assert pool.insert(self.table, {'name': 'd'}) == 4
+        assert self._rows()[-1] == (4, 'd', 0), 'Autocommit sessions commit each statement'
+
+    def testError(self):
+        pool = DB(fakedb, dict(self.config, multi_statements=True))
+        with self.assertRaises(fakedb.IntegrityError):
+            with pool.batch() as b:
+                first = b.insert(self.table, {'name': 'a'})
+                second = b.insert(self.table, {'name': 'a'})
+        assert isinstance(first.exception(), fakedb.IntegrityError) and second.exception() is not None
+        assert self._rows() == [], 'A failed batch must be rolled back'
+        del fakedb.statements[:]
+
+        with self.assertRaises(ZeroDivisionError):
+            with pool.batch() as b:
+                third = b.insert(self.table, {'name': 'a'})
+                1 / 0
+        assert isinstance(third.exception(), ZeroDivisionError)
+        assert fakedb.statements == [], 'Nothing is sent when the block fails'
+
+    def testNestedError(self):
+        pool = DB(fakedb, self.config)
+        with self.assertRaises(ZeroDivisionError):
+            with pool.transaction():
+                pool.insert(self.table, {'name': 'a'})
+                with self.assertRaises(fakedb.IntegrityError):
+                    with pool.transaction():
+                        with pool.batch() as b:
+                            b.insert(self.table, {'name': 'b'})
+                            b.insert(self.table, {'name': 'a'})
+                assert len(pool._ctx.transactions) == 1, 'The outer transaction is still open'
+                pool.insert(self.table, {'name': 'c'})
+                1 / 0
+        assert self._rows() == [], 'The outer transaction is rolled back as a whole'
+
+    def testInsertId(self):
+        pool = DB(fakedb, self.config)
+        assert pool.insert(self.table, {'name': 'a'}) == 1
+        assert [sql for host, sql, params in fakedb.statements if 'last_insert_id' in sql] == []
+
+
+if __name__ == '__main__':
+    unittest.main()
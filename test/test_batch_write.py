@@ -0,0 +1,101 @@
+# coding: utf-8
+
+import sys
+import unittest
+
+from pool import DB, Field, ReplicaLagTimeout, SQLPool
+from test import fakedb
+
+
+class TestBatchWrite(unittest.TestCase):
+    """
+        Test pysql batched delete and update
+    """
+    TABLE = 't18'
+    TABLE_SCHEMA = """
+        CREATE TABLE IF NOT EXISTS `%s`(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            grp int NOT NULL,
+            age int DEFAULT 0
+        );
+    """ % TABLE
+
+    def setUp(self):
+        fakedb.reset()
+        self.table = TestBatchWrite.TABLE
+        self.pool = DB(fakedb, {'host': 'localhost', 'db': 'bar'})
+        self.pool.execute(TestBatchWrite.TABLE_SCHEMA)
+        self.pool.insertmany(self.table, [{'grp': i % 2, 'age': i} for i in range(1, 21)])
+        del fakedb.statements[:]
+
+    def _statements(self, verb):
+        return [sql for host, sql, params in fakedb.statements if sql.startswith(verb)]
+
+    def testDelete(self):
+        done = []
+        assert self.pool.delete(self.table, where={'grp': 1}, batch_size=3, progress=done.append) == 10
+        assert done == [3, 6, 9, 10], done
+        deletes = self._statements('DELETE')
+        assert len(deletes) == 4
+        assert deletes[0] == 'DELETE FROM t18 WHERE grp = %s ORDER BY id LIMIT 3', deletes[0]
+        assert len(list(self.pool.query(self.table))) == 10
+        assert self.pool.delete(self.table, where={'grp': 1}, batch_size=3) == 0
+
+    def testUpdate(self):
+        done = []
+        obj = {'age': Field('age + 100')}
+        assert self.pool.update(self.table, where={'grp': 0, 'id__gt': 2}, obj=obj, batch_size=4,
+                                progress=done.append) == 9
+        assert done == [4, 8, 9], done
+        assert len(self._statements('UPDATE')) == 3
+        ages = dict((row.id, row.age) for row in self.pool.query(self.table))
+        assert [ages[i] for i in (2, 4, 20)] == [2, 104, 120], ages
+        assert ages[3] == 3, 'Rows not matching where must be kept'
+
+    def testLag(self):
+        lags = iter([100, 100, 0])
+        fakedb.respond('SHOW SLAVE STATUS', ['Seconds_Behind_Master'], lambda conn, sql, params: [[next(lags, 0)]])
+        pool = DB(fakedb, {'host': 'localhost', 'db': 'bar'}, replicas=[{'host': 'replica'}],
+                  replica_lag_check_interval=0)
+        assert pool.delete(self.table, where={'grp': 1}, batch_size=5, max_replica_lag=10) == 10
+        # Three checks until the lag is gone after the first batch, one after the second.
+        assert len(self._statements('SHOW SLAVE STATUS')) == 4, 'Batches must wait for the replica'
+
+    def _replicated(self, **options):
+        return DB(fakedb, {'host': 'localhost', 'db': 'bar'}, replicas=[{'host': 'replica'}, {'host': 'replica2'}],
+                  replica_lag_check_interval=0, **options)
+
+    def testLagBound(self):
+        fakedb.respond('SHOW SLAVE STATUS', ['Seconds_Behind_Master'], [[100]], host='replica')
+        fakedb.respond('SHOW SLAVE STATUS', ['Seconds_Behind_Master'], [[None]], host='replica2')
+        pool = self._replicated(max_replica_wait=0.05)
+        self.assertRaises(ReplicaLagTimeout, pool.delete, self.table, where={'grp': 1}, batch_size=5,
+                          max_replica_lag=10)
+        assert len(self._statements('DELETE')) == 1, 'Rows written after the wait bound'
+
+        # A stopped replica, or one failing to tell its lag, is not waited for.
+        fakedb.respond('SHOW SLAVE STATUS', ['Seconds_Behind_Master'], [[0]], host='replica')
+        assert pool.delete(self.table, where={'grp': 1}, batch_size=5, max_replica_lag=10) == 5
+
+    def testPoolOption(self):
+        # SQLPool imports its driver by name.
+        driver = sys.modules.get('pymysql')
+        sys.modules['pymysql'] = fakedb
+        try:
+            pool = SQLPool(host='localhost', port='3306', db='bar', max_replica_wait=60)
+        finally:
+            if driver is None:
+                del sys.modules['pymysql']
+            else:
+                sys.modules['pymysql'] = driver
+        assert pool.max_replica_wait == 60 and 'max_replica_wait' not in pool.config
+
+    def testReplicaStatus(self):
+        fakedb.respond('SHOW REPLICA STATUS', ['Seconds_Behind_Source'], [[0]])
+        pool = self._replicated()
+        assert pool.delete(self.table, where={'grp': 1}, batch_size=5, max_replica_lag=10) == 10
+        assert self._statements('SHOW REPLICA STATUS') and not self._statements('SHOW SLAVE STATUS')
+
+
+if __name__ == '__main__':
+    unittest.main()
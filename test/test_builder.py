@@ -0,0 +1,41 @@
+# coding: utf-8
+
+import unittest
+
+from pool import DB, SQLBuilder, SQLParam, SQLQuery, sqlconvert, sqlquote
+
+
+class TestBuilder(unittest.TestCase):
+    """
+        Test pysql SQLBuilder
+    """
+
+    def testRender(self):
+        q = SQLBuilder("SELECT * FROM t WHERE name LIKE 'a%' AND id = ").param(1)
+        assert q.query() == "SELECT * FROM t WHERE name LIKE 'a%%' AND id = %s", q.query()
+        assert q.query() is q.query(), 'Render is not memoized'
+
+        q.append(' AND age IN ').append(sqlquote([2, 3]))
+        assert q.query().endswith('age IN (%s,%s)'), q.query()
+        assert q.values() == [1, 2, 3], q.values()
+
+        raw = SQLBuilder("SELECT * FROM t WHERE name LIKE 'a%'")
+        assert raw.query() == "SELECT * FROM t WHERE name LIKE 'a%'", raw.query()
+
+    def testCompat(self):
+        q = 'UPDATE t SET ' + sqlconvert([('a', 1), ('b', 'x')])
+        assert isinstance(q, SQLBuilder)
+        q = SQLQuery(['SELECT 1 WHERE ', SQLParam(0)]) + q
+        assert isinstance(q, SQLQuery)
+        assert q.values() == [0, 1, 'x'], q.values()
+        assert str(SQLQuery.join(['x', sqlquote(5)], ' = ')) == 'x = 5'
+
+    def testInsertmany(self):
+        db = DB(None, {})
+        sqlquery = db._compile_insertmany('t', [{'a': 1, 'b': 2}, {'a': 3, 'b': 4}], 'INSERT', {})
+        assert sqlquery.query() == 'INSERT INTO t (a,b) VALUES (%s,%s),(%s,%s)', sqlquery.query()
+        assert sqlquery.values() == [1, 2, 3, 4], sqlquery.values()
+
+
+if __name__ == '__main__':
+    unittest.main()
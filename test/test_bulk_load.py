@@ -0,0 +1,89 @@
+# coding: utf-8
+
+import datetime
+import threading
+import unittest
+
+from pool import DB
+from test import fakedb
+
+
+class TestBulkLoad(unittest.TestCase):
+    """
+        Test pysql bulk_load with LOAD DATA LOCAL INFILE
+    """
+    TABLE = 't15'
+    TABLE_SCHEMA = """
+        CREATE TABLE IF NOT EXISTS `%s`(
+            id INTEGER PRIMARY KEY,
+            name varchar(32),
+            data blob,
+            created datetime
+        );
+    """ % TABLE
+
+    def setUp(self):
+        fakedb.reset()
+        self.table = TestBulkLoad.TABLE
+        self.pool = DB(fakedb, {'host': 'localhost', 'db': 'bar', 'local_infile': True})
+        self.pool.execute(TestBulkLoad.TABLE_SCHEMA)
+
+    def _rows(self):
+        return list(self.pool.query(self.table, order_by='id', row_factory='tuple'))
+
+    def testPipe(self):
+        created = datetime.datetime(2020, 1, 2, 3, 4, 5)
+        rows = ({'id': i, 'name': 'a\tb\\c\n%d' % i, 'data': b'\x00\\\n\xff', 'created': created} for i in range(1000))
+        out = self.pool.bulk_load(self.table, rows)
+        assert (out.sent, out.loaded, out.warnings) == (1000, 1000, 0), out
+        rows = self._rows()
+        assert len(rows) == 1000
+        assert rows[7] == (7, 'a\tb\\c\n7', b'\x00\\\n\xff', created.isoformat()), rows[7]
+
+    def testFile(self):
+        rows = [(i, None if i % 2 else 'n%d' % i) for i in range(5)]
+        out = self.pool.bulk_load(self.table, rows, columns=['id', 'name'], via='file', chunk_rows=2)
+        assert (out.sent, out.loaded) == (5, 5), out
+        loads = [sql for host, sql, params in fakedb.statements if sql.startswith('LOAD DATA')]
+        assert len(loads) == 3, loads
+        assert [row[1] for row in self._rows()] == ['n0', None, 'n2', None, 'n4']
+
+    def testModes(self):
+        self.pool.bulk_load(self.table, [{'id': 1, 'name': 'a'}, {'id': 2, 'name': 'b'}])
+        out = self.pool.bulk_load(self.table, [{'id': 2, 'name': 'c'}, {'id': 3, 'name': 'd'}])
+        assert (out.loaded, out.warnings) == (1, 1), 'Duplicates must be skipped with a warning'
+        self.pool.bulk_load(self.table, [{'id': 1, 'name': 'e'}], mode='REPLACE')
+        assert [row[1] for row in self._rows()] == ['e', 'b', 'd']
+
+    def testError(self):
+        def rows():
+            yield {'id': 1, 'name': 'a'}
+            yield {'id': 2}
+        for via in ('pipe', 'file'):
+            self.assertRaises(KeyError, self.pool.bulk_load, self.table, rows(), via=via)
+            assert self._rows() == [], 'A failed load must be rolled back'
+            assert self.pool.connection_pool.stats().in_use == 0
+
+    def testRejected(self):
+        def reject(conn, sql, params):
+            raise fakedb.OperationalError(1148, 'The used command is not allowed with this MySQL version')
+        fakedb.respond(r'^LOAD DATA', [], reject)
+        for i in range(20):
+            self.assertRaises(fakedb.OperationalError, self.pool.bulk_load, self.table, [{'id': 1, 'name': 'a'}],
+                              via='pipe')
+        writers = [t for t in threading.enumerate() if t.name == 'pysql-bulk-load']
+        assert not writers, 'Pipe writers left blocked: %d' % len(writers)
+
+    def testAutocommit(self):
+        pool = DB(fakedb, {'host': 'localhost', 'db': 'bar', 'local_infile': True, 'autocommit': True})
+
+        def rows():
+            for i in range(5):
+                yield {'id': i, 'name': 'n%d' % i}
+            yield {'id': 5}
+        self.assertRaises(KeyError, pool.bulk_load, self.table, rows(), via='file', chunk_rows=2)
+        assert self._rows() == [], 'Loaded chunks must be rolled back in autocommit mode'
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+# coding: utf-8
+
+import array
+import unittest
+
+from pool import DB, ColumnBuffer, import_numpy
+from test import fakedb
+
+
+class TestColumns(unittest.TestCase):
+    """
+        Test pysql columnar query API
+    """
+    TABLE = 't9'
+    TABLE_SCHEMA = """
+        CREATE TABLE IF NOT EXISTS `%s`(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name varchar(32) DEFAULT '',
+            age smallint,
+            score double
+        );
+    """ % TABLE
+
+    def setUp(self):
+        fakedb.reset()
+        self.pool = DB(fakedb, {'host': 'columns', 'db': 'bar'})
+        self.pool.execute(TestColumns.TABLE_SCHEMA)
+        self.table = TestColumns.TABLE
+        objs = [{'name': 'n%d' % i, 'age': None if i % 4 == 3 else i, 'score': i / 2.0} for i in range(10)]
+        self.pool.insertmany(self.table, objs)
+
+    def _query(self, use_numpy):
+        return self.pool.query_columns(table=self.table, fields=['name', 'age', 'score'], order_by=['id'],
+                                       batch_size=4, use_numpy=use_numpy)
+
+    def testArray(self):
+        result = self._query(use_numpy=False)
+        assert len(result) == 10, 'Wrong rowcount: %s' % len(result)
+        assert isinstance(result['age'], array.array) and result['age'].typecode == 'q'
+        assert list(result['score']) == [i / 2.0 for i in range(10)]
+        assert result['name'][9] == 'n9' and result.nulls['name'] is None
+        assert list(result.nulls['age']) == [i % 4 == 3 for i in range(10)], result.nulls['age']
+        assert result['age'][3] == 0 and result['age'][4] == 4
+
+    @unittest.skipIf(import_numpy() is None, 'numpy is not installed')
+    def testNumpy(self):
+        result = self._query(use_numpy=None)
+        assert str(result['age'].dtype) == 'int64' and len(result['age']) == 10
+        assert str(result['score'].dtype) == 'float64'
+        assert result.nulls['age'].tolist() == [i % 4 == 3 for i in range(10)]
+        assert result['name'].tolist() == ['n%d' % i for i in range(10)]
+
+    def testOverflow(self):
+        buf = ColumnBuffer('q')
+        buf.extend((1, None))
+        buf.extend((1 << 64,))
+        column, mask = buf.finish()
+        assert column == [1, None, 1 << 64] and mask is None, column
+
+
+if __name__ == '__main__':
+    unittest.main()
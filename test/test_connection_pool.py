@@ -0,0 +1,85 @@
+# coding: utf-8
+
+import threading
+import time
+import unittest
+
+from pool import ConnectionPool, PoolTimeout, TooManyConnections
+from test import fakedb
+
+
+class TestConnectionPool(unittest.TestCase):
+    """
+        Test pysql connection pool
+    """
+
+    def setUp(self):
+        fakedb.reset()
+        self.config = {'host': 'pool', 'db': 'bar'}
+
+    def _pool(self, **options):
+        return ConnectionPool(fakedb, self.config, **options)
+
+    def testWarmup(self):
+        pool = self._pool(mincached=3, maxcached=3)
+        pool.warmup().join()
+        stats = pool.stats()
+        assert (stats.idle, stats.created) == (3, 3), stats
+
+        conn = pool.connection()
+        assert pool.stats().in_use == 1 and pool.stats().created == 3
+        conn.close()
+        assert pool.stats().idle == 3
+
+    def testOverflow(self):
+        pool = self._pool(maxcached=1, maxconnections=2)
+        a, b = pool.connection(), pool.connection()
+        with self.assertRaises(TooManyConnections):
+            pool.connection()
+        a.close()
+        b.close()
+        stats = pool.stats()
+        assert (stats.idle, stats.size, stats.closed) == (1, 1, 1), stats
+
+    def testCheckoutTimeout(self):
+        pool = self._pool(maxconnections=1, blocking=True, checkout_timeout=0.05)
+        conn = pool.connection()
+        with self.assertRaises(PoolTimeout):
+            pool.connection()
+
+        threading.Timer(0.01, conn.close).start()
+        pool.checkout_timeout = 5
+        pool.connection().close()
+        stats = pool.stats()
+        assert stats.timeouts == 1 and stats.checkouts == 2, stats
+        assert sum(stats.wait_histogram.values()) == 2, stats.wait_histogram
+
+    def testEviction(self):
+        pool = self._pool(mincached=1, idle_timeout=0.01)
+        conns = [pool.connection() for _ in range(3)]
+        for conn in conns:
+            conn.close()
+        time.sleep(0.02)
+        pool.connection().close()
+        assert pool.stats().size == 1, pool.stats()
+
+        pool = self._pool(max_lifetime=0)
+        conn = pool.connection()
+        raw = conn._con()
+        conn.close()
+        assert not raw.open and pool.stats().size == 0
+
+    def testPing(self):
+        pool = self._pool(ping_interval=0)
+        conn = pool.connection()
+        raw = conn._con()
+        conn.close()
+        raw.close()  # The server went away while the connection was idle.
+        conn = pool.connection()
+        assert conn._con() is not raw and conn._con().open
+        assert pool.stats().ping_failures == 1
+        conn.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
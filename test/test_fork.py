@@ -0,0 +1,90 @@
+# coding: utf-8
+
+import multiprocessing
+import os
+import time
+import unittest
+
+from pool import DB
+from test import fakedb
+
+
+def _serve(pool, results, table, write=True):
+    """Worker of a preforking server: wait for the warm connections, then query"""
+    try:
+        deadline = time.time() + 5
+        while pool.connection_pool.stats().idle < pool.connection_pool.mincached and time.time() < deadline:
+            time.sleep(0.01)
+        warm = pool.connection_pool.stats()
+        if write:
+            pool.insert(table, {'name': 'child'})
+        names = [row.name for row in pool.query(table, order_by='id')]
+        ids = [pool._connection_id(entry.con) for entry in pool.connection_pool._idle]
+        results.put((warm.idle, warm.created, names, ids, fakedb.shared_uses))
+    except Exception as e:
+        results.put(repr(e))
+
+
+@unittest.skipUnless(hasattr(os, 'register_at_fork'), 'os.register_at_fork is needed')
+class TestFork(unittest.TestCase):
+    """
+        Test pysql pools inherited by forked children
+    """
+    TABLE = 't25'
+    TABLE_SCHEMA = """
+        CREATE TABLE IF NOT EXISTS `%s`(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name varchar(32) DEFAULT ''
+        );
+    """ % TABLE
+
+    def setUp(self):
+        fakedb.reset()
+        self.table = TestFork.TABLE
+        self.pool = DB(fakedb, {'host': 'localhost', 'db': 'bar', 'mincached': 2})
+        self.pool.execute(TestFork.TABLE_SCHEMA)
+        self.pool.insert(self.table, {'name': 'parent'})
+        self.pool.connection_pool.warmup(background=False)
+        self.parent_ids = sorted(self.pool._connection_id(entry.con) for entry in self.pool.connection_pool._idle)
+
+    def _fork(self, write=True):
+        context = multiprocessing.get_context('fork')
+        results = context.Queue()
+        process = context.Process(target=_serve, args=(self.pool, results, self.table, write))
+        process.start()
+        result = results.get(timeout=10)
+        process.join(10)
+        assert process.exitcode == 0, process.exitcode
+        assert not isinstance(result, str), result
+        return result
+
+    def testChild(self):
+        idle, created, names, ids, shared_uses = self._fork()
+        assert (idle, created) == (2, 2), (idle, created)
+        assert names == ['parent', 'child'], names
+        assert not set(ids) & set(self.parent_ids), (ids, self.parent_ids)
+        assert shared_uses == [], shared_uses
+
+        # The connections of the parent are still open and idle.
+        stats = self.pool.connection_pool.stats()
+        assert (stats.idle, stats.closed) == (2, 0), stats
+        assert len(list(self.pool.query(self.table))) == 2
+        ids = sorted(self.pool._connection_id(entry.con) for entry in self.pool.connection_pool._idle)
+        assert ids == self.parent_ids, (ids, self.parent_ids)
+
+    def testInheritedContext(self):
+        # Forked in the middle of a transaction: the child neither rolls back
+        # nor reuses the connection of the parent's context.
+        with self.pool.transaction():
+            self.pool.update(self.table, {'name': 'parent'}, {'name': 'renamed'})
+            ctx_id = self.pool._connection_id(self.pool.ctx.db)
+            # The child reads while the parent holds the write lock.
+            idle, created, names, ids, shared_uses = self._fork(write=False)
+        assert shared_uses == [], shared_uses
+        assert ctx_id not in ids, (ctx_id, ids)
+        assert names == ['parent'], names
+        assert [row.name for row in self.pool.query(self.table)] == ['renamed']
+
+
+if __name__ == '__main__':
+    unittest.main()
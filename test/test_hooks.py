@@ -0,0 +1,130 @@
+# coding: utf-8
+
+import contextlib
+import io
+import unittest
+
+from pool import DB, QueryHook, QueryRecorder, statement_shape
+from test import fakedb
+
+
+class Calls(QueryHook):
+
+    def __init__(self):
+        self.calls = []
+
+    def before_execute(self, event):
+        self.calls.append(('before', event.sql))
+
+    def after_execute(self, event):
+        self.calls.append(('after', event.sql))
+
+    def on_error(self, event, error):
+        self.calls.append(('error', event.sql, type(error)))
+
+
+class TestHooks(unittest.TestCase):
+    """
+        Test pysql query hooks and the QueryRecorder
+    """
+    TABLE = 't22'
+    TABLE_SCHEMA = """
+        CREATE TABLE IF NOT EXISTS `%s`(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name varchar(32) UNIQUE,
+            age int DEFAULT 0
+        );
+    """ % TABLE
+
+    def setUp(self):
+        fakedb.reset()
+        self.table = TestHooks.TABLE
+        self.pool = DB(fakedb, {'host': 'localhost', 'db': 'bar'})
+        self.pool.execute(TestHooks.TABLE_SCHEMA)
+
+    def testHooks(self):
+        hook = Calls()
+        self.pool.add_hook(hook)
+        self.pool.insert(self.table, {'name': 'a'})
+        with self.assertRaises(fakedb.IntegrityError):
+            self.pool.insert(self.table, {'name': 'a'})
+        sql = 'INSERT INTO t22 (name) VALUES (%s)'
+        assert hook.calls == [('before', sql), ('after', sql), ('before', sql), ('error', sql, fakedb.IntegrityError)]
+
+        self.pool.remove_hook(hook)
+        self.pool.insert(self.table, {'name': 'b'})
+        assert len(hook.calls) == 4
+
+    def testSettingsError(self):
+        hook = Calls()
+        self.pool.add_hook(hook)
+        fakedb.respond(r'@@auto_increment_increment', ['increment', 'packet'], [('x', 'y')])
+        error = None
+        try:
+            self.pool.server_settings()
+        except ValueError as e:
+            # The traceback keeps the frames of the lookup alive, with its rows.
+            error = e
+        assert isinstance(error, ValueError)
+        assert [call[0] for call in hook.calls] == ['before', 'after'], hook.calls
+
+    def testRecorder(self):
+        recorder = QueryRecorder()
+        self.pool.add_hook(recorder)
+        self.pool.insertmany(self.table, [{'name': 'n%d' % i, 'age': i} for i in range(10)])
+        for i in range(3):
+            rows = list(self.pool.query(self.table, where={'id__in': list(range(i + 1))}))
+        assert len(rows) == 2
+        self.pool.update(self.table, where={'id': 1}, obj={'age': 7})
+
+        snapshot = recorder.snapshot()
+        select = snapshot['SELECT * FROM t22 WHERE id IN (...)']
+        assert select.count == 3 and select.rows == 3 and select.errors == 0, select
+        assert sum(select.histogram.values()) == 3
+        assert select.execute > 0 and select.fetch > 0 and select.convert > 0 and select.build > 0
+        assert abs(select.total - (select.build + select.execute + select.fetch + select.convert)) < 1e-9
+        assert snapshot['INSERT INTO t22 (age,name) VALUES (...), ...'].rows == 10
+        assert snapshot['UPDATE t22 SET age = ? WHERE id = ?'].count == 1
+
+        text = recorder.prometheus()
+        assert '# TYPE pysql_query_duration_seconds histogram' in text
+        assert 'pysql_query_duration_seconds_bucket{shape="SELECT * FROM t22 WHERE id IN (...)",le="+Inf"} 3' in text
+        assert 'pysql_query_duration_seconds_count{shape="UPDATE t22 SET age = ? WHERE id = ?"} 1' in text
+        assert 'pysql_query_phase_seconds_total{shape="SELECT * FROM t22 WHERE id IN (...)",phase="fetch"}' in text
+
+        recorder.reset()
+        assert recorder.snapshot() == {}
+
+    def testLazyRows(self):
+        hook = Calls()
+        self.pool.add_hook(hook)
+        self.pool.insertmany(self.table, [{'name': 'n%d' % i} for i in range(5)])
+        del hook.calls[:]
+        rows = self.pool.query(self.table, page=1, page_num=5)
+        assert not isinstance(rows, (list, tuple)) and next(rows).name == 'n0'
+        assert [call[0] for call in hook.calls] == ['before'], 'Event reported before the rows are read'
+        assert len(list(rows)) == 4
+        assert [call[0] for call in hook.calls] == ['before', 'after'], hook.calls
+
+    def testMaxShapes(self):
+        recorder = QueryRecorder(max_shapes=2)
+        self.pool.add_hook(recorder)
+        for column in ('id', 'name', 'age'):
+            list(self.pool.query(self.table, fields=[column]))
+        assert sorted(recorder.snapshot()) == ['SELECT id FROM t22', 'SELECT name FROM t22', 'other']
+
+    def testShape(self):
+        assert statement_shape("SELECT *\n FROM t1 WHERE a = 'x''y' AND b = 2.5 LIMIT 10") == \
+            'SELECT * FROM t1 WHERE a = ? AND b = ? LIMIT ?'
+        assert statement_shape('SELECT * FROM t1 WHERE id IN (1, 2, 3)') == 'SELECT * FROM t1 WHERE id IN (...)'
+
+    def testQuiet(self):
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            self.pool.insert(self.table, {'name': 'a'})
+            list(self.pool.query(self.table))
+        assert out.getvalue() == '', 'Statements are not printed'
+
+
+if __name__ == '__main__':
+    unittest.main()
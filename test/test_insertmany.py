@@ -0,0 +1,100 @@
+# coding: utf-8
+
+import unittest
+
+from pool import DB
+from test import fakedb
+
+
+class TestInsertmany(unittest.TestCase):
+    """
+        Test pysql chunked insertmany
+    """
+    TABLE = 't14'
+    TABLE_SCHEMA = """
+        CREATE TABLE IF NOT EXISTS `%s`(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name varchar(32) UNIQUE
+        );
+    """ % TABLE
+
+    def setUp(self):
+        fakedb.reset()
+        self.table = TestInsertmany.TABLE
+        self.pool = DB(fakedb, {'host': 'localhost', 'db': 'bar'})
+        self.pool.execute(TestInsertmany.TABLE_SCHEMA)
+
+    def _inserts(self):
+        return [sql for host, sql, params in fakedb.statements if sql.startswith('INSERT')]
+
+    def _count(self):
+        return len(list(self.pool.execute('SELECT id FROM %s' % self.table)))
+
+    def testChunks(self):
+        objs = ({'name': 'n%d' % i} for i in range(10))
+        ids = self.pool.insertmany(self.table, objs, chunk_size=3)
+        assert list(ids) == list(range(1, 11)), ids
+        assert len(ids) == 10 and ids[4] == 5 and ids[-1] == 10
+        assert len(self._inserts()) == 4
+        assert self._count() == 10
+
+        del fakedb.statements[:]
+        ids = self.pool.insertmany(self.table, [{'name': 'x' * 20 + str(i)} for i in range(10)], chunk_bytes=100)
+        assert len(self._inserts()) == 4, 'Chunks must be split by size'
+        assert list(ids) == list(range(11, 21))
+
+        assert self.pool.insertmany(self.table, iter([])) is None
+
+    def testIncrement(self):
+        fakedb.variables['auto_increment_increment'] = 2
+        self.pool.insert(self.table, {'id': 100, 'name': 'x'})
+        self.pool.delete(self.table, where={'id': 100})
+        ids = self.pool.insertmany(self.table, [{'name': 'n%d' % i} for i in range(3)])
+        assert ids.ranges == [range(101, 107, 2)], ids
+
+    def testSettingsError(self):
+        failures = [fakedb.OperationalError('Lost connection')]
+
+        def fail(conn, sql, params):
+            raise failures.pop()
+        fakedb.respond(r'@@auto_increment_increment', [], fail)
+        self.assertRaises(fakedb.OperationalError, self.pool.insertmany, self.table, [{'name': 'a'}])
+        assert self._count() == 0
+
+        del fakedb._responses[0]
+        fakedb.variables['auto_increment_increment'] = 2
+        ids = self.pool.insertmany(self.table, [{'name': 'b'}, {'name': 'c'}])
+        assert ids.ranges == [range(1, 5, 2)], 'Settings of the failed read kept: %s' % ids
+
+    def testDupIds(self):
+        self.pool.insert(self.table, {'name': 'n0'})
+        ids = self.pool.insertmany(self.table, [{'name': 'n0'}, {'name': 'n1'}], dup=['name'])
+        assert list(ids) == [None, None], 'Ids guessed from an upsert: %s' % ids
+
+    def testIgnore(self):
+        self.pool.insert(self.table, {'name': 'n1'})
+        ids = self.pool.insertmany(self.table, [{'name': 'n%d' % i} for i in range(4)], mode='INSERT_IGNORE',
+                                   chunk_size=2)
+        assert self._inserts()[-1].startswith('INSERT IGNORE INTO')
+        assert list(ids) == [None, None, 4, 5], ids
+        assert self._count() == 4
+
+    def testAtomic(self):
+        objs = [{'name': 'n%d' % i} for i in range(4)] + [{'name': 'n0'}]
+        self.assertRaises(fakedb.IntegrityError, self.pool.insertmany, self.table, objs, chunk_size=2, atomic=True)
+        assert self._count() == 0, 'Chunks of a failed atomic insert must be rolled back'
+
+        self.assertRaises(fakedb.IntegrityError, self.pool.insertmany, self.table, objs, chunk_size=2)
+        assert self._count() == 4, 'Committed chunks must be kept'
+
+    def testAtomicAutocommit(self):
+        pool = DB(fakedb, {'host': 'localhost', 'db': 'bar', 'autocommit': True})
+        objs = [{'name': 'a'}, {'name': 'b'}, {'name': 'a'}]
+        self.assertRaises(fakedb.IntegrityError, pool.insertmany, self.table, objs, chunk_size=1, atomic=True)
+        assert self._count() == 0, 'Chunks of a failed atomic insert must be rolled back in autocommit mode'
+        assert len(pool.insertmany(self.table, objs[:2], chunk_size=1, atomic=True)) == 2
+        assert self._count() == 2
+
+
+if __name__ == '__main__':
+    unittest.main()
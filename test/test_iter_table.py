@@ -0,0 +1,86 @@
+# coding: utf-8
+
+import unittest
+
+from pool import DB
+from test import fakedb
+
+
+class TestIterTable(unittest.TestCase):
+    """
+        Test pysql iter_table keyset pagination
+    """
+    TABLE = 't16'
+    TABLE_SCHEMA = """
+        CREATE TABLE IF NOT EXISTS `%s`(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            grp int NOT NULL,
+            name varchar(32) DEFAULT ''
+        );
+    """ % TABLE
+
+    def setUp(self):
+        fakedb.reset()
+        self.table = TestIterTable.TABLE
+        self.pool = DB(fakedb, {'host': 'localhost', 'db': 'bar'})
+        self.pool.execute(TestIterTable.TABLE_SCHEMA)
+        self.pool.insertmany(self.table, [{'grp': i % 3, 'name': 'n%d' % i} for i in range(1, 26)])
+        del fakedb.statements[:]
+
+    def _selects(self):
+        return [(sql, params) for host, sql, params in fakedb.statements if sql.startswith('SELECT')]
+
+    def testKeyset(self):
+        rows = list(self.pool.iter_table(self.table, chunk_size=10))
+        assert [r.id for r in rows] == list(range(1, 26))
+        selects = self._selects()
+        assert len(selects) == 3, selects
+        assert selects[1] == ('SELECT * FROM t16 WHERE (id > %s) ORDER BY id LIMIT 10 OFFSET 0', [10]), selects[1]
+        assert len(set(params[0] for sql, params in selects[1:])) == 2
+
+        chunks = list(self.pool.iter_table(self.table, where={'grp': 1}, chunk_size=4, fields=['name'],
+                                           desc=True, chunks=True, row_factory='tuple'))
+        assert [len(c) for c in chunks] == [4, 4, 1], chunks
+        assert chunks[0][0] == ('n25', 25), chunks[0][0]
+        assert chunks[-1][-1] == ('n1', 1)
+
+    def testCompositeKey(self):
+        rows = list(self.pool.iter_table(self.table, key=('grp', 'id'), chunk_size=4, row_factory='record'))
+        expected = sorted((i % 3, i) for i in range(1, 26))
+        assert [(r.grp, r.id) for r in rows] == expected
+        sql, params = self._selects()[1]
+        assert 'WHERE (grp > %s OR (grp = %s AND id > %s)) ORDER BY grp, id' in sql, sql
+
+    def testConnection(self):
+        in_use = set()
+        for row in self.pool.iter_table(self.table, key='id', chunk_size=5):
+            in_use.add(self.pool.connection_pool.stats().in_use)
+        assert in_use == set([1]), 'One connection must serve the walk'
+        assert self.pool.connection_pool.stats().in_use == 0
+
+        walk = self.pool.iter_table(self.table, chunk_size=5)
+        next(walk)
+        walk.close()
+        assert self.pool.connection_pool.stats().in_use == 0
+
+    def testTransaction(self):
+        walk = self.pool.iter_table(self.table, chunk_size=5)
+        with self.pool.transaction():
+            self.pool.insert(self.table, {'grp': 9})
+            next(walk)
+            assert self.pool.connection_pool.stats().in_use == 2, 'Walk begun outside joined the transaction'
+        walk.close()
+
+        try:
+            with self.pool.transaction():
+                self.pool.insert(self.table, {'grp': 8})
+                list(self.pool.iter_table(self.table, key='nope'))
+        except fakedb.OperationalError:
+            pass
+        rows = list(self.pool.query(self.table, where={'grp': 8}))
+        assert rows == [], 'Failed chunk must roll the transaction back'
+        assert self.pool.connection_pool.stats().in_use == 0
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+# coding: utf-8
+
+import time
+import unittest
+
+from pool import DB
+from test import fakedb
+
+
+class TestReplica(unittest.TestCase):
+    """
+        Test pysql read/write splitting over a primary and two replicas
+    """
+    TABLE = 't11'
+    TABLE_SCHEMA = """
+        CREATE TABLE IF NOT EXISTS `%s`(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name varchar(32) DEFAULT ''
+        );
+    """ % TABLE
+    HOSTS = ('primary', 'replica1', 'replica2')
+
+    def setUp(self):
+        fakedb.reset()
+        self.table = TestReplica.TABLE
+        # Every server holds one row named after itself, so a read tells where it ran.
+        for host in self.HOSTS:
+            db = DB(fakedb, {'host': host, 'db': 'bar'})
+            db.execute(TestReplica.TABLE_SCHEMA)
+            db.insert(self.table, {'name': host})
+
+    def _pool(self, **options):
+        options.setdefault('replica_sticky_window', 0)
+        return DB(fakedb, {'host': 'primary', 'db': 'bar'},
+                  replicas=[{'host': 'replica1'}, {'host': 'replica2'}], **options)
+
+    def _read(self, pool, **kwargs):
+        return [row.name for row in pool.query(self.table, fields=['name'], **kwargs)][0]
+
+    def _hosts(self, pattern):
+        return [host for host, sql, params in fakedb.statements if sql.startswith(pattern)]
+
+    def testRoundRobin(self):
+        pool = self._pool()
+        hosts = [self._read(pool) for _ in range(4)]
+        assert hosts == ['replica1', 'replica2', 'replica1', 'replica2'], hosts
+        assert self._read(pool, use_primary=True) == 'primary'
+        assert pool.execute('SELECT name FROM %s' % self.table, row_factory='tuple').__next__()[0] == 'replica1'
+
+    def testWrites(self):
+        pool = self._pool()
+        del fakedb.statements[:]
+        pool.insert(self.table, {'name': 'x'})
+        pool.update(self.table, where={'name': 'x'}, obj={'name': 'y'})
+        pool.execute('DELETE FROM %s WHERE name = "y"' % self.table)
+        list(pool.execute('SELECT * FROM %s FOR UPDATE' % self.table))
+        hosts = set(host for host, sql, params in fakedb.statements if 'SLAVE' not in sql)
+        assert hosts == set(['primary']), fakedb.statements
+
+    def testStickiness(self):
+        pool = self._pool(replica_sticky_window=60)
+        assert self._read(pool) == 'replica1'
+        pool.insert(self.table, {'name': 'z'})
+        assert self._read(pool) == 'primary', 'Read after write left the primary'
+
+    def testLag(self):
+        fakedb.respond('SHOW SLAVE STATUS', ['Seconds_Behind_Master'], [[0]])
+        fakedb.respond('SHOW SLAVE STATUS', ['Seconds_Behind_Master'], [[100]], host='replica1')
+        pool = self._pool(max_replica_lag=5)
+        pool.replicas.check()
+        assert [self._read(pool) for _ in range(3)] == ['replica2'] * 3
+        pool.replicas.close()
+
+        fakedb.respond('SHOW SLAVE STATUS', ['Seconds_Behind_Master'], [[None]], host='replica2')
+        pool = self._pool(max_replica_lag=5)
+        pool.replicas.check()
+        assert self._read(pool) == 'primary', 'All replicas lag, the primary must serve reads'
+        pool.replicas.close()
+
+    def testLagChecker(self):
+        fakedb.respond('SHOW SLAVE STATUS', ['Seconds_Behind_Master'], [[0]])
+        pool = self._pool(max_replica_lag=5, replica_lag_check_interval=0.01)
+        self._read(pool)
+        for _ in range(100):
+            if self._read(pool) != 'primary':
+                break
+            time.sleep(0.01)
+        assert self._read(pool).startswith('replica'), 'Lags never checked'
+        checks = len(self._hosts('SHOW SLAVE STATUS'))
+        time.sleep(0.1)
+        assert len(self._hosts('SHOW SLAVE STATUS')) > checks, 'Lags not checked in the background'
+        pool.replicas.close()
+
+    def testLeastInflight(self):
+        pool = self._pool(replica_strategy='least_inflight')
+        replica1, replica2 = pool.replicas.replicas
+        pool.replicas.begin(replica1)
+        assert self._read(pool) == 'replica2'
+        pool.replicas.end(replica1)
+        pool.replicas.begin(replica2)
+        assert self._read(pool) == 'replica1'
+        assert pool.replicas.inflight() == [0, 1]
+
+    def testStreamInflight(self):
+        pool = self._pool(replica_strategy='least_inflight')
+        rows = pool.query(self.table, stream=True, batch_size=1)
+        assert pool.replicas.inflight() == [1, 0], 'Open stream not counted: %s' % pool.replicas.inflight()
+        assert self._read(pool) == 'replica2'
+        rows.close()
+        assert pool.replicas.inflight() == [0, 0], pool.replicas.inflight()
+
+        pool.query_columns(self.table, use_numpy=False)
+        assert pool.replicas.inflight() == [0, 0], pool.replicas.inflight()
+
+
+if __name__ == '__main__':
+    unittest.main()
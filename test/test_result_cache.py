@@ -0,0 +1,118 @@
+# coding: utf-8
+
+import threading
+import time
+import unittest
+
+from pool import DB, ResultCache
+from test import fakedb
+
+
+class TestResultCache(unittest.TestCase):
+    """
+        Test pysql result cache of query(cache=True)
+    """
+    TABLE = 't13'
+    TABLE_SCHEMA = """
+        CREATE TABLE IF NOT EXISTS `%s`(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name varchar(32) DEFAULT ''
+        );
+    """ % TABLE
+
+    def setUp(self):
+        fakedb.reset()
+        self.table = TestResultCache.TABLE
+        self.pool = DB(fakedb, {'host': 'localhost', 'db': 'bar'}, result_cache_bytes=1 << 20)
+        self.pool.execute(TestResultCache.TABLE_SCHEMA)
+        self.pool.insertmany(self.table, [{'name': 'n%d' % i} for i in range(5)])
+
+    def _selects(self):
+        return len([sql for host, sql, params in fakedb.statements if sql.startswith('SELECT *')])
+
+    def testHit(self):
+        rows = list(self.pool.query(self.table, where={'id__in': [1, 2]}, cache=True))
+        again = list(self.pool.query(self.table, where={'id__in': [1, 2]}, cache=True, row_factory='record'))
+        assert [r.name for r in rows] == [r.name for r in again] == ['n0', 'n1']
+        assert self._selects() == 1, 'Second query must be served by the cache'
+
+        list(self.pool.query(self.table, where={'id__in': [1, 3]}, cache=True))
+        list(self.pool.query(self.table, where={'id__in': [1, 2]}))
+        assert self._selects() == 3
+
+        stats = self.pool.result_cache.stats()
+        assert (stats.hits, stats.misses, stats.size) == (1, 2, 2), stats
+        assert stats.hit_ratio == 1 / 3.0
+
+    def testReplicaRead(self):
+        replica = DB(fakedb, {'host': 'replica', 'db': 'bar'})
+        replica.execute(TestResultCache.TABLE_SCHEMA)
+        replica.insert(self.table, {'name': 'stale'})
+        fakedb.respond('SHOW SLAVE STATUS', ['Seconds_Behind_Master'], [[0]])
+        pool = DB(fakedb, {'host': 'localhost', 'db': 'bar'}, replicas=[{'host': 'replica'}],
+                  replica_sticky_window=0.05, result_cache_bytes=1 << 20)
+        pool.update(self.table, where={'id': 1}, obj={'name': 'x'})
+
+        def read():
+            # Another thread, not kept on the primary by the write.
+            names = []
+            thread = threading.Thread(target=lambda: names.extend(r.name for r in pool.query(self.table, cache=True)))
+            thread.start()
+            thread.join()
+            return names
+
+        assert read() == ['stale']
+        assert len(pool.result_cache) == 0, 'Replica read cached right after an invalidation'
+        pool.replicas.check()
+        time.sleep(0.06)
+        read()
+        assert len(pool.result_cache) == 1, 'Replica read not cached once caught up'
+        pool.replicas.close()
+
+    def testInvalidation(self):
+        list(self.pool.query(self.table, cache=True))
+        self.pool.update(self.table, where={'id': 1}, obj={'name': 'x'})
+        rows = list(self.pool.query(self.table, cache=True))
+        assert rows[0].name == 'x', rows
+        assert self.pool.result_cache.stats().invalidations == 1
+
+        self.pool.delete(self.table, where={'id': 1})
+        assert len(list(self.pool.query(self.table, cache=True))) == 4
+
+    def testTransaction(self):
+        list(self.pool.query(self.table, cache=True))
+        with self.pool.transaction():
+            self.pool.update(self.table, where={'id': 1}, obj={'name': 'x'})
+            assert len(self.pool.result_cache) == 1, 'Invalidated before commit'
+            assert list(self.pool.query(self.table, cache=True))[0].name == 'x', 'Cache used in a transaction'
+        assert len(self.pool.result_cache) == 0
+
+    def testExpiry(self):
+        cache = ResultCache(maxbytes=1 << 20, ttl=60, ttls={'t1': 0.01})
+        cache.put('a', ['t1'], (None, [(1,)]), cache.generation(['t1']))
+        cache.put('b', ['t1', 't2'], (None, [(2,)]), cache.generation(['t1', 't2']))
+        cache.put('c', ['t2'], (None, [(3,)]), cache.generation(['t2']))
+        time.sleep(0.02)
+        assert cache.get('a') is None and cache.get('b') is None
+        assert cache.get('c') == (None, [(3,)])
+        assert cache.stats().expirations == 2
+
+        # Results read before an invalidation are not cached.
+        generation = cache.generation(['t2'])
+        cache.invalidate(['t2'])
+        cache.put('d', ['t2'], (None, [(4,)]), generation)
+        assert cache.get('d') is None and cache.get('c') is None
+
+    def testEviction(self):
+        row = (1, 'x' * 100)
+        cache = ResultCache(maxbytes=3000)
+        for i in range(20):
+            cache.put(i, ['t'], (None, [row] * 5), cache.generation(['t']))
+            cache.get(0)
+        stats = cache.stats()
+        assert stats.nbytes <= 3000 and stats.evictions == 20 - stats.size, stats
+        assert cache.get(0) is not None, 'Recently used entry evicted'
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+# coding: utf-8
+
+import unittest
+
+from pool import DB
+from pool import Item
+from test import fakedb
+
+
+class TestRowFactory(unittest.TestCase):
+    """
+        Test pysql row factories
+    """
+    TABLE = 't8'
+    TABLE_SCHEMA = """
+        CREATE TABLE IF NOT EXISTS `%s`(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name varchar(32) DEFAULT '',
+            age smallint DEFAULT '0'
+        );
+    """ % TABLE
+
+    def setUp(self):
+        fakedb.reset()
+        self.pool = DB(fakedb, {'host': 'rows', 'db': 'bar'})
+        self.pool.execute(TestRowFactory.TABLE_SCHEMA)
+        self.table = TestRowFactory.TABLE
+        self.pool.insertmany(self.table, [{'name': 'n%d' % i, 'age': i} for i in range(3)])
+
+    def _query(self, **kwargs):
+        return list(self.pool.query(table=self.table, fields=['name', 'age'], order_by=['id'], **kwargs))
+
+    def testItem(self):
+        rows = self._query()
+        assert rows[1] == Item(name='n1', age=1) and rows[1].age == 1, 'Wrong rows: %s' % rows
+
+    def testTuple(self):
+        rows = self._query(row_factory='tuple')
+        assert rows == [('n0', 0), ('n1', 1), ('n2', 2)], 'Wrong rows: %s' % rows
+
+    def testRecord(self):
+        rows = self._query(row_factory='record')
+        assert rows[2].name == 'n2' and rows[2] == ('n2', 2), 'Wrong rows: %s' % rows
+        assert type(rows[0]) is type(self._query(row_factory='record')[0]), 'Record class is not cached'
+
+        with self.pool.query(table=self.table, fields=['age'], stream=True, row_factory='record') as rows:
+            assert [row.age for row in rows] == [0, 1, 2]
+
+    def testPoolDefault(self):
+        self.pool.row_factory = 'tuple'
+        assert self._query()[0] == ('n0', 0)
+        assert self._query(row_factory=lambda description: list)[0] == ['n0', 0]
+
+
+if __name__ == '__main__':
+    unittest.main()
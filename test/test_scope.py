@@ -0,0 +1,139 @@
+# coding: utf-8
+
+import asyncio
+import contextvars
+import threading
+import time
+import unittest
+
+from pool import DB
+from test import fakedb
+
+
+class TestScope(unittest.TestCase):
+    """
+        Test pysql connection scopes and the leak detector
+    """
+    TABLE = 't26'
+    TABLE_SCHEMA = """
+        CREATE TABLE IF NOT EXISTS `%s`(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name varchar(32) DEFAULT ''
+        );
+    """ % TABLE
+
+    def setUp(self):
+        fakedb.reset()
+        self.table = TestScope.TABLE
+        self.leaks = []
+        self.pool = DB(fakedb, {'host': 'localhost', 'db': 'bar', 'leak_threshold': 0.05,
+                                'leak_callback': self.leaks.append})
+        self.pool.execute(TestScope.TABLE_SCHEMA)
+
+    def _stats(self):
+        return self.pool.connection_pool.stats()
+
+    def _names(self):
+        return [row.name for row in self.pool.query(self.table, order_by='id')]
+
+    def testOneConnection(self):
+        checkouts = self._stats().checkouts
+        with self.pool.connection() as conn:
+            self.pool.insert(self.table, {'name': 'a'})
+            with self.pool.connection() as inner:
+                assert inner is conn
+                self.pool.update(self.table, {'name': 'a'}, {'name': 'b'})
+            assert self._names() == ['b']
+            assert self._stats().in_use == 1
+        assert self._stats().checkouts == checkouts + 1
+        assert self._stats().in_use == 0
+
+    def testReleaseOnError(self):
+        with self.assertRaises(fakedb.Error):
+            with self.pool.connection():
+                self.pool.insert(self.table, {'name': 'a'})
+                self.pool.execute('SELECT * FROM missing')
+        assert self._stats().in_use == 0
+        # Statements outside transactions are committed by their call.
+        assert self._names() == ['a']
+
+    def testOpenTransaction(self):
+        with self.pool.connection():
+            self.pool.transaction().begin()
+            self.pool.insert(self.table, {'name': 'a'})
+        assert self._stats().in_use == 0
+        assert self._names() == []
+        assert self.pool.transaction_stats().rollbacks == 1
+
+    def testScopeInTransaction(self):
+        with self.pool.transaction():
+            with self.pool.connection():
+                self.pool.insert(self.table, {'name': 'a'})
+            assert self._stats().in_use == 1
+            self.pool.insert(self.table, {'name': 'b'})
+        assert self._stats().in_use == 0
+        assert self._names() == ['a', 'b']
+
+    def testFailedCommit(self):
+        commit = fakedb.Connection.commit
+
+        def fail(conn):
+            raise fakedb.OperationalError(2013, 'Lost connection to MySQL server during query')
+        fakedb.Connection.commit = fail
+        try:
+            with self.assertRaises(fakedb.OperationalError):
+                self.pool.insert(self.table, {'name': 'a'})
+        finally:
+            fakedb.Connection.commit = commit
+        assert self.pool._ctx.get('db') is None
+        assert self._stats().in_use == 0
+        assert self._names() == []
+
+    def testContexts(self):
+        # Two contexts of the same thread, e.g. two tasks, hold their own connections.
+        scopes = [self.pool.connection() for i in range(2)]
+        contexts = [contextvars.Context() for i in range(2)]
+        conns = [context.run(scope.__enter__) for context, scope in zip(contexts, scopes)]
+        assert conns[0] is not conns[1]
+        assert self._stats().in_use == 2
+        for context, scope in zip(contexts, scopes):
+            context.run(scope.__exit__, None, None, None)
+        assert self._stats().in_use == 0
+        assert self.pool._ctx.get('db') is None
+
+    def testCopiedContext(self):
+        with self.pool.connection() as conn:
+            self.pool.insert(self.table, {'name': 'a'})
+            # A thread running a copy of the context has its own state and connection.
+            thread = threading.Thread(target=contextvars.copy_context().run,
+                                      args=(self.pool.insert, self.table, {'name': 'b'}))
+            thread.start()
+            thread.join()
+            assert self.pool.ctx.db is conn
+            assert self._stats().in_use == 1
+
+            async def child():
+                self.pool.insert(self.table, {'name': 'c'})
+                with self.pool.connection() as own:
+                    return own is conn
+
+            async def main():
+                return await asyncio.create_task(child())
+            assert asyncio.run(main()) is False
+        assert self._stats().in_use == 0
+        assert self._names() == ['a', 'b', 'c']
+
+    def testLeak(self):
+        with self.pool.connection():
+            time.sleep(0.2)
+            leaks = self.pool.connection_pool.leaks()
+            assert len(leaks) == 1 and leaks[0].held > 0.05, leaks
+        assert len(self.leaks) == 1, self.leaks
+        stack = self.leaks[0].stack
+        assert 'in testLeak' in stack and 'in _track' not in stack, stack
+        assert stack.index('in testLeak') < stack.index('in connection'), 'Outermost frame first'
+        assert self.pool.connection_pool.leaks() == []
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+# coding: utf-8
+
+import unittest
+
+from pool import DB, PRIORITY_BATCH
+from shard import ShardedPool, parse_order_by
+from test import fakedb
+
+
+class TestShard(unittest.TestCase):
+    """
+        Test pysql sharding over three stand-in servers, rows are sharded by user_id % 3
+    """
+    TABLE = 't12'
+    TABLE_SCHEMA = """
+        CREATE TABLE IF NOT EXISTS `%s`(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id int NOT NULL,
+            name varchar(32) DEFAULT ''
+        );
+    """ % TABLE
+    HOSTS = ('shard0', 'shard1', 'shard2')
+
+    def setUp(self):
+        fakedb.reset()
+        self.table = TestShard.TABLE
+        shards = [DB(fakedb, {'host': host, 'db': 'bar'}) for host in self.HOSTS]
+        for shard in shards:
+            shard.execute(TestShard.TABLE_SCHEMA)
+        self.pool = ShardedPool(shards, shard_key='user_id')
+        self.pool.insertmany(self.table, [{'user_id': i, 'name': 'n%02d' % i} for i in range(12)])
+        del fakedb.statements[:]
+
+    def tearDown(self):
+        self.pool.close()
+
+    def _hosts(self):
+        return sorted(set(host for host, sql, params in fakedb.statements))
+
+    def testInsert(self):
+        self.pool.insert(self.table, {'user_id': 13, 'name': 'x'})
+        assert self._hosts() == ['shard1'], fakedb.statements
+
+        del fakedb.statements[:]
+        ids = self.pool.insertmany(self.table, [{'user_id': i, 'name': 'y'} for i in (20, 21, 23)])
+        assert ids == [5, 5, 6], ids
+        inserts = [host for host, sql, params in fakedb.statements if sql.startswith('INSERT')]
+        assert sorted(inserts) == ['shard0', 'shard2'], 'One batch per shard expected'
+
+        ids = self.pool.insertmany(self.table, ({'user_id': i, 'name': 'z'} for i in (24, 25)))
+        assert ids == [6, 6], ids
+        assert self.pool.insertmany(self.table, iter([])) is None
+
+    def testRouting(self):
+        rows = list(self.pool.query(self.table, where={'user_id': 4}))
+        assert [r.name for r in rows] == ['n04'], rows
+        assert self._hosts() == ['shard1']
+
+        del fakedb.statements[:]
+        rows = self.pool.query(self.table, where={'user_id__in': [3, 6, 5]}, order_by='user_id')
+        assert [r.user_id for r in rows] == [3, 5, 6]
+        assert self._hosts() == ['shard0', 'shard2']
+        params = dict((host, tuple(p)) for host, sql, p in fakedb.statements)
+        assert params == {'shard0': (3, 6), 'shard2': (5,)}, params
+
+    def testScatter(self):
+        rows = list(self.pool.query(self.table, where={'name__like': 'n%'}))
+        assert sorted(r.user_id for r in rows) == list(range(12))
+        assert self._hosts() == list(self.HOSTS)
+
+    def testMerge(self):
+        rows = self.pool.query(self.table, order_by='user_id DESC', fields=['user_id'])
+        assert [r.user_id for r in rows] == list(range(11, -1, -1))
+
+        rows = self.pool.query(self.table, order_by=['name'], page=2, page_num=5, row_factory='record')
+        assert [r.name for r in rows] == ['n%02d' % i for i in range(5, 10)]
+        limits = set(sql[sql.index('LIMIT'):] for host, sql, params in fakedb.statements if 'LIMIT' in sql)
+        assert limits == set(['LIMIT 10 OFFSET 0']), 'Each shard must return the first two pages'
+
+        with self.pool.query(self.table, order_by='id, user_id DESC', row_factory='tuple') as rows:
+            first = next(rows)
+            assert first[0] == 1 and first[1] == 2, first
+        for shard in self.pool.shards:
+            assert shard.connection_pool.stats().in_use == 0, 'Stream not closed'
+
+        assert parse_order_by('`t`.age desc, id') == [('age', True), ('id', False)]
+
+    def testWrite(self):
+        assert self.pool.update(self.table, where={'user_id__gt': 8}, obj={'name': 'z'}) == 3
+        assert self._hosts() == list(self.HOSTS)
+        assert self.pool.delete(self.table, where={'user_id': 9}) == 1
+        assert self.pool.delete(self.table, where={'name': 'z'}) == 2
+        assert len(list(self.pool.query(self.table))) == 9
+
+    def testTimeout(self):
+        rows = list(self.pool.query(self.table, order_by='user_id', page=1, page_num=4, timeout=5))
+        assert [row.user_id for row in rows] == [0, 1, 2, 3], rows
+        selects = [sql for host, sql, params in fakedb.statements if sql.startswith('SELECT')]
+        assert len(selects) == 3 and all('MAX_EXECUTION_TIME' in sql for sql in selects), selects
+
+        shard = self.pool.shards[0]
+        with shard.admission_scope(PRIORITY_BATCH):
+            scopes = self.pool._scatter(dict((index, lambda shard: shard._admission_scope.get()) for index in range(3)))
+        assert scopes[0][0] == PRIORITY_BATCH, 'Shard threads lost the context of the caller'
+
+
+if __name__ == '__main__':
+    unittest.main()
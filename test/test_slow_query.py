@@ -0,0 +1,122 @@
+# coding: utf-8
+
+import io
+import json
+import unittest
+
+from pool import DB, Item, SlowQueryLog, TooManyConnections, plan_flags
+from test import fakedb
+
+
+PLAN = {
+    'query_block': {
+        'select_id': 1,
+        'ordering_operation': {
+            'using_filesort': True,
+            'table': {'table_name': 't23', 'access_type': 'ALL', 'rows_examined_per_scan': 1000},
+        },
+    },
+}
+
+
+class TestSlowQuery(unittest.TestCase):
+    """
+        Test pysql slow query log
+    """
+    TABLE = 't23'
+    TABLE_SCHEMA = """
+        CREATE TABLE IF NOT EXISTS `%s`(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name varchar(32) DEFAULT '',
+            age int DEFAULT 0
+        );
+    """ % TABLE
+
+    def setUp(self):
+        fakedb.reset()
+        self.table = TestSlowQuery.TABLE
+        self.pool = DB(fakedb, {'host': 'localhost', 'db': 'bar'})
+        self.pool.execute(TestSlowQuery.TABLE_SCHEMA)
+        self.pool.insertmany(self.table, [{'name': 'n%d' % i, 'age': i} for i in range(5)])
+        fakedb.respond(r'^EXPLAIN FORMAT=JSON', ['EXPLAIN'], [[json.dumps(PLAN)]])
+
+    def testThreshold(self):
+        slow = SlowQueryLog(self.pool, threshold=60)
+        self.pool.add_hook(slow)
+        list(self.pool.query(self.table))
+        assert slow.entries() == []
+
+    def testCapture(self):
+        slow = SlowQueryLog(self.pool, threshold=0, explain_sample=1.0)
+        self.pool.add_hook(slow)
+        list(self.pool.query(self.table, where={'age__gt': 2}, order_by='name'))
+        self.pool.update(self.table, where={'id': 1}, obj={'name': 'x'})
+        slow.flush()
+
+        select, update = slow.entries()
+        assert select.shape == 'SELECT * FROM t23 WHERE age > ? ORDER BY name', select.shape
+        assert select.params == [2] and select.rowcount == 2 and select.duration > 0
+        assert select.site.endswith('in testCapture'), select.site
+        assert select.plan == PLAN and select.full_scan and select.filesort
+        assert update.params == ['x', 1]
+
+        explains = [sql for host, sql, params in fakedb.statements if sql.startswith('EXPLAIN')]
+        assert len(explains) == 2
+        assert slow.entries(shape=update.shape) == [update]
+        assert len(slow.entries(full_scan=True)) == 2 and slow.entries(min_duration=60) == []
+        assert self.pool.connection_pool.stats().in_use == 0
+        slow.close()
+
+    def testRedact(self):
+        slow = SlowQueryLog(self.pool, threshold=0, redact=True)
+        self.pool.add_hook(slow)
+        list(self.pool.query(self.table, where={'name': 'secret'}))
+        entry, = slow.entries()
+        assert entry.params is None and entry.plan is None
+        assert 'secret' not in json.dumps(entry)
+
+        slow = SlowQueryLog(self.pool, threshold=0, redact=lambda params: ['?'] * len(params))
+        self.pool.add_hook(slow)
+        self.pool.delete(self.table, where={'name': 'secret'})
+        assert slow.entries()[0].params == ['?']
+
+    def testExplainError(self):
+        fakedb.respond(r'^EXPLAIN FORMAT=JSON', None, lambda conn, sql, params: 1 / 0)
+        slow = SlowQueryLog(self.pool, threshold=0, explain_sample=1.0)
+        self.pool.add_hook(slow)
+        list(self.pool.query(self.table))
+        slow.flush()
+        entry, = slow.entries()
+        assert 'ZeroDivisionError' in entry.explain_error and entry.plan is None
+        slow.close()
+
+    def testExplainCheckout(self):
+        slow = SlowQueryLog(self.pool, threshold=0, explain_sample=1.0)
+        entry = Item(plan=None, explain_error=None)
+
+        def exhausted():
+            raise TooManyConnections('Too many connections: 1')
+        self.pool.connection_pool.connection = exhausted
+        slow._explain(entry, 'SELECT * FROM %s' % self.table, ())
+        assert 'TooManyConnections' in entry.explain_error and entry.plan is None
+        slow.close()
+
+    def testDump(self):
+        slow = SlowQueryLog(self.pool, threshold=0)
+        self.pool.add_hook(slow)
+        list(self.pool.query(self.table, where={'id__in': [1, 2]}))
+        with self.assertRaises(fakedb.OperationalError):
+            self.pool.execute('SELECT nope FROM t23')
+        out = io.StringIO()
+        assert slow.dump(out) == 2
+        lines = [json.loads(line) for line in out.getvalue().splitlines()]
+        assert lines[0]['shape'] == 'SELECT * FROM t23 WHERE id IN (...)' and lines[0]['params'] == [1, 2]
+        assert lines[1]['error'].startswith('OperationalError')
+
+    def testPlanFlags(self):
+        assert plan_flags(PLAN) == (True, True)
+        assert plan_flags({'query_block': {'table': {'access_type': 'ref'}}}) == (False, False)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+# coding: utf-8
+
+import unittest
+
+from pool import DB, Field, CompiledQuery
+
+
+class TestStatementCache(unittest.TestCase):
+    """
+        Test pysql compiled statement cache
+    """
+    TABLE = 't6'
+
+    def setUp(self):
+        self.db = DB(None, {})
+        self.nocache = DB(None, {}, statement_cache_size=0)
+
+    def assertSameSQL(self, compile_name, *args):
+        expected = getattr(self.nocache, compile_name)(*args)
+        # First call renders and caches the shape, the second one is bound from cache.
+        getattr(self.db, compile_name)(*args)
+        compiled = getattr(self.db, compile_name)(*args)
+        assert isinstance(compiled, CompiledQuery), 'Not served from cache: %r' % compiled
+        assert compiled.query() == expected.query(), '%s != %s' % (compiled.query(), expected.query())
+        assert list(compiled.values()) == list(expected.values()), \
+            '%s != %s' % (compiled.values(), expected.values())
+
+    def testInsert(self):
+        self.assertSameSQL('_compile_insert', self.TABLE, {'name': 'a', 'age': 1}, 'INSERT', {})
+        self.assertSameSQL('_compile_insert', self.TABLE, {'name': 'a', 'age': 1}, 'REPLACE', {'age': Field('age+1')})
+
+    def testDupTypes(self):
+        for flag in (True, 1, 1.0):
+            compiled = self.db._compile_insert(self.TABLE, {'name': 'a'}, 'INSERT', {'flag': flag})
+            assert compiled.query().endswith('flag = %s' % flag), 'Wrong dup: %s' % compiled.query()
+
+    def testUpdate(self):
+        where = {'id__in': [1, 2, 3], 'age__gte': 10, 'name': 'x'}
+        self.assertSameSQL('_compile_update', self.TABLE, where, {'age': 9, 'num': Field('num+1')})
+
+    def testDelete(self):
+        self.assertSameSQL('_compile_delete', self.TABLE, {'id__nin': [4, 5]}, None)
+
+    def testQuery(self):
+        args = (self.TABLE, {'id__in': ['a', 'b'], 'age__lt': 3}, None, None, ['id DESC'], ['*'], 0, 10)
+        self.assertSameSQL('_compile_select', *args)
+
+    def testShapeKeys(self):
+        self.db._compile_update(self.TABLE, {'id__in': [1, 2]}, {'age': 1})
+        self.db._compile_update(self.TABLE, {'id__in': [3, 4]}, {'age': 2})
+        self.db._compile_update(self.TABLE, {'id__in': [1, 2, 3]}, {'age': 1})
+        stats = self.db.statement_cache.stats()
+        assert (stats.hits, stats.misses) == (1, 2), 'Wrong counters: %s' % stats
+
+        compiled = self.db._compile_update(self.TABLE, {'id__in': [7, 8]}, {'age': 5})
+        assert compiled.values() == (5, 7, 8), 'Wrong params: %s' % (compiled.values(),)
+
+    def testEviction(self):
+        db = DB(None, {}, statement_cache_size=2)
+        for column in ('a', 'b', 'c'):
+            db._compile_delete(self.TABLE, {column: 1}, None)
+        stats = db.statement_cache.stats()
+        assert stats.size == 2 and stats.evictions == 1, 'Wrong counters: %s' % stats
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+# coding: utf-8
+
+import unittest
+
+from pool import DB
+from test import fakedb
+
+
+class TestStream(unittest.TestCase):
+    """
+        Test pysql streaming query API
+    """
+    TABLE = 't7'
+    TABLE_SCHEMA = """
+        CREATE TABLE IF NOT EXISTS `%s`(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name varchar(32) DEFAULT '',
+            age smallint DEFAULT '0'
+        );
+    """ % TABLE
+
+    def setUp(self):
+        fakedb.reset()
+        self.pool = DB(fakedb, {'host': 'stream', 'db': 'bar'})
+        self.pool.execute(TestStream.TABLE_SCHEMA)
+        self.table = TestStream.TABLE
+        self.pool.insertmany(self.table, [{'name': 'n%d' % i, 'age': i} for i in range(25)])
+
+    def _in_use(self):
+        return self.pool.connection_pool.stats().in_use
+
+    def testStream(self):
+        with self.pool.query(table=self.table, where={'age__gte': 5}, stream=True, batch_size=10) as rows:
+            cursor = rows.cursor
+            assert isinstance(cursor, fakedb.SSCursor), 'Not a server side cursor: %r' % cursor
+            first = next(rows)
+            assert first.name == 'n5', 'Wrong row: %s' % first
+            assert self._in_use() == 1, 'Connection released too early'
+            ages = [first.age] + [row.age for row in rows]
+
+        assert ages == list(range(5, 25)), 'Wrong rows: %s' % ages
+        assert self._in_use() == 0, 'Connection not released'
+
+    def testCloseEarly(self):
+        rows = self.pool.execute('SELECT * FROM %s' % self.table, stream=True, batch_size=3)
+        assert next(rows).age == 0
+        rows.close()
+        assert self._in_use() == 0, 'Connection not released'
+        assert list(rows) == [], 'Closed stream still yields rows'
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+# coding: utf-8
+
+import time
+import unittest
+
+from pool import DB, QueryTimeout
+from test import fakedb
+
+
+# Statements running until they are interrupted.
+ENDLESS = 'WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c) SELECT count(*) FROM c'
+ENDLESS_SELECT = 'SELECT count(*) FROM (%s)' % ENDLESS
+
+
+class TestTimeout(unittest.TestCase):
+    """
+        Test pysql per call timeouts
+    """
+    TABLE = 't24'
+    TABLE_SCHEMA = """
+        CREATE TABLE IF NOT EXISTS `%s`(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name varchar(32) DEFAULT '',
+            age int DEFAULT 0
+        );
+    """ % TABLE
+
+    def setUp(self):
+        fakedb.reset()
+        self.table = TestTimeout.TABLE
+        self.pool = DB(fakedb, {'host': 'localhost', 'db': 'bar'})
+        self.pool.execute(TestTimeout.TABLE_SCHEMA)
+        self.pool.insertmany(self.table, [{'name': 'n%d' % i} for i in range(10)])
+        del fakedb.statements[:]
+
+    def _timed_out(self, call, *args, **kwargs):
+        start = time.time()
+        with self.assertRaises(QueryTimeout):
+            call(*args, **kwargs)
+        return time.time() - start
+
+    def testSelect(self):
+        elapsed = self._timed_out(self.pool.execute, ENDLESS_SELECT, timeout=0.1)
+        assert 0.05 < elapsed < 2, elapsed
+        sql = fakedb.statements[0][1]
+        assert sql.startswith('SELECT /*+ MAX_EXECUTION_TIME(') and ') */ count(*)' in sql, sql
+        assert not [s for h, s, p in fakedb.statements if s.startswith('KILL')]
+        assert self.pool.connection_pool.stats().in_use == 0
+        assert len(list(self.pool.query(self.table, timeout=5))) == 10
+
+    def testKill(self):
+        update = 'UPDATE %s SET age = (SELECT count(*) FROM (%s))' % (self.table, ENDLESS)
+        elapsed = self._timed_out(self.pool.execute, update, timeout=0.1)
+        assert 0.05 < elapsed < 2, elapsed
+        kills = [s for h, s, p in fakedb.statements if s.startswith('KILL QUERY')]
+        assert len(kills) == 1, kills
+        assert self.pool._watchdog.kills == 1
+
+        # The connection is clean and back in the pool.
+        stats = self.pool.connection_pool.stats()
+        assert stats.in_use == 0 and stats.idle == 1, stats
+        assert self.pool.update(self.table, where={'id': 1}, obj={'age': 3}) == 1
+        assert sum(row.age for row in self.pool.query(self.table)) == 3
+
+    def testTransaction(self):
+        with self.assertRaises(QueryTimeout):
+            with self.pool.transaction():
+                self.pool.delete(self.table, where={'id': 1})
+                self.pool.execute('DELETE FROM %s WHERE id IN (SELECT count(*) FROM (%s))' % (self.table, ENDLESS),
+                                  timeout=0.1)
+        assert len(list(self.pool.query(self.table))) == 10, 'The transaction is rolled back'
+
+    def testDefault(self):
+        pool = DB(fakedb, {'host': 'localhost', 'db': 'bar'}, query_timeout=0.1)
+        self._timed_out(pool.execute, ENDLESS_SELECT)
+        elapsed = self._timed_out(pool.execute, ENDLESS_SELECT, timeout=0.3)
+        assert elapsed > 0.2, 'An explicit timeout wins over the default'
+
+    def testBudget(self):
+        # Ten batches with a pause of 0.05s between them don't fit in 0.12s.
+        self._timed_out(self.pool.update, self.table, where={'id__gt': 0}, obj={'age': 1}, batch_size=1,
+                        sleep=0.05, timeout=0.12)
+        updated = sum(row.age for row in self.pool.query(self.table))
+        assert 1 <= updated < 10, updated
+
+        self._timed_out(self.pool.delete, self.table, batch_size=1, sleep=0.05, timeout=0.12)
+        assert 0 < len(list(self.pool.query(self.table))) < 10
+
+    def testEntryPoints(self):
+        pool = DB(fakedb, {'host': 'localhost', 'db': 'bar'}, query_timeout=5)
+        assert len(list(pool.iter_table(self.table, chunk_size=4, timeout=1))) == 10
+        assert pool.query_columns(self.table).rowcount == 10
+        with pool.batch() as b:
+            b.execute('SELECT count(*) FROM %s' % self.table)
+        selects = [sql for host, sql, params in fakedb.statements if sql.startswith('SELECT')]
+        assert len(selects) == 5 and all('MAX_EXECUTION_TIME(' in sql for sql in selects), selects
+
+    def testKillRace(self):
+        class Late(object):
+            """The KILL fired just as the statement completed"""
+            def watch(self, deadline, connection_id):
+                return None
+
+            def cancel(self, watch):
+                return True
+        self.pool._get_watchdog = Late
+        assert self.pool.update(self.table, where={'id': 1}, obj={'age': 3}, timeout=5) == 1
+        assert sum(row.age for row in self.pool.query(self.table)) == 3
+        stats = self.pool.connection_pool.stats()
+        assert stats.closed == 1, 'The connection the KILL may hit must not be reused: %s' % stats
+
+    def testBroken(self):
+        pool = self.pool.connection_pool
+        conn = pool.connection()
+        pool.mark_broken(conn._entry.con)
+        conn.close()
+        stats = pool.stats()
+        assert stats.idle == 0 and stats.size == 0 and stats.closed == 1, stats
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+# coding: utf-8
+
+import unittest
+
+from pool import DB, ER_LOCK_DEADLOCK, ER_LOCK_WAIT_TIMEOUT
+from test import fakedb
+
+
+class TestTransactionRetry(unittest.TestCase):
+    """
+        Test pysql transactions, savepoints and replays on lock errors
+    """
+    TABLE = 't21'
+    TABLE_SCHEMA = """
+        CREATE TABLE IF NOT EXISTS `%s`(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name varchar(32) UNIQUE,
+            age int DEFAULT 0
+        );
+    """ % TABLE
+
+    def setUp(self):
+        fakedb.reset()
+        self.table = TestTransactionRetry.TABLE
+        self.config = {'host': 'localhost', 'db': 'bar'}
+        self.pool = DB(fakedb, self.config)
+        self.pool.execute(TestTransactionRetry.TABLE_SCHEMA)
+
+    def _names(self):
+        # Read on another pool, so only committed rows are seen.
+        return [r.name for r in DB(fakedb, self.config).query(self.table, order_by='id')]
+
+    def _fail(self, *codes):
+        """Make the next UPDATEs fail with the MySQL errors `codes`, one each"""
+        codes = list(codes)
+
+        def rows(conn, sql, params):
+            if codes:
+                raise fakedb.OperationalError(codes.pop(0), 'Lock error')
+            return []
+        fakedb.respond(r'^UPDATE', None, rows)
+
+    def testCommitRollback(self):
+        with self.pool.transaction():
+            self.pool.insert(self.table, {'name': 'a'})
+            assert self._names() == []
+        assert self._names() == ['a']
+
+        with self.assertRaises(ValueError):
+            with self.pool.transaction():
+                self.pool.insert(self.table, {'name': 'b'})
+                raise ValueError
+        assert self._names() == ['a']
+
+        tx = self.pool.transaction().begin()
+        self.pool.insert(self.table, {'name': 'c'})
+        tx.commit()
+        assert self._names() == ['a', 'c']
+        assert self.pool.transaction_stats() == {'commits': 2, 'rollbacks': 1, 'retries': 0, 'aborts': 0}
+        assert self.pool.connection_pool.stats().in_use == 0
+
+    def testSavepoints(self):
+        with self.pool.transaction():
+            self.pool.insert(self.table, {'name': 'a'})
+            with self.assertRaises(fakedb.IntegrityError):
+                with self.pool.transaction():
+                    self.pool.insert(self.table, {'name': 'b'})
+                    self.pool.insert(self.table, {'name': 'a'})
+            with self.pool.transaction():
+                self.pool.insert(self.table, {'name': 'c'})
+        assert self._names() == ['a', 'c']
+        sql = [sql for host, sql, params in fakedb.statements if 'SAVEPOINT' in sql]
+        assert sql == ['SAVEPOINT sp_1', 'ROLLBACK TO SAVEPOINT sp_1', 'SAVEPOINT sp_1', 'RELEASE SAVEPOINT sp_1'], sql
+
+    def testRetry(self):
+        calls = []
+
+        @self.pool.transaction(retries=3, backoff=0.001)
+        def rename(name):
+            calls.append(name)
+            self.pool.insert(self.table, {'name': name})
+            self.pool.update(self.table, where={'name': name}, obj={'age': 1})
+            return len(calls)
+
+        self._fail(ER_LOCK_DEADLOCK, ER_LOCK_WAIT_TIMEOUT)
+        assert rename('a') == 3
+        assert self._names() == ['a'], 'Failed attempts must be rolled back'
+        assert self.pool.transaction_stats().retries == 2
+
+        self._fail(*[ER_LOCK_DEADLOCK] * 4)
+        with self.assertRaises(fakedb.OperationalError):
+            rename('b')
+        assert len(calls) == 7 and self._names() == ['a']
+        stats = self.pool.transaction_stats()
+        assert stats.retries == 5 and stats.aborts == 1 and stats.commits == 1, stats
+
+    def testNoRetry(self):
+        calls = []
+
+        def insert():
+            calls.append(1)
+            self.pool.insert(self.table, {'name': 'a'})
+        self.pool.insert(self.table, {'name': 'a'})
+        with self.assertRaises(fakedb.IntegrityError):
+            self.pool.transaction(retries=3).run(insert)
+        assert len(calls) == 1, 'Only lock errors are replayed'
+
+    def testNestedDeadlock(self):
+        calls = []
+
+        def inner():
+            self.pool.update(self.table, where={'name': 'a'}, obj={'age': 2})
+
+        def outer():
+            calls.append(1)
+            self.pool.insert(self.table, {'name': 'b%d' % len(calls)})
+            self.pool.transaction(retries=3).run(inner)
+
+        self.pool.insert(self.table, {'name': 'a'})
+        self._fail(ER_LOCK_DEADLOCK)
+        self.pool.transaction(retries=1, backoff=0).run(outer)
+        assert len(calls) == 2, 'The outermost transaction is replayed'
+        assert self._names() == ['a', 'b2']
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+# coding: utf-8
+
+import unittest
+
+from pool import DB
+from test import fakedb
+
+
+class TestUpdatemany(unittest.TestCase):
+    """
+        Test pysql updatemany and per-row ON DUPLICATE KEY UPDATE
+    """
+    TABLE = 't17'
+    TABLE_SCHEMA = """
+        CREATE TABLE IF NOT EXISTS `%s`(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            grp int NOT NULL DEFAULT 0,
+            name varchar(32) DEFAULT '',
+            age int DEFAULT 0,
+            UNIQUE (grp, name)
+        );
+    """ % TABLE
+
+    def setUp(self):
+        fakedb.reset()
+        self.table = TestUpdatemany.TABLE
+        self.pool = DB(fakedb, {'host': 'localhost', 'db': 'bar'})
+        self.pool.execute(TestUpdatemany.TABLE_SCHEMA)
+        self.pool.insertmany(self.table, [{'grp': i % 2, 'name': 'n%d' % i, 'age': i} for i in range(1, 8)])
+        del fakedb.statements[:]
+
+    def _rows(self):
+        return list(self.pool.query(self.table, order_by='id', row_factory='tuple'))
+
+    def _writes(self):
+        return [sql for host, sql, params in fakedb.statements if sql.startswith(('UPDATE', 'INSERT'))]
+
+    def testCase(self):
+        rows = [{'id': 1, 'age': 10}, {'id': 2, 'name': 'x', 'age': 20}, {'id': 3, 'name': 'y'}, {'id': 99, 'age': 1}]
+        assert self.pool.updatemany(self.table, rows, chunk_size=2) == 3
+        assert len(self._writes()) == 2, 'One statement per chunk expected'
+        assert self._writes()[0] == ('UPDATE t17 SET age = CASE id WHEN %s THEN %s WHEN %s THEN %s ELSE age END, '
+                                     'name = CASE id WHEN %s THEN %s ELSE name END WHERE id IN (%s,%s)')
+        assert self._rows()[:4] == [(1, 1, 'n1', 10), (2, 0, 'x', 20), (3, 1, 'y', 3), (4, 0, 'n4', 4)]
+
+    def testCompositeKey(self):
+        rows = [{'grp': 1, 'name': 'n1', 'age': 11}, {'grp': 0, 'name': 'n2', 'age': 12}, {'grp': 0, 'name': 'n3', 'age': 13}]
+        assert self.pool.updatemany(self.table, rows, key=('grp', 'name')) == 2
+        assert 'WHERE (grp = %s AND name = %s) OR (grp = %s AND name = %s)' in self._writes()[0]
+        assert [r[3] for r in self._rows()[:3]] == [11, 12, 3]
+
+    def testUpsert(self):
+        rows = [{'id': 1, 'age': 10}, {'id': 2, 'age': 20}]
+        self.pool.updatemany(self.table, rows, method='upsert')
+        assert self._writes() == ['INSERT INTO t17 (age,id) VALUES (%s,%s),(%s,%s) '
+                                  'ON DUPLICATE KEY UPDATE age = VALUES(age)']
+        assert [r[3] for r in self._rows()[:3]] == [10, 20, 3]
+
+    def testDupColumns(self):
+        objs = [{'grp': 1, 'name': 'n1', 'age': 31}, {'grp': 1, 'name': 'new', 'age': 32}]
+        self.pool.insertmany(self.table, objs, dup=['age'])
+        self.pool.insert(self.table, {'grp': 1, 'name': 'n3', 'age': 33}, dup=['age'])
+        rows = self._rows()
+        assert rows[0][3] == 31 and rows[2][3] == 33, rows
+        assert rows[-1][1:] == (1, 'new', 32), rows
+
+
+if __name__ == '__main__':
+    unittest.main()
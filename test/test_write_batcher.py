@@ -0,0 +1,121 @@
+# coding: utf-8
+
+import threading
+import unittest
+
+from pool import DB
+from test import fakedb
+
+
+class TestWriteBatcher(unittest.TestCase):
+    """
+        Test pysql group commit of writes from many threads
+    """
+    TABLE = 't19'
+    TABLE_SCHEMA = """
+        CREATE TABLE IF NOT EXISTS `%s`(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name varchar(32) UNIQUE,
+            age int DEFAULT 0
+        );
+    """ % TABLE
+
+    def setUp(self):
+        fakedb.reset()
+        self.table = TestWriteBatcher.TABLE
+        self.pool = DB(fakedb, {'host': 'localhost', 'db': 'bar'})
+        self.pool.execute(TestWriteBatcher.TABLE_SCHEMA)
+        del fakedb.statements[:]
+
+    def tearDown(self):
+        self.pool.write_batcher().close()
+
+    def _statements(self, verb):
+        return [sql for host, sql, params in fakedb.statements if sql.startswith(verb)]
+
+    def testThreads(self):
+        batcher = self.pool.write_batcher(max_delay=0.05, max_ops=1000)
+        assert self.pool.write_batcher() is batcher
+        ids = []
+
+        def work(i):
+            ids.append(batcher.insert(self.table, {'name': 'n%d' % i, 'age': i}).result())
+
+        threads = [threading.Thread(target=work, args=(i,)) for i in range(20)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert sorted(ids) == list(range(1, 21)), ids
+        assert batcher.batches < 20 and batcher.writes == 20
+        assert len(self._statements('INSERT')) == batcher.batches, 'Inserts of a batch must be merged'
+        assert all(row.age == int(row.name[1:]) for row in self.pool.query(self.table))
+
+    def testMixed(self):
+        batcher = self.pool.write_batcher(max_delay=0.05)
+        futures = [
+            batcher.insert(self.table, {'name': 'a', 'age': 1}),
+            batcher.insert(self.table, {'name': 'b', 'age': 2}),
+            batcher.update(self.table, where={'name': 'a'}, obj={'age': 10}),
+            batcher.insert(self.table, {'name': 'c'}),
+            batcher.delete(self.table, where={'name': 'b'}),
+        ]
+        assert [f.result() for f in futures] == [1, 2, 1, 3, 1]
+        assert batcher.batches == 1
+        assert [(r.name, r.age) for r in self.pool.query(self.table, order_by='id')] == [('a', 10), ('c', 0)]
+
+    def testError(self):
+        batcher = self.pool.write_batcher(max_delay=0.05)
+        futures = [batcher.insert(self.table, {'name': name}, mode='INSERT', dup={})
+                   for name in ('a', 'b', 'a', 'c')]
+        batcher.flush()
+        assert [f.exception() is None for f in futures] == [True, True, False, True]
+        assert isinstance(futures[2].exception(), fakedb.IntegrityError)
+        assert sorted(r.name for r in self.pool.query(self.table)) == ['a', 'b', 'c']
+
+    def testAutocommit(self):
+        pool = DB(fakedb, {'host': 'localhost', 'db': 'bar', 'autocommit': True})
+        batcher = pool.write_batcher(max_delay=0.05)
+        try:
+            # Other columns each time, so the inserts are not merged into one statement.
+            futures = [batcher.insert(self.table, obj)
+                       for obj in ({'name': 'a'}, {'name': 'b', 'age': 1}, {'name': 'a'}, {'name': 'c', 'age': 2})]
+            batcher.flush()
+        finally:
+            batcher.close()
+        # The writes before the failing one are rolled back with the batch, and run again once.
+        assert [f.exception() is None for f in futures] == [True, True, False, True]
+        assert isinstance(futures[2].exception(), fakedb.IntegrityError)
+        assert sorted(r.name for r in pool.query(self.table)) == ['a', 'b', 'c']
+
+    def testCheckoutError(self):
+        batcher = self.pool.write_batcher(max_delay=0.01)
+        connect, failures = self.pool._connect, [fakedb.OperationalError('Too many connections')]
+
+        def flaky(config):
+            if failures:
+                raise failures.pop()
+            return connect(config)
+        self.pool._connect = flaky
+        first = batcher.insert(self.table, {'name': 'a'})
+        assert isinstance(first.exception(timeout=5), fakedb.OperationalError), first.exception()
+        assert batcher.insert(self.table, {'name': 'b'}).result(timeout=5) == 1
+        assert batcher._thread.is_alive(), 'The batcher thread died'
+
+    def testOneConnection(self):
+        pool = DB(fakedb, {'host': 'localhost', 'db': 'bar', 'maxconnections': 1, 'blocking': True})
+        batcher = pool.write_batcher(max_delay=0.05)
+        try:
+            futures = [batcher.insert(self.table, {'name': name}) for name in ('a', 'b')]
+            assert [f.result(timeout=5) for f in futures] == [1, 2]
+        finally:
+            batcher.close()
+
+    def testArguments(self):
+        batcher = self.pool.write_batcher(max_ops=10)
+        assert self.pool.write_batcher() is self.pool.write_batcher(max_ops=10) is batcher
+        self.assertRaises(ValueError, self.pool.write_batcher, max_ops=20)
+
+
+if __name__ == '__main__':
+    unittest.main()